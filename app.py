@@ -6,6 +6,8 @@ from flask import Flask
 from extensions import db, login_manager # Import from extensions
 from flask_migrate import Migrate  # Import Migrate
 from werkzeug.middleware.proxy_fix import ProxyFix
+from metrics import metrics
+from profiler import profiler
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -31,14 +33,112 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["UPLOAD_FOLDER"] = os.path.join(os.getcwd(), "file_storage")
 app.config["MAX_CONTENT_LENGTH"] = 100 * 1024 * 1024  
 
+# The upload API (/api/files, /api/uploads) isn't bound by MAX_CONTENT_LENGTH:
+# content is hashed while it streams to storage, up to UPLOAD_MAX_SIZE bytes.
+# Chunked uploads take chunks of up to UPLOAD_MAX_CHUNK_SIZE (clients are told
+# to use UPLOAD_CHUNK_SIZE) and are dropped after UPLOAD_SESSION_MAX_AGE
+# seconds without progress.
+app.config["UPLOAD_MAX_SIZE"] = 64 * 1024 * 1024 * 1024
+app.config["UPLOAD_CHUNK_SIZE"] = 16 * 1024 * 1024
+app.config["UPLOAD_MAX_CHUNK_SIZE"] = 256 * 1024 * 1024
+app.config["UPLOAD_SESSION_MAX_AGE"] = 7 * 24 * 3600
+
 
 app.config["BACKUP_TEMP_DIR"] = os.path.join(os.getcwd(), "backup_temp")
+app.config["BACKUP_WORKERS"] = int(os.environ.get("BACKUP_WORKERS", min(8, (os.cpu_count() or 1) + 2)))  # Threads for the hash/copy stage
+app.config["BACKUP_MAX_CONCURRENT_JOBS"] = int(os.environ.get("BACKUP_MAX_CONCURRENT_JOBS", 2))  # Jobs the scheduler runs at once
 app.config["DEFAULT_BACKUP_INTERVAL"] = 60 
 app.config["ALLOWED_BACKUP_INTERVALS"] = [15, 30, 60, 360, 720, 1440]  
 app.config["MAX_MONITORED_FOLDERS_PER_USER"] = 10
 app.config["MONITOR_ENABLED"] = True  
 
 
+# Files at least this large are stored as content-defined chunks so that
+# new versions only write the chunks that changed
+app.config["CHUNKED_STORAGE_ENABLED"] = os.environ.get("CHUNKED_STORAGE_ENABLED", "false").lower() == "true"
+app.config["CHUNKED_STORAGE_MIN_SIZE"] = 64 * 1024 * 1024
+app.config["CHUNK_AVG_SIZE"] = 1024 * 1024
+
+# Read buffer for the single-pass hash-and-copy path; copy_file_range/sendfile
+# are used when the kernel supports them
+app.config["COPY_BUFFER_SIZE"] = 1024 * 1024
+app.config["KERNEL_COPY_ENABLED"] = True
+
+# Downloads carry the version's checksum as a strong ETag and support Range
+# requests. With DOWNLOAD_OFFLOAD set, uncompressed blobs are handed to the
+# front server to stream from disk: "x-accel-redirect" for nginx (which needs
+# an internal location at DOWNLOAD_ACCEL_PREFIX aliased to UPLOAD_FOLDER) or
+# "x-sendfile" for Apache/lighttpd. Compressed and chunked content is always
+# sent by the app.
+app.config["DOWNLOAD_OFFLOAD"] = os.environ.get("DOWNLOAD_OFFLOAD") or None
+app.config["DOWNLOAD_ACCEL_PREFIX"] = "/_blobs/"
+
+# Backup jobs group-commit their rows: a transaction is committed every
+# BACKUP_COMMIT_BATCH_SIZE files or BACKUP_COMMIT_INTERVAL seconds.
+# Blobs are fsynced before the rows that reference them are committed.
+app.config["BACKUP_COMMIT_BATCH_SIZE"] = 500
+app.config["BACKUP_COMMIT_INTERVAL"] = 2.0
+app.config["BLOB_FSYNC"] = True
+
+# Stored content is compressed with zstd (gzip if the zstandard package isn't
+# installed), except for file types that are already compressed. Set
+# COMPRESSION=none to store raw copies.
+app.config["COMPRESSION"] = os.environ.get("COMPRESSION", "zstd")
+app.config["COMPRESSION_LEVEL"] = 3
+
+# Hash used for content addresses and version checksums (sha256, blake2b,
+# blake3 if installed, ...). "auto" benchmarks this host once and records
+# the fastest strong hash next to the blobs; run `python hashing.py` to see
+# the numbers.
+app.config["HASH_ALGORITHM"] = os.environ.get("HASH_ALGORITHM", "auto")
+
+# On Linux the scheduler watches monitored folders with inotify and backs up
+# changed files within FILE_WATCHER_POLL_INTERVAL seconds. Full scans still
+# run every backup_interval to catch anything the watcher missed.
+app.config["FILE_WATCHER_ENABLED"] = os.environ.get("FILE_WATCHER_ENABLED", "true").lower() == "true"
+app.config["FILE_WATCHER_POLL_INTERVAL"] = 5
+
+# The scheduler sleeps until the next folder is due and is woken when folders
+# change; it also reloads every folder's schedule this often (in seconds) to
+# pick up edits made by other processes
+app.config["SCHEDULER_REFRESH_INTERVAL"] = 600
+
+# "local" runs backup jobs inside the web process. "workers" only queues them
+# in the database; worker.py processes claim them, holding a lease of
+# JOB_LEASE_SECONDS that they renew while running. Jobs whose worker stops
+# renewing are requeued, up to JOB_MAX_ATTEMPTS tries.
+app.config["BACKUP_EXECUTION"] = os.environ.get("BACKUP_EXECUTION", "local")
+app.config["JOB_LEASE_SECONDS"] = 60
+app.config["JOB_CLAIM_INTERVAL"] = 2
+app.config["JOB_MAX_ATTEMPTS"] = 3
+
+# Jobs save a checkpoint with every commit. At startup, jobs left running by
+# a process that died resume from their checkpoint (again up to
+# JOB_MAX_ATTEMPTS tries). A running job of a process on another host counts
+# as dead once it hasn't checkpointed for JOB_ORPHAN_SECONDS.
+app.config["JOB_ORPHAN_SECONDS"] = 3600
+
+# Prometheus metrics at /metrics. Every process (gunicorn workers, worker.py)
+# writes its values to METRICS_DIR every METRICS_FLUSH_INTERVAL seconds and a
+# scrape adds them up; the gauges of processes silent for METRICS_STALE_SECONDS
+# are left out, their counters kept. Set METRICS_TOKEN to require "Authorization: Bearer <token>".
+app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR", os.path.join(os.getcwd(), "metrics"))
+app.config["METRICS_FLUSH_INTERVAL"] = 5
+app.config["METRICS_STALE_SECONDS"] = 60
+app.config["METRICS_STORAGE_INTERVAL"] = 300
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
+# Sampling profiler, off by default. PROFILE_JOBS profiles every backup job
+# (single jobs can also be profiled from the manual backup page) and
+# PROFILE_REQUEST_RATE is the fraction of HTTP requests to profile. Profiles
+# are collapsed stacks for flamegraph.pl or speedscope, written to PROFILE_DIR.
+app.config["PROFILE_JOBS"] = os.environ.get("PROFILE_JOBS", "false").lower() == "true"
+app.config["PROFILE_REQUEST_RATE"] = float(os.environ.get("PROFILE_REQUEST_RATE", 0))
+app.config["PROFILE_INTERVAL"] = 0.01
+app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", os.path.join(os.getcwd(), "profiles"))
+
+
 os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
 os.makedirs(app.config["BACKUP_TEMP_DIR"], exist_ok=True)
 
@@ -49,6 +149,8 @@ login_manager.login_view = "login"
 login_manager.login_message_category = "info"
 
 migrate = Migrate(app, db) # Initialize Migrate
+metrics.init_app(app)
+profiler.init_app(app)
 
 
 with app.app_context():
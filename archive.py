@@ -0,0 +1,217 @@
+"""Export backed-up files as a tar archive.
+
+The archive is produced as a stream: each file's content is read from
+storage (decompressing or joining chunks as needed) and written out
+straight after its header, so memory use doesn't depend on the size or
+number of files and nothing is staged on disk. Optionally the whole
+stream is compressed with gzip or zstd on the way out.
+
+    python archive.py --folder 3 -o photos.tar.zst --compression zstd
+    python archive.py --job 42 -o - | tar -t
+"""
+import os
+import sys
+import time
+import tarfile
+import calendar
+import logging
+import argparse
+from collections import namedtuple
+from sqlalchemy import select, func
+from werkzeug.utils import secure_filename
+from app import app, db
+from models import File, FileVersion, Blob, VersionChunk, MonitoredFolder, BackupJob, BackupLog
+from blob_store import ChunkedReader, open_blob, READ_CHUNK_SIZE, DEFAULT_COMPRESSION_LEVEL
+from compression import FILE_SUFFIXES, compressor, resolve_codec
+
+logger = logging.getLogger(__name__)
+
+# Rows are fetched from the database in batches of this many while the archive streams
+QUERY_BATCH_SIZE = 500
+
+MIME_TYPES = {None: "application/x-tar", "gzip": "application/gzip", "zstd": "application/zstd"}
+
+ExportMember = namedtuple("ExportMember", "arcname version_id size mtime filename compression is_chunked")
+
+
+def archive_name(name, compression=None):
+    return f"{secure_filename(name) or 'export'}.tar{FILE_SUFFIXES.get(compression, '')}"
+
+
+def _mtime(source_mtime_ns, created_at):
+    """The source file's mtime when it was backed up, or failing that when the version was taken"""
+    if source_mtime_ns is not None:
+        return source_mtime_ns // 1_000_000_000
+    return calendar.timegm(created_at.utctimetuple()) if created_at else 0
+
+
+def _members(stmt, prefix_for):
+    rows = db.session.execute(stmt.execution_options(yield_per=QUERY_BATCH_SIZE))
+    for row in rows:
+        arcname = "/".join((prefix_for(row), *row.source_path.replace(os.sep, "/").split("/")))
+        yield ExportMember(arcname, row.id, row.size, _mtime(row.source_mtime_ns, row.created_at),
+                           row.filename, row.compression, row.is_chunked)
+
+
+def _member_columns():
+    return (FileVersion.id, FileVersion.size, FileVersion.filename, FileVersion.is_chunked,
+            FileVersion.created_at, FileVersion.source_mtime_ns, Blob.compression, File.source_path)
+
+
+def folder_members(folder):
+    """Current version of every backed-up file of a monitored folder, under a directory named after it"""
+    prefix = secure_filename(folder.name) or f"folder-{folder.id}"
+    stmt = (
+        select(*_member_columns())
+        .join(File, File.id == FileVersion.file_id)
+        .outerjoin(Blob, Blob.id == FileVersion.blob_id)
+        .where(File.source_folder_id == folder.id, File.is_deleted == False,
+               File.source_path.isnot(None), FileVersion.is_current == True)
+        .order_by(File.source_path)
+    )
+    return _members(stmt, lambda row: prefix)
+
+
+def job_members(job):
+    """Every file a backup job backed up, at the version it left them in.
+
+    Files go under a directory named after their monitored folder, as a
+    job can cover several.
+    """
+    touched = select(BackupLog.file_id).where(BackupLog.job_id == job.id, BackupLog.file_id.isnot(None))
+    latest = (
+        select(FileVersion.file_id, func.max(FileVersion.version_number).label("version_number"))
+        .where(FileVersion.file_id.in_(touched))
+        .group_by(FileVersion.file_id)
+    )
+    if job.finished_at is not None:
+        # Later jobs may have added versions since
+        latest = latest.where(FileVersion.created_at <= job.finished_at)
+    latest = latest.subquery()
+    stmt = (
+        select(*_member_columns(), MonitoredFolder.id.label("folder_id"), MonitoredFolder.name.label("folder_name"))
+        .join(latest, (latest.c.file_id == FileVersion.file_id) & (latest.c.version_number == FileVersion.version_number))
+        .join(File, File.id == FileVersion.file_id)
+        .join(MonitoredFolder, MonitoredFolder.id == File.source_folder_id)
+        .outerjoin(Blob, Blob.id == FileVersion.blob_id)
+        .where(File.user_id == job.user_id, File.source_path.isnot(None))
+        .order_by(MonitoredFolder.name, MonitoredFolder.id, File.source_path)
+    )
+    return _members(stmt, lambda row: secure_filename(row.folder_name) or f"folder-{row.folder_id}")
+
+
+def _open_member(member, storage_root):
+    """Open a member's content for reading, or return None if some of it is missing from storage"""
+    if member.is_chunked:
+        chunks = db.session.execute(
+            select(VersionChunk.offset, VersionChunk.size, Blob.filename, Blob.compression)
+            .join(Blob, Blob.id == VersionChunk.blob_id)
+            .where(VersionChunk.version_id == member.version_id)
+            .order_by(VersionChunk.seq)
+        ).all()
+        if not all(os.path.exists(os.path.join(storage_root, chunk.filename)) for chunk in chunks):
+            return None
+        return ChunkedReader([tuple(chunk) for chunk in chunks], storage_root)
+    path = os.path.join(storage_root, member.filename)
+    if not os.path.exists(path):
+        return None
+    return open_blob(path, member.compression)
+
+
+def stream_tar(members, storage_root, compression=None, level=DEFAULT_COMPRESSION_LEVEL,
+               buffer_size=READ_CHUNK_SIZE):
+    """Yield a tar archive of members as a series of byte strings.
+
+    Headers are written in the POSIX pax format, so long paths and files
+    over 8 GiB are stored as they are. Members whose content is missing
+    from storage are left out with a warning.
+    """
+    start = time.perf_counter()
+    count = total = 0
+    position = 0  # Uncompressed bytes written
+    packer = compressor(compression, level) if compression else None
+
+    def out(data):
+        nonlocal position
+        position += len(data)
+        return packer.compress(data) if packer else data
+
+    for member in members:
+        source = _open_member(member, storage_root)
+        if source is None:
+            logger.warning(f"Leaving {member.arcname} out of the archive: its content is missing from storage")
+            continue
+        info = tarfile.TarInfo(member.arcname)
+        info.size = member.size
+        info.mtime = member.mtime
+        info.mode = 0o644
+        try:
+            data = out(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+            if data:
+                yield data
+            remaining = member.size
+            while remaining:
+                chunk = source.read(min(buffer_size, remaining))
+                if not chunk:
+                    # The header already promised member.size bytes; a short archive is all that's left
+                    raise IOError(f"{member.arcname} is shorter in storage than recorded")
+                remaining -= len(chunk)
+                data = out(chunk)
+                if data:
+                    yield data
+        finally:
+            source.close()
+        padding = -member.size % tarfile.BLOCKSIZE
+        if padding:
+            data = out(tarfile.NUL * padding)
+            if data:
+                yield data
+        count += 1
+        total += member.size
+
+    # End-of-archive marker, padded to a full record like tar(1) does
+    end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    end += tarfile.NUL * (-(position + len(end)) % tarfile.RECORDSIZE)
+    yield out(end) + (packer.flush() if packer else b"")
+    logger.info(f"Exported {count} files ({total} bytes) in {time.perf_counter() - start:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export backed-up files as a tar archive")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--folder", type=int, help="id of the monitored folder to export (current versions)")
+    source.add_argument("--job", type=int, help="id of the backup job whose files to export")
+    parser.add_argument("-o", "--output", required=True, help="archive to write, or - for standard output")
+    parser.add_argument("--compression", default=None, help="gzip or zstd (default: none)")
+    parser.add_argument("--level", type=int, default=None, help="compression level (default: COMPRESSION_LEVEL)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    with app.app_context():
+        if args.folder is not None:
+            folder = db.session.get(MonitoredFolder, args.folder)
+            if folder is None:
+                parser.error(f"no monitored folder {args.folder}")
+            members = folder_members(folder)
+        else:
+            job = db.session.get(BackupJob, args.job)
+            if job is None:
+                parser.error(f"no backup job {args.job}")
+            members = job_members(job)
+        codec = resolve_codec(args.compression)
+        level = args.level or app.config.get("COMPRESSION_LEVEL", DEFAULT_COMPRESSION_LEVEL)
+        stream = stream_tar(members, app.config["UPLOAD_FOLDER"], codec, level,
+                            app.config.get("COPY_BUFFER_SIZE", READ_CHUNK_SIZE))
+        out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        try:
+            for data in stream:
+                out.write(data)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+
+
+if __name__ == "__main__":
+    main()
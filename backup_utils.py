@@ -1,25 +1,37 @@
 import os
-import shutil
-import hashlib
 import logging
-import uuid
 import time
 import mimetypes
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from werkzeug.utils import secure_filename
 from flask import current_app
+from sqlalchemy import insert, select, update
 from app import db
-from models import File, FileVersion, MonitoredFolder, BackupJob, BackupLog
+from models import File, FileVersion, VersionChunk, MonitoredFolder, BackupJob, BackupLog
+from blob_store import (stage_file, commit_blobs, storage_algorithm, SourceChangedError, READ_CHUNK_SIZE,
+                        DEFAULT_COMPRESSION_LEVEL)
+from chunk_store import stage_chunked
+from compression import resolve_codec, should_compress
+from folder_index import FolderIndex, IndexEntry
+from hashing import verify_file, measure_hashing
+from job_queue import LeaseLostError, confirm_claim
+from job_stats import FileTiming, JobStats
+from metrics import metrics
+from profiler import profiler
+from usage import UsageChanges
 
 logger = logging.getLogger(__name__)
 
-def calculate_file_hash(file_path):
-    """Calculate MD5 hash of a file"""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+def checksum_matches(file_path, checksum, buffer_size=None):
+    """Whether a file still has the content a version's checksum describes.
+    
+    Works for tagged checksums and for the untagged MD5 ones of older versions.
+    """
+    if buffer_size is None:
+        buffer_size = current_app.config.get('COPY_BUFFER_SIZE', READ_CHUNK_SIZE)
+    return verify_file(file_path, checksum, buffer_size)
 
 def get_file_mime_type(file_path):
     """Get MIME type of a file"""
@@ -44,56 +56,158 @@ def scan_folder(folder_id):
             file_path = os.path.join(root, file)
             file_paths.append(file_path)
     
+    # Walk order depends on the filesystem; sort so jobs are reproducible
+    file_paths.sort()
+    
     logger.debug(f"Found {len(file_paths)} files in folder {folder.name}")
     return file_paths
 
-def should_backup_file(folder_id, file_path):
-    """Check if a file should be backed up based on its modification time and existing backups"""
-    folder = MonitoredFolder.query.get(folder_id)
-    if not folder:
-        return False
-    
-    
-    try:
-        mtime = os.path.getmtime(file_path)
-        mod_time = datetime.fromtimestamp(mtime)
-    except (OSError, ValueError) as e:
-        logger.error(f"Error getting modification time for {file_path}: {e}")
-        return False
-    
-    
-    rel_path = os.path.relpath(file_path, folder.path)
-    
+def existing_files(folder, paths):
+    """Filter changed paths reported for a folder down to files that still exist in it"""
+    root = os.path.join(os.path.abspath(folder.path), '')
+    return sorted(p for p in paths if p.startswith(root) and os.path.isfile(p))
+
+def stat_key(st):
+    """The parts of a stat result that identify one state of a file's content"""
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+
+def source_stat_fields(st):
+    """FileVersion columns describing the source file a version was taken from"""
+    size, mtime_ns, inode, ctime_ns = stat_key(st)
+    return {
+        'source_size': size,
+        'source_mtime_ns': mtime_ns,
+        'source_inode': inode,
+        'source_ctime_ns': ctime_ns,
+    }
+
+def source_unchanged(version, st):
+    """Check whether a file's current stat matches the one recorded on a version"""
+    recorded = (version.source_size, version.source_mtime_ns, version.source_inode, version.source_ctime_ns)
+    return recorded == stat_key(st)
+
+def needs_backup(entry, st):
+    """Decide from a file's stat whether it changed since the version in entry.
     
-    existing_file = File.query.filter_by(
-        source_folder_id=folder.id,
-        source_path=rel_path,
-        is_deleted=False
-    ).first()
+    Returns None when the version predates stat tracking and only a content
+    comparison can tell.
+    """
+    if entry is None or entry.version_id is None:
+        return True
+    if entry.source_mtime_ns is not None:
+        return not source_unchanged(entry, st)
+    if entry.size != st.st_size:
+        return True
+    return None
+
+def adopt_source_stat(entry, st, index=None, rel_path=None):
+    """Record the current stat on a pre-stat-tracking version whose content is unchanged.
+    
+    The caller commits.
+    """
+    fields = source_stat_fields(st)
+    FileVersion.query.filter_by(id=entry.version_id).update(fields)
+    if index is not None:
+        index.set(rel_path, entry._replace(**fields))
+
+def should_backup_file(folder_id, file_path, index=None):
+    """Check if a file should be backed up by comparing its stat with the latest version's.
+    
+    Unchanged files cost a single stat call; their content is never read.
+    Pass the job's FolderIndex to avoid querying the database.
+    
+    Returns (changed, adopt). adopt is None, or the (entry, stat) of a version
+    from before stat tracking whose content is unchanged: the caller records it
+    with adopt_source_stat so later checks are stat-only.
+    """
+    if index is not None:
+        folder_path = index.folder_path
+    else:
+        folder = MonitoredFolder.query.get(folder_id)
+        if not folder:
+            return False, None
+        folder_path = folder.path
     
     
-    if not existing_file:
-        return True
+    try:
+        st = os.stat(file_path)
+    except OSError as e:
+        logger.error(f"Error reading file status for {file_path}: {e}")
+        return False, None
     
     
-    latest_version = existing_file.get_latest_version()
-    if not latest_version:
-        return True
+    rel_path = os.path.relpath(file_path, folder_path)
+    entry = index.get(rel_path) if index is not None else FolderIndex.lookup(folder_id, rel_path)
     
+    changed = needs_backup(entry, st)
+    if changed is not None:
+        return changed, None
     
-    if mod_time > latest_version.created_at:
-        return True
+    # Versions recorded before stat tracking: compare content once
+    if entry.checksum and not checksum_matches(file_path, entry.checksum):
+        return True, None
     
+    return False, (entry, st)
 
-    if mod_time == latest_version.created_at and latest_version.checksum:
-        current_checksum = calculate_file_hash(file_path)
-        if current_checksum != latest_version.checksum:
-            return True
-    
-    return False
+def get_storage_settings():
+    """Snapshot the config values the storage stage needs, for use outside the app context"""
+    config = current_app.config
+    return {
+        'storage_root': config['UPLOAD_FOLDER'],
+        'hash_algorithm': storage_algorithm(config['UPLOAD_FOLDER'], config.get('HASH_ALGORITHM')),
+        'chunked_enabled': config.get('CHUNKED_STORAGE_ENABLED', False),
+        'chunked_min_size': config.get('CHUNKED_STORAGE_MIN_SIZE'),
+        'chunk_avg_size': config.get('CHUNK_AVG_SIZE'),
+        'buffer_size': config.get('COPY_BUFFER_SIZE', READ_CHUNK_SIZE),
+        'kernel_copy': config.get('KERNEL_COPY_ENABLED', True),
+        'durable': config.get('BLOB_FSYNC', True),
+        'compression': resolve_codec(config.get('COMPRESSION')),
+        'compression_level': config.get('COMPRESSION_LEVEL', DEFAULT_COMPRESSION_LEVEL),
+    }
+
+def choose_compression(file_path, settings):
+    """Codec to store a file with, or None if its type is already compressed"""
+    if settings['compression'] and should_compress(get_file_mime_type(file_path)):
+        return settings['compression']
+    return None
 
-def create_backup_job(user_id, name=None, is_manual=False):
-    """Create a new backup job"""
+def stage_file_content(file_path, settings):
+    """Copy a file's content into storage without touching the database.
+    
+    This is the stat/hash/copy stage of a backup and is safe to run in worker
+    threads. The source is read and hashed exactly once: the version's
+    checksum is the whole-file content digest. Content is compressed unless
+    its MIME type says it already is. Raises OSError if the file can't be read.
+    """
+    storage_root = settings['storage_root']
+    algorithm = settings['hash_algorithm']
+    st = os.stat(file_path)
+    compression = choose_compression(file_path, settings)
+    level = settings['compression_level']
+    
+    if settings['chunked_enabled'] and st.st_size >= settings['chunked_min_size']:
+        avg_size = settings['chunk_avg_size']
+        digest, size, chunks = stage_chunked(file_path, storage_root, avg_size // 4, avg_size, avg_size * 4,
+                                             durable=settings['durable'], compression=compression, level=level,
+                                             algorithm=algorithm)
+        staged = {'digest': digest, 'chunks': chunks, 'size': size,
+                  'stored_size': sum(chunk.stored_size for _, chunk in chunks)}
+    else:
+        blob = stage_file(file_path, storage_root, buffer_size=settings['buffer_size'],
+                          kernel_copy=settings['kernel_copy'], durable=settings['durable'],
+                          compression=compression, level=level, algorithm=algorithm)
+        digest = blob.digest
+        staged = {'blob': blob, 'size': blob.size, 'stored_size': blob.stored_size}
+    
+    # The recorded stat must describe exactly the bytes that were stored
+    if stat_key(st) != stat_key(os.stat(file_path)):
+        raise SourceChangedError(f"{file_path} changed while it was being backed up")
+    
+    staged.update(checksum=digest, stat=st)
+    return staged
+
+def create_backup_job(user_id, name=None, is_manual=False, folder_id=None, claimed_by=None, profile=False):
+    """Create a new backup job, scoped to one folder if folder_id is given"""
     if not name:
         name = f"Backup {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
     
@@ -101,7 +215,10 @@ def create_backup_job(user_id, name=None, is_manual=False):
         name=name,
         user_id=user_id,
         status="pending",
-        is_manual=is_manual
+        is_manual=is_manual,
+        folder_id=folder_id,
+        claimed_by=claimed_by,
+        profile=profile
     )
     
     db.session.add(job)
@@ -120,144 +237,359 @@ def backup_file(file_path, folder_id, job_id=None):
         logger.error(f"File {file_path} does not exist")
         return None
     
-    
-    original_filename = os.path.basename(file_path)
-    safe_original_filename = secure_filename(original_filename)
-    file_extension = os.path.splitext(safe_original_filename)[1].lower()
-    unique_filename = f"{uuid.uuid4().hex}{file_extension}"
-    
-    
-    rel_path = os.path.relpath(file_path, folder.path)
-    
-    
     try:
-        file_size = os.path.getsize(file_path)
-        file_hash = calculate_file_hash(file_path)
-        content_type = get_file_mime_type(file_path)
+        staged = stage_file_content(file_path, get_storage_settings())
     except (OSError, IOError) as e:
-        logger.error(f"Error accessing file {file_path}: {e}")
+        logger.error(f"Error storing file {file_path}: {e}")
         return None
     
-    
-    existing_file = File.query.filter_by(
-        source_folder_id=folder.id,
-        source_path=rel_path,
-        is_deleted=False
-    ).first()
-    
-    new_version = None
-    
-    
-    if existing_file:
-    
-        latest_version = FileVersion.query.filter_by(file_id=existing_file.id).order_by(FileVersion.version_number.desc()).first()
-        version_number = (latest_version.version_number + 1) if latest_version else 1
-        
-        
-        for version in existing_file.versions:
-            version.is_current = False
-        
-        storage_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
-        try:
-            shutil.copy2(file_path, storage_path)
-        except (OSError, IOError) as e:
-            logger.error(f"Error copying file {file_path} to {storage_path}: {e}")
-            return None
-        
-        new_version = FileVersion(
-            file_id=existing_file.id,
-            version_number=version_number,
-            filename=unique_filename,
-            size=file_size,
-            is_current=True,
-            checksum=file_hash,
-            change_reason="Automatic backup - file modified"
-        )
-        
-        existing_file.size = file_size
-        existing_file.updated_at = datetime.utcnow()
+    writer = BackupWriter(job_id)
+    pending = writer.add_backup(folder, file_path, staged)
+    writer.flush()
+    return db.session.get(File, pending.file_id)
+
+class PendingBackup:
+    """A staged file waiting for the next BackupWriter flush"""
+    
+    def __init__(self, folder, file_path, staged, entry, index):
+        self.folder_id = folder.id
+        self.user_id = folder.user_id
+        self.file_path = file_path
+        self.rel_path = os.path.relpath(file_path, folder.path)
+        self.staged = staged
+        self.entry = entry
+        self.index = index
+        self.timestamp = datetime.utcnow()
+        self.file_id = entry.file_id if entry else None
+        self.version_number = (entry.version_number or 0) + 1 if entry else 1
+        self.version_id = None
+
+class BackupWriter:
+    """Group-commits the rows produced by a backup job.
+    
+    Files, versions, chunks and logs are buffered and written in one
+    transaction once batch_size files are pending or interval seconds have
+    passed, each kind of row with one executemany INSERT/UPDATE; the ids of
+    new files and versions are read back with one SELECT each. Blob content is already on
+    disk (and fsynced) when it is staged, so a committed row never points
+    at missing data; a crash only loses the uncommitted batch, whose blobs
+    are reclaimed by collect_garbage (python blob_store.py gc).
+    
+    checkpoint, if given, is called as checkpoint(folder_id, rel_path) with
+    the last position passed to mark_done() just before each commit, so a
+    job's progress is saved in the same transaction as the rows it covers.
+    guard, if given, is called right before every commit and may raise to
+    stop the commit (e.g. LeaseLostError once another worker owns the job).
+    """
+    
+    def __init__(self, job_id=None, batch_size=500, interval=2.0, checkpoint=None, guard=None):
+        self.job_id = job_id
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.checkpoint = checkpoint
+        self.guard = guard
+        self._position = None
+        self._backups = []
+        self._adopted = []
+        self._logs = []
+        self._last_flush = time.monotonic()
+        self.flush_seconds = 0.0  # Time spent writing to the database, for the job's stats
+    
+    def add_backup(self, folder, file_path, staged, index=None):
+        """Queue the rows for a staged file and return its PendingBackup"""
+        rel_path = os.path.relpath(file_path, folder.path)
+        entry = index.get(rel_path) if index is not None else FolderIndex.lookup(folder.id, rel_path)
+        pending = PendingBackup(folder, file_path, staged, entry, index)
+        self._backups.append(pending)
+        if self.job_id:
+            self._logs.append(pending)
+        return pending
+    
+    def adopt_source_stat(self, entry, st, index=None, rel_path=None):
+        """Queue recording the current stat on a pre-stat-tracking version"""
+        fields = source_stat_fields(st)
+        self._adopted.append({'id': entry.version_id, **fields})
+        if index is not None:
+            index.set(rel_path, entry._replace(**fields))
+    
+    def add_log(self, message, level="info", folder_id=None):
+        """Queue a job log entry, kept in order with the per-file entries"""
+        self._logs.append(BackupLog(message=message, level=level, folder_id=folder_id, job_id=self.job_id,
+                                    timestamp=datetime.utcnow()))
+    
+    def mark_done(self, folder_id, rel_path):
+        """Note that every file of the job up to this one has been handed to the writer"""
+        self._position = (folder_id, rel_path)
+    
+    def maybe_flush(self):
+        if (len(self._backups) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.interval):
+            self.flush()
+    
+    def flush(self):
+        """Write everything queued (and any other pending session changes) in one transaction"""
+        start = time.perf_counter()
+        backups = self._backups
         
-       
-        db.session.add(new_version)
-        db.session.commit()
+        blobs = []
+        for pending in backups:
+            if 'chunks' in pending.staged:
+                blobs.extend(chunk for _, chunk in pending.staged['chunks'])
+            else:
+                blobs.append(pending.staged['blob'])
+        blob_ids = commit_blobs(blobs)
         
-        logger.info(f"Created new version {version_number} for file {rel_path}")
+        new_files = [p for p in backups if p.file_id is None]
+        if new_files:
+            # A plain executemany, then one SELECT for the ids: INSERT ... RETURNING with the
+            # rows' order kept falls back to one statement per row on SQLite
+            db.session.execute(insert(File), [self._file_row(p) for p in new_files])
+            file_ids = self._new_file_ids(new_files)
+            for pending in new_files:
+                pending.file_id = file_ids[(pending.folder_id, pending.rel_path)]
         
-        if job_id:
-            log = BackupLog(
-                message=f"Updated file: {rel_path} (version {version_number})",
-                level="info",
-                folder_id=folder.id,
-                job_id=job_id,
-                file_id=existing_file.id
+        updated_files = [p for p in backups if p.entry is not None]
+        if updated_files:
+            db.session.execute(update(File), [
+                {'id': p.file_id, 'size': p.staged['size'], 'updated_at': p.timestamp} for p in updated_files
+            ])
+            db.session.execute(
+                update(FileVersion)
+                .where(FileVersion.file_id.in_([p.file_id for p in updated_files]), FileVersion.is_current == True)
+                .values(is_current=False)
             )
-            db.session.add(log)
-            db.session.commit()
         
-        return existing_file
-    
-    else:
-        storage_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
-        try:
-            shutil.copy2(file_path, storage_path)
-        except (OSError, IOError) as e:
-            logger.error(f"Error copying file {file_path} to {storage_path}: {e}")
-            return None
+        if backups:
+            db.session.execute(insert(FileVersion), [self._version_row(p, blob_ids) for p in backups])
+            # The new versions are the only current ones of their files
+            version_ids = dict(db.session.execute(
+                select(FileVersion.file_id, FileVersion.id)
+                .where(FileVersion.file_id.in_([p.file_id for p in backups]), FileVersion.is_current == True)
+            ).all())
+            chunk_rows = []
+            for pending in backups:
+                version_id = pending.version_id = version_ids[pending.file_id]
+                for seq, (offset, chunk) in enumerate(pending.staged.get('chunks', ())):
+                    chunk_rows.append({'version_id': version_id, 'seq': seq, 'offset': offset,
+                                       'size': chunk.size, 'blob_id': blob_ids[chunk.digest]})
+            if chunk_rows:
+                db.session.execute(insert(VersionChunk), chunk_rows)
         
-       
-        new_file = File(
-            filename=unique_filename,
-            original_filename=safe_original_filename,
-            size=file_size,
-            content_type=content_type,
-            user_id=folder.user_id,
-            source_folder_id=folder.id,
-            source_path=rel_path,
-            is_auto_backup=True
-        )
+        if self._adopted:
+            db.session.execute(update(FileVersion), self._adopted)
         
-        db.session.add(new_file)
-        db.session.flush()  
+        if self._logs:
+            db.session.execute(insert(BackupLog), [self._log_row(log) for log in self._logs])
         
-        new_version = FileVersion(
-            file_id=new_file.id,
-            version_number=1,
-            filename=unique_filename,
-            size=file_size,
-            is_current=True,
-            checksum=file_hash,
-            change_reason="Automatic backup - initial version"
-        )
+        if backups:
+            changes = UsageChanges()
+            for pending in backups:
+                staged = pending.staged
+                if pending.entry is None:
+                    changes.add(pending.user_id, pending.folder_id, files=1, size=staged['size'])
+                else:
+                    changes.add(pending.user_id, pending.folder_id, size=staged['size'] - (pending.entry.file_size or 0))
+                stored = staged['stored_size'] if staged['stored_size'] is not None else staged['size']
+                changes.add(pending.user_id, pending.folder_id, versions=1, stored=stored)
+            changes.apply()
         
-        db.session.add(new_version)
+        if self.checkpoint is not None and self._position is not None:
+            self.checkpoint(*self._position)
+        
+        if self.guard is not None:
+            self.guard()
         db.session.commit()
         
-        logger.info(f"Created new file backup for {rel_path}")
+        for pending in backups:
+            if pending.entry:
+                logger.info(f"Created new version {pending.version_number} for file {pending.rel_path}")
+            else:
+                logger.info(f"Created new file backup for {pending.rel_path}")
+            if pending.index is not None:
+                pending.index.set(pending.rel_path, self._index_entry(pending))
         
-       
-        if job_id:
-            log = BackupLog(
-                message=f"New file: {rel_path}",
-                level="info",
-                folder_id=folder.id,
-                job_id=job_id,
-                file_id=new_file.id
+        self._backups = []
+        self._adopted = []
+        self._logs = []
+        self._last_flush = time.monotonic()
+        self.flush_seconds += time.perf_counter() - start
+    
+    def _new_file_ids(self, new_files):
+        """{(folder_id, source_path): id} of the File rows just inserted for new_files"""
+        paths = defaultdict(list)
+        for pending in new_files:
+            paths[pending.folder_id].append(pending.rel_path)
+        file_ids = {}
+        for folder_id, rel_paths in paths.items():
+            # A path has at most one live File; earlier ones were deleted
+            rows = db.session.execute(
+                select(File.source_path, File.id)
+                .where(File.source_folder_id == folder_id, File.source_path.in_(rel_paths), File.is_deleted == False)
             )
-            db.session.add(log)
-            db.session.commit()
+            file_ids.update(((folder_id, rel_path), file_id) for rel_path, file_id in rows)
+        return file_ids
+    
+    def _file_row(self, pending):
+        return {
+            'filename': pending.staged.get('digest') or pending.staged['blob'].filename,
+            'original_filename': secure_filename(os.path.basename(pending.file_path)),
+            'size': pending.staged['size'],
+            'content_type': get_file_mime_type(pending.file_path),
+            'created_at': pending.timestamp,
+            'updated_at': pending.timestamp,
+            'user_id': pending.user_id,
+            'is_deleted': False,
+            'source_folder_id': pending.folder_id,
+            'source_path': pending.rel_path,
+            'is_auto_backup': True,
+        }
+    
+    def _version_row(self, pending, blob_ids):
+        staged = pending.staged
+        row = {
+            'file_id': pending.file_id,
+            'version_number': pending.version_number,
+            'size': staged['size'],
+            'stored_size': staged['stored_size'],
+            'created_at': pending.timestamp,
+            'is_current': True,
+            'checksum': staged['checksum'],
+            'change_reason': "Automatic backup - file modified" if pending.entry else "Automatic backup - initial version",
+            **source_stat_fields(staged['stat']),
+        }
+        if 'chunks' in staged:
+            row.update(filename=staged['digest'], is_chunked=True, blob_id=None)
+        else:
+            row.update(filename=staged['blob'].filename, is_chunked=False, blob_id=blob_ids[staged['blob'].digest])
+        return row
+    
+    def _log_row(self, log):
+        if isinstance(log, PendingBackup):
+            if log.entry:
+                message = f"Updated file: {log.rel_path} (version {log.version_number})"
+            else:
+                message = f"New file: {log.rel_path}"
+            return {'message': message, 'level': 'info', 'timestamp': log.timestamp,
+                    'folder_id': log.folder_id, 'job_id': self.job_id, 'file_id': log.file_id}
+        return {'message': log.message, 'level': log.level, 'timestamp': log.timestamp,
+                'folder_id': log.folder_id, 'job_id': log.job_id, 'file_id': None}
+    
+    def _index_entry(self, pending):
+        staged = pending.staged
+        return IndexEntry(pending.file_id, staged['size'], pending.version_id, pending.version_number,
+                          staged['size'], staged['checksum'], *stat_key(staged['stat']))
+
+def process_file(file_path, entry, settings):
+    """Worker task: the stat/hash/copy stage for one file of a job.
+    
+    Returns (action, payload, error, timing) where action is 'skip', 'adopt'
+    (payload is the stat to record), 'backup' (payload is the staged content)
+    or 'error', and timing is a FileTiming for the job's stats.
+    """
+    start = time.perf_counter()
+    try:
+        st = os.stat(file_path)
+        changed = needs_backup(entry, st)
+        scan_seconds = time.perf_counter() - start
+        hash_seconds = 0.0
+        bytes_hashed = 0
+        if changed is None:
+            if entry.checksum:
+                with measure_hashing() as meter:
+                    changed = not checksum_matches(file_path, entry.checksum, settings['buffer_size'])
+                hash_seconds, bytes_hashed = meter.seconds, st.st_size
+            if not changed:
+                return 'adopt', st, None, FileTiming(scan_seconds, hash_seconds, 0.0, bytes_hashed)
+        if not changed:
+            return 'skip', None, None, FileTiming(scan_seconds, 0.0, 0.0, 0)
         
-        return new_file
+        stage_start = time.perf_counter()
+        with measure_hashing() as meter:
+            staged = stage_file_content(file_path, settings)
+        # Hashing is fused with the copy; everything else the stage does counts as copying
+        copy_seconds = time.perf_counter() - stage_start - meter.seconds
+        timing = FileTiming(scan_seconds, hash_seconds + meter.seconds, copy_seconds, bytes_hashed + staged['size'])
+        return 'backup', staged, None, timing
+    except (OSError, IOError) as e:
+        return 'error', None, e, None
+
+def process_in_parallel(pool, fn, items, max_in_flight):
+    """Run fn(*item) on the pool for each item and yield (item, result) in input order.
+    
+    At most max_in_flight items are being processed at once, so memory stays
+    bounded however long items is. Results come back in the order the items
+    were given, which keeps job results deterministic.
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, pool.submit(fn, *item)))
+        if len(pending) >= max_in_flight:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
 
-def run_backup_job(job_id):
-    """Run a complete backup job for all files in all active folders for the job owner"""
+def run_backup_job(job_id, changed_paths=None, worker_id=None, cancel=None):
+    """Run a backup job for the job's folder, or all active folders of the job owner if it has none
+    
+    changed_paths, if given, are the paths the file watcher saw change in
+    the job's folder; only those files are looked at instead of a full scan.
+    worker_id is given by queue workers that claimed the job: every commit
+    of the job then only goes through while that claim still holds. cancel,
+    a threading.Event, is set by the worker when it loses the claim, and
+    stops the job at the next file.
+    A job that has a checkpoint (it was interrupted and is being resumed)
+    continues after it: folders and files are processed in sorted order,
+    so everything up to the checkpoint is skipped without being looked at.
+    Files added before the checkpoint in the meantime are left for the
+    folder's next job.
+    """
     job = BackupJob.query.get(job_id)
     if not job:
         logger.error(f"Job with ID {job_id} not found")
         return False
     
+    if not profiler.wants_job(job):
+        return _run_job(job, changed_paths, worker_id, cancel)
+    
+    with profiler.profile_job(job.id) as profile_file:
+        result = _run_job(job, changed_paths, worker_id, cancel)
+    job.profile_file = profile_file
+    db.session.commit()
+    return result
+
+def _run_job(job, changed_paths, worker_id=None, cancel=None):
+    """Body of run_backup_job, once the job has been loaded"""
+    
+    def guard():
+        """Stop the job, before its next commit, if it now belongs to another worker"""
+        if cancel is not None and cancel.is_set():
+            db.session.rollback()
+            raise LeaseLostError(f"Lost the claim on backup job {job.id}")
+        if worker_id is not None:
+            confirm_claim(job.id, worker_id)
+    
+    resuming = job.checkpoint_folder_id is not None
     job.status = "running"
+    if not resuming or job.started_at is None:
+        job.started_at = datetime.utcnow()
+    try:
+        guard()
+    except LeaseLostError as e:
+        logger.warning(f"Not starting backup job {job.id}: {e}")
+        return False
     db.session.commit()
     
+    stats = JobStats.resume(job) if resuming else JobStats()
+    writer = None
+    
+    def save_checkpoint(folder_id, rel_path):
+        job.checkpoint_folder_id = folder_id
+        job.checkpoint_path = rel_path
+        job.checkpoint_at = datetime.utcnow()
+        stats.save(job, writer.flush_seconds)
+    
     try:
         start_time = time.time()
         
@@ -265,7 +597,12 @@ def run_backup_job(job_id):
         folders = MonitoredFolder.query.filter_by(
             user_id=job.user_id,
             is_active=True
-        ).all()
+        )
+        if job.folder_id is not None:
+            folders = folders.filter_by(id=job.folder_id)
+        if resuming:
+            folders = folders.filter(MonitoredFolder.id >= job.checkpoint_folder_id)
+        folders = folders.order_by(MonitoredFolder.id).all()
         
         if not folders:
             log = BackupLog(
@@ -276,69 +613,124 @@ def run_backup_job(job_id):
             db.session.add(log)
             
          
+            guard()
             job.status = "completed"
+            job.finished_at = datetime.utcnow()
+            stats.save(job)
             db.session.commit()
+            metrics.record_job(job.status, stats)
             
             logger.warning(f"No active folders found for backup job {job.id}")
             return True
         
-        total_files = 0
-        backed_up_files = 0
-        
-    
-        for folder in folders:
-            folder.last_scan_at = datetime.utcnow()
-            db.session.commit()
-            
-            log = BackupLog(
-                message=f"Scanning folder: {folder.name} ({folder.path})",
-                level="info",
-                folder_id=folder.id,
-                job_id=job.id
-            )
-            db.session.add(log)
-            db.session.commit()
-            
-        
-            file_paths = scan_folder(folder.id)
-            total_files += len(file_paths)
-            
+        workers = max(1, current_app.config.get('BACKUP_WORKERS', 1))
+        settings = get_storage_settings()
+        writer = BackupWriter(
+            job.id,
+            batch_size=current_app.config.get('BACKUP_COMMIT_BATCH_SIZE', 500),
+            interval=current_app.config.get('BACKUP_COMMIT_INTERVAL', 2.0),
+            checkpoint=save_checkpoint,
+            guard=guard
+        )
+        if resuming:
+            writer.add_log(f"Resuming after {job.checkpoint_path} (checkpoint of {job.checkpoint_at})",
+                           folder_id=job.checkpoint_folder_id)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"backup-job-{job.id}") as pool:
+            for folder in folders:
+                with stats.timed('db'):
+                    index = FolderIndex.load(folder)
+                if changed_paths is None:
+                    folder.last_scan_at = datetime.utcnow()
+                    writer.add_log(f"Scanning folder: {folder.name} ({folder.path})", folder_id=folder.id)
+                    with stats.timed('scan'):
+                        file_paths = scan_folder(folder.id)
+                else:
+                    writer.add_log(f"Backing up {len(changed_paths)} changed paths in folder: {folder.name} ({folder.path})",
+                                   folder_id=folder.id)
+                    with stats.timed('scan'):
+                        file_paths = existing_files(folder, changed_paths)
+                if resuming and folder.id == job.checkpoint_folder_id:
+                    done = os.path.join(folder.path, job.checkpoint_path)
+                    file_paths = [p for p in file_paths if p > done]
             
-            for file_path in file_paths:
-                if should_backup_file(folder.id, file_path):
-                    result = backup_file(file_path, folder.id, job.id)
-                    if result:
-                        backed_up_files += 1
+                # Stat, hash and copy run on the worker pool; this thread is the
+                # only one that touches the database session
+                tasks = ((p, index.get(os.path.relpath(p, folder.path)), settings) for p in file_paths)
+                results = process_in_parallel(pool, process_file, tasks, workers * 2)
+                for (file_path, entry, _), (action, payload, error, timing) in results:
+                    if cancel is not None and cancel.is_set():
+                        raise LeaseLostError(f"Lost the claim on backup job {job.id}")
+                    rel_path = os.path.relpath(file_path, folder.path)
+                    if action == 'error':
+                        logger.error(f"Error backing up file {file_path}: {error}")
+                    elif action == 'adopt':
+                        writer.adopt_source_stat(entry, payload, index, rel_path)
+                    elif action == 'backup':
+                        writer.add_backup(folder, file_path, payload, index)
+                    stats.add_file(timing, payload if action == 'backup' else None)
+                    writer.mark_done(folder.id, rel_path)
+                    writer.maybe_flush()
+                
+                writer.flush()
         
-       
         duration = time.time() - start_time
         
         
         log = BackupLog(
-            message=f"Backup completed: {backed_up_files} files backed up out of {total_files} total files in {duration:.2f} seconds",
+            message=f"Backup completed: {stats.files_changed} files backed up out of {stats.files_scanned} total files in {duration:.2f} seconds",
             level="info",
             job_id=job.id
         )
         db.session.add(log)
         
        
+        # The claim is checked first: the status change below is flushed before
+        # any later statement, and would make the job look no longer running
+        guard()
         job.status = "completed"
+        job.finished_at = datetime.utcnow()
+        job.checkpoint_folder_id = job.checkpoint_path = job.checkpoint_at = None
+        # Every folder the job covered, including any done before it was resumed
+        covered = update(MonitoredFolder).where(MonitoredFolder.user_id == job.user_id, MonitoredFolder.is_active == True)
+        if job.folder_id is not None:
+            covered = covered.where(MonitoredFolder.id == job.folder_id)
+        db.session.execute(covered.values(last_backup_at=job.finished_at))
+        stats.db_seconds += writer.flush_seconds
+        stats.save(job)
         db.session.commit()
+        metrics.record_job(job.status, stats)
         
         logger.info(f"Backup job {job.id} completed successfully")
         return True
         
+    except LeaseLostError as e:
+        # The job is someone else's now: leave its row, and its checkpoint, to them
+        db.session.rollback()
+        logger.warning(f"Stopping backup job {job.id}: {e}")
+        return False
+        
     except Exception as e:
         logger.exception(f"Error running backup job {job.id}: {e}")
+        db.session.rollback()
         
         log = BackupLog(
             message=f"Backup failed: {str(e)}",
             level="error",
             job_id=job.id
         )
+        try:
+            guard()
+        except LeaseLostError as lost:
+            logger.warning(f"Not recording the failure of backup job {job.id}: {lost}")
+            return False
         db.session.add(log)
         
         job.status = "failed"
+        job.finished_at = datetime.utcnow()
+        if writer is not None:
+            stats.db_seconds += writer.flush_seconds
+        stats.save(job)
         db.session.commit()
+        metrics.record_job(job.status, stats)
         
         return False
\ No newline at end of file
@@ -0,0 +1,296 @@
+"""Benchmark the scan/hash/copy/commit pipeline.
+
+Generates a synthetic tree, backs it up into a throwaway SQLite database
+and storage directory, changes part of the tree and backs it up again.
+Every phase is reported as JSON with files/sec, MB/sec and SQL statements
+per file, so results can be collected and compared over time:
+
+    python benchmark.py --files 5000 --depth 3 --change-rate 0.05 --output bench.json
+
+The tree is generated from --seed, so runs with the same arguments do
+exactly the same work.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+SIZE_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+LOGNORMAL_SIGMA = 1.5
+
+
+class TreeSpec:
+    """Shape of the synthetic tree"""
+
+    def __init__(self, files, depth, fanout, size_dist, mean_size, max_size, duplicate_rate, seed):
+        self.files = files
+        self.depth = depth
+        self.fanout = fanout
+        self.size_dist = size_dist
+        self.mean_size = mean_size
+        self.max_size = max_size
+        self.duplicate_rate = duplicate_rate
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def sample_size(rng, spec):
+    if spec.size_dist == "fixed":
+        size = spec.mean_size
+    elif spec.size_dist == "uniform":
+        size = rng.randint(0, 2 * spec.mean_size)
+    else:
+        # Parameterised so the distribution's mean is mean_size
+        mu = math.log(max(spec.mean_size, 1)) - LOGNORMAL_SIGMA ** 2 / 2
+        size = int(rng.lognormvariate(mu, LOGNORMAL_SIGMA))
+    return min(size, spec.max_size)
+
+
+def random_directory(rng, root, spec):
+    parts = [f"d{rng.randrange(spec.fanout)}" for _ in range(rng.randint(0, spec.depth))]
+    return os.path.join(root, *parts)
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def file_content(rng, spec, written):
+    """New random content, or a copy of an earlier file at duplicate_rate"""
+    if written and rng.random() < spec.duplicate_rate:
+        with open(rng.choice(written), "rb") as f:
+            return f.read()
+    return rng.randbytes(sample_size(rng, spec))
+
+
+def generate_tree(root, spec, rng):
+    """Create spec.files files under root and return their paths"""
+    paths = []
+    for i in range(spec.files):
+        path = os.path.join(random_directory(rng, root, spec), f"f{i}.bin")
+        write_file(path, file_content(rng, spec, paths))
+        paths.append(path)
+    return paths
+
+
+def mutate_tree(root, paths, spec, rng, change_rate, add_rate):
+    """Rewrite change_rate of the files and add add_rate new ones; return the touched paths"""
+    changed = rng.sample(paths, int(len(paths) * change_rate))
+    for path in changed:
+        write_file(path, rng.randbytes(sample_size(rng, spec)))
+    added = []
+    for _ in range(int(len(paths) * add_rate)):
+        path = os.path.join(random_directory(rng, root, spec), f"f{len(paths) + len(added)}.bin")
+        write_file(path, file_content(rng, spec, paths))
+        added.append(path)
+    paths.extend(added)
+    return sorted(changed + added)
+
+
+def total_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+class StatementCounter:
+    """Counts SQL statements sent to the database"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+class Phase:
+    """Times one phase of the benchmark and records its result"""
+
+    def __init__(self, name, counter, results):
+        self.name = name
+        self.counter = counter
+        self.results = results
+        self.files = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        self._statements = self.counter.count
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            return False
+        seconds = time.perf_counter() - self._start
+        statements = self.counter.count - self._statements
+        self.results.append({
+            "phase": self.name,
+            "files": self.files,
+            "bytes": self.bytes,
+            "seconds": round(seconds, 6),
+            "files_per_sec": round(self.files / seconds, 2) if seconds else None,
+            "mb_per_sec": round(self.bytes / seconds / (1024 * 1024), 2) if seconds and self.bytes else None,
+            "sql_statements": statements,
+            "sql_per_file": round(statements / self.files, 3) if self.files else None,
+        })
+        return False
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(spec, change_rate, add_rate, single_files, workdir):
+    """Run every phase in workdir and return the report"""
+    # The app reads its database URL and storage paths when it is imported
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "benchmark.db")
+    os.chdir(workdir)
+    from app import app, db
+    from models import User, MonitoredFolder
+    from backup_utils import (scan_folder, should_backup_file, backup_file, create_backup_job, run_backup_job,
+                              get_storage_settings)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rng = random.Random(spec.seed)
+    source = os.path.join(workdir, "source")
+    results = []
+
+    with app.app_context():
+        db.create_all()
+        counter = StatementCounter(db.engine)
+        user = User(username="benchmark", email="benchmark@example.com")
+        user.set_password("benchmark")
+        db.session.add(user)
+        db.session.commit()
+        folder = MonitoredFolder(name="benchmark", path=source, user_id=user.id)
+        db.session.add(folder)
+        db.session.commit()
+        folder_id, user_id = folder.id, user.id
+
+        generate_start = time.perf_counter()
+        paths = generate_tree(source, spec, rng)
+        tree_bytes = total_size(paths)
+        generate_seconds = time.perf_counter() - generate_start
+
+        with Phase("scan_folder", counter, results) as phase:
+            phase.files = len(scan_folder(folder_id))
+
+        with Phase("full_job", counter, results) as phase:
+            run_backup_job(create_backup_job(user_id, "Benchmark full").id)
+            phase.files, phase.bytes = len(paths), tree_bytes
+
+        with Phase("should_backup_file", counter, results) as phase:
+            for path in paths:
+                should_backup_file(folder_id, path)
+            phase.files = len(paths)
+
+        with Phase("unchanged_job", counter, results) as phase:
+            run_backup_job(create_backup_job(user_id, "Benchmark unchanged").id)
+            phase.files = len(paths)
+
+        changed = mutate_tree(source, paths, spec, rng, change_rate, add_rate)
+        with Phase("incremental_job", counter, results) as phase:
+            run_backup_job(create_backup_job(user_id, "Benchmark incremental").id)
+            phase.files, phase.bytes = len(paths), total_size(changed)
+
+        changed = mutate_tree(source, paths, spec, rng, change_rate, add_rate)
+        with Phase("changed_paths_job", counter, results) as phase:
+            job = create_backup_job(user_id, "Benchmark changed paths", folder_id=folder_id)
+            run_backup_job(job.id, changed_paths=changed)
+            phase.files, phase.bytes = len(changed), total_size(changed)
+
+        sample = rng.sample(paths, min(single_files, len(paths)))
+        with Phase("backup_file", counter, results) as phase:
+            for path in sample:
+                backup_file(path, folder_id)
+            phase.files, phase.bytes = len(sample), total_size(sample)
+
+        settings = get_storage_settings()
+        config = {
+            "hash_algorithm": settings["hash_algorithm"],
+            "compression": settings["compression"],
+            "chunked_storage": settings["chunked_enabled"],
+            "backup_workers": app.config.get("BACKUP_WORKERS"),
+            "commit_batch_size": app.config.get("BACKUP_COMMIT_BATCH_SIZE"),
+            "blob_fsync": settings["durable"],
+        }
+
+    return {
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "revision": git_revision(),
+        "host": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": config,
+        "tree": {**spec.as_dict(), "bytes": tree_bytes, "generate_seconds": round(generate_seconds, 3),
+                 "change_rate": change_rate, "add_rate": add_rate},
+        "phases": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark backup jobs against a synthetic tree")
+    parser.add_argument("--files", type=int, default=2000, help="files in the generated tree")
+    parser.add_argument("--depth", type=int, default=3, help="maximum directory depth")
+    parser.add_argument("--fanout", type=int, default=8, help="subdirectories per directory")
+    parser.add_argument("--size-dist", choices=SIZE_DISTRIBUTIONS, default="lognormal",
+                        help="distribution of file sizes")
+    parser.add_argument("--mean-size", type=int, default=32 * 1024, help="mean file size in bytes")
+    parser.add_argument("--max-size", type=int, default=16 * 1024 * 1024, help="largest file size in bytes")
+    parser.add_argument("--duplicate-rate", type=float, default=0.1,
+                        help="fraction of files that copy an earlier file's content")
+    parser.add_argument("--change-rate", type=float, default=0.05,
+                        help="fraction of files rewritten before each incremental run")
+    parser.add_argument("--add-rate", type=float, default=0.01,
+                        help="fraction of new files added before each incremental run")
+    parser.add_argument("--single-files", type=int, default=100, help="files to back up one at a time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="directory for the tree, database and storage (default: a temp dir)")
+    parser.add_argument("--keep", action="store_true", help="don't delete the temp directory afterwards")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    spec = TreeSpec(args.files, args.depth, args.fanout, args.size_dist, args.mean_size, args.max_size,
+                    args.duplicate_rate, args.seed)
+    if args.workdir:
+        workdir = os.path.abspath(args.workdir)
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        workdir = tempfile.mkdtemp(prefix="backup-benchmark-")
+    output = os.path.abspath(args.output) if args.output else None
+    try:
+        report = run(spec, args.change_rate, args.add_rate, args.single_files, workdir)
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
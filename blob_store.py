@@ -0,0 +1,771 @@
+import os
+import io
+import sys
+import uuid
+import errno
+import time
+import shutil
+import logging
+import argparse
+from collections import Counter, namedtuple
+from flask import current_app
+from sqlalchemy import bindparam, func, insert, select, update
+from app import db
+from models import Blob, BackupJob
+from compression import FILE_SUFFIXES, compressor, compress_bytes, open_decompressed, worth_keeping
+from hashing import AUTO, DEFAULT_ALGORITHM, format_checksum, get_algorithm, new_hasher, resolve_algorithm
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Blobs live under UPLOAD_FOLDER/blobs/<algorithm>/<aa>/<bb>/<hexdigest>[.zst|.gz]
+BLOB_DIR = "blobs"
+BLOB_TEMP_DIR = os.path.join(BLOB_DIR, "tmp")
+# Records which algorithm a store addresses its content with
+ALGORITHM_FILE = "ALGORITHM"
+DIGEST_ALGORITHM = DEFAULT_ALGORITHM
+READ_CHUNK_SIZE = 1024 * 1024
+KERNEL_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+IN_CLAUSE_BATCH_SIZE = 500
+DEFAULT_COMPRESSION_LEVEL = 3
+
+# errno values meaning "this kernel/filesystem can't do that copy", not a real I/O error
+_KERNEL_COPY_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+# Linux ioctl making a file share another's extents copy-on-write (btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+
+
+class SourceChangedError(OSError):
+    """The source file was modified while it was being copied"""
+
+
+# Content that is on disk at its address but not yet recorded in the database.
+# size is the length of the content, stored_size what it takes on disk.
+StagedBlob = namedtuple("StagedBlob", ["digest", "filename", "size", "written", "compression", "stored_size"])
+
+
+def format_digest(algorithm, hexdigest):
+    """Return the tagged digest string used as a blob's content address"""
+    return format_checksum(algorithm, hexdigest)
+
+
+def blob_relpath(digest, compression=None):
+    """Return the path of a blob relative to the storage root"""
+    algorithm, hexdigest = digest.split(":", 1)
+    return os.path.join(BLOB_DIR, algorithm, hexdigest[:2], hexdigest[2:4], hexdigest + FILE_SUFFIXES.get(compression, ""))
+
+
+def _stored_variant(storage_root, digest):
+    """Return (relpath, compression, stored_size) of the copy of digest already on disk, if any"""
+    for compression in (None, *FILE_SUFFIXES):
+        relpath = blob_relpath(digest, compression)
+        try:
+            return relpath, compression, os.path.getsize(os.path.join(storage_root, relpath))
+        except FileNotFoundError:
+            continue
+    return None
+
+
+_store_algorithms = {}
+
+
+def storage_algorithm(storage_root, configured=AUTO):
+    """Return the algorithm content in a store is addressed with.
+
+    An explicitly configured algorithm is used as is. With "auto" the choice
+    is made once per store and recorded in blobs/ALGORITHM, so every process
+    sharing the storage, across restarts, keeps deduplicating against the
+    same addresses. A store that already holds blobs keeps their algorithm;
+    a new one gets the fastest strong hash on this host.
+    """
+    if configured and configured != AUTO:
+        return resolve_algorithm(configured)
+    key = os.path.abspath(storage_root)
+    if key not in _store_algorithms:
+        path = os.path.join(storage_root, BLOB_DIR, ALGORITHM_FILE)
+        try:
+            with open(path) as f:
+                algorithm = f.read().strip()
+        except FileNotFoundError:
+            algorithm = _record_algorithm(storage_root, _existing_algorithm(storage_root) or resolve_algorithm(AUTO))
+        get_algorithm(algorithm)
+        _store_algorithms[key] = algorithm
+    return _store_algorithms[key]
+
+
+def _existing_algorithm(storage_root):
+    """The algorithm blobs in a store were written with before the choice was recorded"""
+    try:
+        names = os.listdir(os.path.join(storage_root, BLOB_DIR))
+    except FileNotFoundError:
+        return None
+    if DIGEST_ALGORITHM in names:
+        return DIGEST_ALGORITHM
+    for name in sorted(names):
+        try:
+            if get_algorithm(name).strong:
+                return name
+        except ValueError:
+            continue
+    return None
+
+
+def _record_algorithm(storage_root, algorithm):
+    """Write blobs/ALGORITHM unless another process got there first; return the recorded choice"""
+    path = os.path.join(storage_root, BLOB_DIR, ALGORITHM_FILE)
+    temp_path = _temp_path(storage_root)
+    with open(temp_path, "w") as f:
+        f.write(algorithm + "\n")
+    try:
+        os.link(temp_path, path)
+        logger.info(f"Addressing content in {storage_root} with {algorithm}")
+    except FileExistsError:
+        with open(path) as f:
+            algorithm = f.read().strip()
+    finally:
+        os.remove(temp_path)
+    return algorithm
+
+
+def _temp_path(storage_root):
+    temp_dir = os.path.join(storage_root, BLOB_TEMP_DIR)
+    os.makedirs(temp_dir, exist_ok=True)
+    return os.path.join(temp_dir, uuid.uuid4().hex)
+
+
+def _fsync_path(path, directory=False):
+    fd = os.open(path, os.O_RDONLY | (getattr(os, "O_DIRECTORY", 0) if directory else 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _publish(temp_path, storage_root, relpath, durable=False):
+    """Move a fully written temp file to its content address.
+
+    Returns False (and drops the temp file) when the content is already
+    on disk. Safe to call from several threads for the same digest. With
+    durable the data and the rename are flushed to disk first, so a
+    database row committed afterwards can never point at a lost blob.
+    """
+    final_path = os.path.join(storage_root, relpath)
+    if os.path.exists(final_path):
+        os.remove(temp_path)
+        return False
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    if durable:
+        _fsync_path(temp_path)
+    os.replace(temp_path, final_path)
+    if durable:
+        _fsync_path(os.path.dirname(final_path), directory=True)
+    return True
+
+
+def _kernel_copy(src_fd, dst_fd):
+    """Copy without passing data through userspace.
+
+    Returns the number of bytes copied, or None if neither copy_file_range
+    nor sendfile can be used for this pair of files.
+    """
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range:
+        copied = 0
+        try:
+            while True:
+                n = copy_file_range(src_fd, dst_fd, KERNEL_COPY_CHUNK_SIZE)
+                if not n:
+                    return copied
+                copied += n
+        except OSError as e:
+            if copied or e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                raise
+
+    sendfile = getattr(os, "sendfile", None)
+    if sendfile:
+        copied = 0
+        try:
+            while True:
+                n = sendfile(dst_fd, src_fd, copied, KERNEL_COPY_CHUNK_SIZE)
+                if not n:
+                    return copied
+                copied += n
+        except OSError as e:
+            if copied or e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                raise
+
+    return None
+
+
+def clone_file(src_path, dst_path):
+    """Make dst_path a copy-on-write clone of src_path, which takes no time or space.
+
+    Returns False, leaving no dst_path behind, if the platform or the
+    filesystem can't clone (or the files are on different filesystems).
+    """
+    if fcntl is None:
+        return False
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in _KERNEL_COPY_UNSUPPORTED | {errno.ENOTTY}:
+                raise
+    os.remove(dst_path)
+    return False
+
+
+def copy_file(src_path, dst_path, buffer_size=READ_CHUNK_SIZE, kernel_copy=True):
+    """Copy a file's content, in the kernel where possible. Returns the bytes copied."""
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        copied = _kernel_copy(src.fileno(), dst.fileno()) if kernel_copy else None
+        if copied is None:
+            shutil.copyfileobj(src, dst, buffer_size)
+            copied = dst.tell()
+    return copied
+
+
+def _hash_into(f, hashers, buffer_size):
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            return
+        for hasher in hashers:
+            hasher.update(view[:n])
+
+
+def copy_hashed(src_path, dst_path, hashers, buffer_size=READ_CHUNK_SIZE, kernel_copy=True):
+    """Copy a file while feeding every hasher, reading the source only once.
+
+    With kernel_copy the data is moved by copy_file_range/sendfile and the
+    digests are taken from the destination afterwards (normally still in the
+    page cache), so they always describe exactly what was stored. Otherwise
+    each buffer is hashed and written in one pass. Raises SourceChangedError
+    if the source was modified during the copy. Returns the bytes copied.
+    """
+    with open(src_path, "rb") as src, open(dst_path, "w+b") as dst:
+        before = os.fstat(src.fileno())
+
+        copied = _kernel_copy(src.fileno(), dst.fileno()) if kernel_copy else None
+        if copied is not None:
+            dst.seek(0)
+            _hash_into(dst, hashers, buffer_size)
+        else:
+            copied = 0
+            buf = bytearray(buffer_size)
+            view = memoryview(buf)
+            while True:
+                n = src.readinto(buf)
+                if not n:
+                    break
+                chunk = view[:n]
+                for hasher in hashers:
+                    hasher.update(chunk)
+                dst.write(chunk)
+                copied += n
+
+        after = os.fstat(src.fileno())
+
+    _check_source(src_path, before, after, copied)
+    return copied
+
+
+def _check_source(src_path, before, after, copied):
+    if (copied != after.st_size or before.st_size != after.st_size
+            or before.st_mtime_ns != after.st_mtime_ns):
+        raise SourceChangedError(f"{src_path} changed while it was being copied")
+
+
+def _compress_into(src, dst, hashers, compression, level, buffer_size):
+    """Compress a stream into dst while hashing the uncompressed bytes; returns (size, stored_size)"""
+    packer = compressor(compression, level)
+    size = stored_size = 0
+    for chunk in iter(lambda: src.read(buffer_size), b""):
+        for hasher in hashers:
+            hasher.update(chunk)
+        packed = packer.compress(chunk)
+        dst.write(packed)
+        size += len(chunk)
+        stored_size += len(packed)
+    packed = packer.flush()
+    dst.write(packed)
+    return size, stored_size + len(packed)
+
+
+def copy_compressed(src_path, dst_path, hashers, compression, level=DEFAULT_COMPRESSION_LEVEL,
+                    buffer_size=READ_CHUNK_SIZE):
+    """Like copy_hashed, but writes the copy compressed. Returns (bytes read, bytes written)."""
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        before = os.fstat(src.fileno())
+        size, stored_size = _compress_into(src, dst, hashers, compression, level, buffer_size)
+        after = os.fstat(src.fileno())
+
+    _check_source(src_path, before, after, size)
+    return size, stored_size
+
+
+def _decompress_temp(temp_path, compression, storage_root, buffer_size):
+    """Replace a compressed temp file with an uncompressed one and return its path"""
+    raw_path = _temp_path(storage_root)
+    try:
+        with open_decompressed(temp_path, compression) as src, open(raw_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, buffer_size)
+    except Exception:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+        raise
+    os.remove(temp_path)
+    return raw_path
+
+
+def _stage_temp(temp_path, storage_root, algorithm, hasher, size, compression, stored_size, buffer_size,
+                durable, verify=None):
+    digest = format_digest(algorithm, hasher.hexdigest())
+    if verify is not None:
+        verify(digest)
+    existing = _stored_variant(storage_root, digest)
+    if existing:
+        os.remove(temp_path)
+        return StagedBlob(digest, existing[0], size, False, existing[1], existing[2])
+
+    if compression and not worth_keeping(size, stored_size):
+        temp_path = _decompress_temp(temp_path, compression, storage_root, buffer_size)
+        compression, stored_size = None, size
+
+    relpath = blob_relpath(digest, compression)
+    written = _publish(temp_path, storage_root, relpath, durable)
+    return StagedBlob(digest, relpath, size, written, compression, stored_size)
+
+
+def stage_file(file_path, storage_root, extra_hashers=(), buffer_size=READ_CHUNK_SIZE, kernel_copy=True,
+               durable=False, compression=None, level=DEFAULT_COMPRESSION_LEVEL, algorithm=DIGEST_ALGORITHM):
+    """Put a file's content on disk at its content address without touching the database.
+
+    The file is read once: it is copied (or compressed, when compression
+    names a codec) into a temp file while being hashed, and the copy is
+    dropped if identical content is already stored. Content that doesn't
+    compress well is stored uncompressed. extra_hashers are fed the same
+    bytes. Safe to run in worker threads.
+    """
+    hasher = new_hasher(algorithm)
+    hashers = [hasher, *extra_hashers]
+    temp_path = _temp_path(storage_root)
+    try:
+        if compression:
+            size, stored_size = copy_compressed(file_path, temp_path, hashers, compression, level, buffer_size)
+        else:
+            size = stored_size = copy_hashed(file_path, temp_path, hashers, buffer_size, kernel_copy)
+        return _stage_temp(temp_path, storage_root, algorithm, hasher, size, compression, stored_size,
+                           buffer_size, durable)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def stage_stream(stream, storage_root, extra_hashers=(), buffer_size=READ_CHUNK_SIZE, durable=False,
+                 compression=None, level=DEFAULT_COMPRESSION_LEVEL, algorithm=DIGEST_ALGORITHM, verify=None):
+    """Put the contents of a readable stream on disk at its content address.
+
+    verify, if given, is called with the content's digest once the whole
+    stream has been hashed and before anything is stored; if it raises,
+    the received data is dropped.
+    """
+    hasher = new_hasher(algorithm)
+    hashers = [hasher, *extra_hashers]
+    temp_path = _temp_path(storage_root)
+    try:
+        with open(temp_path, "wb") as out:
+            if compression:
+                size, stored_size = _compress_into(stream, out, hashers, compression, level, buffer_size)
+            else:
+                size = 0
+                for chunk in iter(lambda: stream.read(buffer_size), b""):
+                    for h in hashers:
+                        h.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+                stored_size = size
+        return _stage_temp(temp_path, storage_root, algorithm, hasher, size, compression, stored_size,
+                           buffer_size, durable, verify)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def stage_received(path, storage_root, hasher=None, extra_hashers=(), buffer_size=READ_CHUNK_SIZE, durable=False,
+                   compression=None, level=DEFAULT_COMPRESSION_LEVEL, algorithm=DIGEST_ALGORITHM, verify=None):
+    """Store a file written under storage_root (e.g. an assembled upload) at its content address.
+
+    The file is consumed. If hasher is given it (and extra_hashers) have
+    already been fed the whole content as it was received; uncompressed
+    content is then renamed into place without being read again. Otherwise
+    the file is read once, to hash it and, with compression, to compress it.
+    verify, if given, is called with the content's digest once it is hashed
+    and before anything is stored; if it raises, the file is left where it was.
+    """
+    fed = hasher is not None
+    if not fed:
+        hasher = new_hasher(algorithm)
+    hashers = [] if fed else [hasher, *extra_hashers]
+    if fed and verify is not None:
+        verify(format_digest(algorithm, hasher.hexdigest()))
+        verify = None
+
+    if compression:
+        if fed:
+            # Already stored: no need to compress it to find out
+            digest = format_digest(algorithm, hasher.hexdigest())
+            existing = _stored_variant(storage_root, digest)
+            if existing:
+                size = os.path.getsize(path)
+                os.remove(path)
+                return StagedBlob(digest, existing[0], size, False, existing[1], existing[2])
+        temp_path = _temp_path(storage_root)
+        try:
+            with open(path, "rb") as src, open(temp_path, "wb") as dst:
+                size, stored_size = _compress_into(src, dst, hashers, compression, level, buffer_size)
+            if verify is not None:
+                verify(format_digest(algorithm, hasher.hexdigest()))
+            os.remove(path)
+            return _stage_temp(temp_path, storage_root, algorithm, hasher, size, compression, stored_size,
+                               buffer_size, durable)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    if hashers:
+        with open(path, "rb") as f:
+            _hash_into(f, hashers, buffer_size)
+    size = os.path.getsize(path)
+    return _stage_temp(path, storage_root, algorithm, hasher, size, None, size, buffer_size, durable, verify)
+
+
+def stage_bytes(data, storage_root, durable=False, compression=None, level=DEFAULT_COMPRESSION_LEVEL,
+                algorithm=DIGEST_ALGORITHM):
+    """Put an in-memory buffer on disk at its content address"""
+    hasher = new_hasher(algorithm)
+    hasher.update(data)
+    digest = format_digest(algorithm, hasher.hexdigest())
+    existing = _stored_variant(storage_root, digest)
+    if existing:
+        return StagedBlob(digest, existing[0], len(data), False, existing[1], existing[2])
+
+    payload = data
+    if compression:
+        packed = compress_bytes(data, compression, level)
+        if worth_keeping(len(data), len(packed)):
+            payload = packed
+        else:
+            compression = None
+
+    relpath = blob_relpath(digest, compression)
+    temp_path = _temp_path(storage_root)
+    try:
+        with open(temp_path, "wb") as out:
+            out.write(payload)
+        written = _publish(temp_path, storage_root, relpath, durable)
+        return StagedBlob(digest, relpath, len(data), written, compression, len(payload))
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def commit_blob(staged):
+    """Return the Blob row for staged content with its reference count incremented.
+
+    The content is already on disk, so a row is never created for a blob
+    that does not exist. The caller is responsible for committing the session.
+    """
+    blob = Blob.query.filter_by(digest=staged.digest).first()
+    if blob:
+        blob.ref_count = (blob.ref_count or 0) + 1
+        return blob
+
+    blob = Blob(
+        digest=staged.digest,
+        filename=staged.filename,
+        size=staged.size,
+        compression=staged.compression,
+        stored_size=staged.stored_size,
+        ref_count=1
+    )
+    db.session.add(blob)
+    return blob
+
+
+def _insert_ignoring_duplicates(table):
+    """INSERT that skips rows whose unique key already exists (another job may have added them)"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        return pg_insert(table).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        return sqlite_insert(table).on_conflict_do_nothing()
+    return insert(table)
+
+
+def _digest_map(column, digests):
+    found = {}
+    for start in range(0, len(digests), IN_CLAUSE_BATCH_SIZE):
+        part = digests[start:start + IN_CLAUSE_BATCH_SIZE]
+        found.update(db.session.execute(select(Blob.digest, column).where(Blob.digest.in_(part))).all())
+    return found
+
+
+def _digest_ids(digests):
+    return _digest_map(Blob.id, digests)
+
+
+def _digest_filenames(digests):
+    return _digest_map(Blob.filename, digests)
+
+
+def commit_blobs(staged_blobs):
+    """Bulk version of commit_blob for a batch of staged content.
+
+    Adds one reference per entry in staged_blobs (duplicates count twice)
+    using a fixed number of statements, and returns {digest: blob_id}.
+    The caller is responsible for committing the session.
+    """
+    if not staged_blobs:
+        return {}
+
+    counts = Counter(staged.digest for staged in staged_blobs)
+    by_digest = {staged.digest: staged for staged in staged_blobs}
+    digests = list(counts)
+
+    ids = _digest_ids(digests)
+    missing = [digest for digest in digests if digest not in ids]
+    if missing:
+        db.session.execute(_insert_ignoring_duplicates(Blob.__table__), [
+            {
+                "digest": digest,
+                "filename": by_digest[digest].filename,
+                "size": by_digest[digest].size,
+                "compression": by_digest[digest].compression,
+                "stored_size": by_digest[digest].stored_size,
+                "ref_count": 0,
+            }
+            for digest in missing
+        ])
+        ids.update(_digest_ids(missing))
+
+    table = Blob.__table__
+    db.session.execute(
+        update(table)
+        .where(table.c.id == bindparam("blob_id"))
+        .values(ref_count=table.c.ref_count + bindparam("increment")),
+        [{"blob_id": ids[digest], "increment": count} for digest, count in counts.items()]
+    )
+    return ids
+
+
+def ingest_stream(stream, storage_root, extra_hashers=(), compression=None, level=DEFAULT_COMPRESSION_LEVEL,
+                  algorithm=DIGEST_ALGORITHM):
+    """Store the contents of a readable stream and return its referenced Blob"""
+    return commit_blob(stage_stream(stream, storage_root, extra_hashers, compression=compression, level=level,
+                                    algorithm=algorithm))
+
+
+def _sweep_orphans(storage_root, grace_seconds):
+    """Remove leftovers of interrupted writes: temp files, and blobs whose row was never committed"""
+    removed = 0
+    cutoff = time.time() - grace_seconds
+
+    temp_dir = os.path.join(storage_root, BLOB_TEMP_DIR)
+    if os.path.isdir(temp_dir):
+        for name in os.listdir(temp_dir):
+            path = os.path.join(temp_dir, name)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+
+    candidates = {}
+    for root, dirs, files in os.walk(os.path.join(storage_root, BLOB_DIR)):
+        if os.path.abspath(root) == os.path.abspath(temp_dir):
+            dirs[:] = []
+            continue
+        # Blobs are only ever three levels down (<algorithm>/<aa>/<bb>); this
+        # skips ALGORITHM at the top
+        if os.path.relpath(root, os.path.join(storage_root, BLOB_DIR)).count(os.sep) != 2:
+            continue
+        algorithm = os.path.basename(os.path.dirname(os.path.dirname(root)))
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.getmtime(path) < cutoff:
+                candidates[path] = format_digest(algorithm, name.split(".", 1)[0])
+
+    # A blob is an orphan if it has no row, or if the row refers to another
+    # encoding of the same content
+    known = _digest_filenames(list(set(candidates.values())))
+    for path, digest in candidates.items():
+        if known.get(digest) != os.path.relpath(path, storage_root):
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def collect_garbage(storage_root, grace_seconds=3600):
+    """Delete blobs that are no longer referenced by any version.
+
+    Files older than grace_seconds that have no Blob row (left behind by a
+    crash between writing a blob and committing its row) are removed too.
+    Must not run while backup jobs are writing to the same storage.
+    """
+    removed = 0
+    for blob in Blob.query.filter(Blob.ref_count <= 0).all():
+        path = os.path.join(storage_root, blob.filename)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            logger.error(f"Error removing blob {blob.digest}: {e}")
+            continue
+        db.session.delete(blob)
+        removed += 1
+
+    db.session.commit()
+    removed += _sweep_orphans(storage_root, grace_seconds)
+    logger.info(f"Removed {removed} unreferenced blobs")
+    return removed
+
+
+class ChunkedReader(io.RawIOBase):
+    """Seekable read-only stream over the chunks of a chunked version"""
+
+    def __init__(self, chunks, storage_root):
+        # chunks: ordered (offset, size, relative path, compression) tuples
+        self._chunks = list(chunks)
+        self._root = storage_root
+        self._pos = 0
+        self._index = 0
+        self._file = None
+        self.size = sum(chunk[1] for chunk in self._chunks)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = max(offset, 0)
+        self._close_chunk()
+        self._index = 0
+        return self._pos
+
+    def _close_chunk(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def readinto(self, b):
+        while self._index < len(self._chunks):
+            offset, size, relpath, compression = self._chunks[self._index]
+            if self._pos >= offset + size:
+                self._close_chunk()
+                self._index += 1
+                continue
+            if self._file is None:
+                self._file = open_blob(os.path.join(self._root, relpath), compression)
+                if compression:
+                    # Compressed chunks can't seek; skip forward by reading
+                    skip = self._pos - offset
+                    while skip:
+                        skipped = len(self._file.read(min(skip, READ_CHUNK_SIZE)))
+                        if not skipped:
+                            break
+                        skip -= skipped
+                else:
+                    self._file.seek(self._pos - offset)
+            n = self._file.readinto(memoryview(b)[:offset + size - self._pos])
+            if not n:
+                raise IOError(f"Chunk {relpath} is shorter than recorded")
+            self._pos += n
+            return n
+        return 0
+
+    def close(self):
+        self._close_chunk()
+        super().close()
+
+
+def open_blob(path, compression=None):
+    """Open stored content for reading, decompressing on the fly if needed"""
+    if compression:
+        return open_decompressed(path, compression)
+    return open(path, "rb")
+
+
+def storage_usage():
+    """(number of blobs, bytes they take on disk)"""
+    count, stored = db.session.query(
+        func.count(Blob.id), func.coalesce(func.sum(func.coalesce(Blob.stored_size, Blob.size)), 0)
+    ).one()
+    return count, stored
+
+
+def version_exists(version):
+    """Check that every piece of a version's content is present on disk"""
+    if version.is_chunked:
+        return all(os.path.exists(chunk.blob.get_path()) for chunk in version.chunks)
+    return os.path.exists(version.get_path())
+
+
+def get_version_source(version):
+    """Return something send_file can stream.
+
+    That is a path for uncompressed blobs, and a reader that decompresses
+    as it goes for compressed blobs and chunked versions.
+    """
+    if version.is_chunked:
+        chunks = [(chunk.offset, chunk.size, chunk.blob.filename, chunk.blob.compression) for chunk in version.chunks]
+        return ChunkedReader(chunks, current_app.config['UPLOAD_FOLDER'])
+    if version.blob is not None and version.blob.compression:
+        return open_blob(version.get_path(), version.blob.compression)
+    return version.get_path()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the blob store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    gc = commands.add_parser("gc", help="delete unreferenced blobs and leftovers of interrupted writes")
+    gc.add_argument("--grace-seconds", type=int, default=3600,
+                    help="leave files younger than this alone (default: 3600)")
+    gc.add_argument("--force", action="store_true", help="run even if backup jobs are running")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    from app import app
+    with app.app_context():
+        running = BackupJob.query.filter_by(status='running').count()
+        if running and not args.force:
+            # Their staged blobs have no rows yet
+            print(f"{running} backup jobs are running; try again later or pass --force", file=sys.stderr)
+            sys.exit(1)
+        collect_garbage(app.config['UPLOAD_FOLDER'], args.grace_seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import hashlib
+import logging
+from hashing import new_hasher
+from blob_store import DIGEST_ALGORITHM, DEFAULT_COMPRESSION_LEVEL, format_digest, stage_bytes
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_CHUNK_SIZE = 256 * 1024
+DEFAULT_AVG_CHUNK_SIZE = 1024 * 1024
+DEFAULT_MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+_MASK_64 = (1 << 64) - 1
+
+# Gear table for the rolling hash. Derived from sha256 so it is identical on
+# every host and Python version; changing it would change every chunk boundary.
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "big") for i in range(256)]
+
+
+def _boundary_mask(bits):
+    """Mask selecting the top `bits` bits of the 64-bit gear hash.
+
+    The low bits of a gear hash only depend on the last few bytes, so the
+    boundary test has to look at the high bits.
+    """
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def _cut_point(buf, min_size, avg_size, max_size):
+    """Return the length of the next chunk at the start of buf (FastCDC-style)"""
+    n = len(buf)
+    if n <= min_size:
+        return n
+    if n > max_size:
+        n = max_size
+
+    bits = avg_size.bit_length() - 1
+    mask_strict = _boundary_mask(bits + 2)
+    mask_loose = _boundary_mask(bits - 2)
+    normal = min(avg_size, n)
+    gear = _GEAR
+    h = 0
+
+    # Boundaries are harder to hit before the average size and easier
+    # afterwards, which keeps chunk sizes close to avg_size.
+    i = min_size
+    while i < normal:
+        h = ((h << 1) + gear[buf[i]]) & _MASK_64
+        if not h & mask_strict:
+            return i + 1
+        i += 1
+    while i < n:
+        h = ((h << 1) + gear[buf[i]]) & _MASK_64
+        if not h & mask_loose:
+            return i + 1
+        i += 1
+    return n
+
+
+def iter_chunks(f, min_size=DEFAULT_MIN_CHUNK_SIZE, avg_size=DEFAULT_AVG_CHUNK_SIZE,
+                max_size=DEFAULT_MAX_CHUNK_SIZE):
+    """Split a binary stream into content-defined chunks.
+
+    Boundaries depend only on nearby content, so inserting or appending
+    data only changes the chunks around the edit.
+    """
+    buf = b""
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = f.read(max_size)
+            if not data:
+                eof = True
+            else:
+                buf += data
+        if not buf:
+            return
+        cut = _cut_point(buf, min_size, avg_size, max_size)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+
+def stage_chunked(file_path, storage_root, min_size=DEFAULT_MIN_CHUNK_SIZE,
+                  avg_size=DEFAULT_AVG_CHUNK_SIZE, max_size=DEFAULT_MAX_CHUNK_SIZE, extra_hashers=(),
+                  durable=False, compression=None, level=DEFAULT_COMPRESSION_LEVEL, algorithm=DIGEST_ALGORITHM):
+    """Put a file's chunks on disk without touching the database.
+
+    Returns (digest, size, staged) where staged is the ordered list of
+    (offset, StagedBlob) pairs. Only chunks that are not already in the
+    store are written, each compressed on its own when compression names a
+    codec. extra_hashers are fed the whole file in the same pass. Safe to
+    run in worker threads.
+    """
+    hashers = [new_hasher(algorithm), *extra_hashers]
+    staged = []
+    offset = 0
+    written = 0
+
+    with open(file_path, "rb") as f:
+        for data in iter_chunks(f, min_size, avg_size, max_size):
+            for hasher in hashers:
+                hasher.update(data)
+            chunk = stage_bytes(data, storage_root, durable, compression, level, algorithm)
+            if chunk.written:
+                written += chunk.size
+            staged.append((offset, chunk))
+            offset += chunk.size
+
+    digest = format_digest(algorithm, hashers[0].hexdigest())
+    logger.debug(f"Chunked {file_path} into {len(staged)} chunks, {written} of {offset} bytes new")
+    return digest, offset, staged
+
@@ -0,0 +1,118 @@
+import io
+import gzip
+import zlib
+import logging
+
+try:
+    import zstandard
+except ImportError:  # optional dependency; gzip from the standard library is used instead
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ZSTD = "zstd"
+GZIP = "gzip"
+
+# Compressed blobs get a suffix so that differently encoded copies of the same
+# content can never be mistaken for one another on disk
+FILE_SUFFIXES = {ZSTD: ".zst", GZIP: ".gz"}
+
+# Only keep the compressed copy if it saves at least 5%; otherwise the
+# decompression cost on every download isn't worth it
+MAX_COMPRESSED_RATIO = 0.95
+
+# Formats that are already compressed and won't shrink any further
+_COMPRESSED_MIME_PREFIXES = ("image/", "video/", "audio/")
+_COMPRESSED_MIME_TYPES = {
+    "application/pdf",
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/x-7z-compressed",
+    "application/x-rar-compressed",
+    "application/vnd.rar",
+    "application/zstd",
+    "application/java-archive",
+    "application/epub+zip",
+}
+# Exceptions to the prefixes above: uncompressed media formats
+_UNCOMPRESSED_MEDIA_TYPES = {"image/svg+xml", "image/bmp", "image/x-ms-bmp", "image/tiff", "audio/x-wav", "audio/wav"}
+
+
+def resolve_codec(name):
+    """Map a configured codec name to one that can be used here, or None for no compression"""
+    if not name or name.lower() == "none":
+        return None
+    name = name.lower()
+    if name == ZSTD and zstandard is None:
+        logger.warning("zstandard is not installed; compressing with gzip instead")
+        return GZIP
+    if name not in FILE_SUFFIXES:
+        raise ValueError(f"Unknown compression codec: {name}")
+    return name
+
+
+def should_compress(mime_type):
+    """Whether content of this MIME type is worth compressing"""
+    if mime_type in _UNCOMPRESSED_MEDIA_TYPES:
+        return True
+    if mime_type in _COMPRESSED_MIME_TYPES:
+        return False
+    return not mime_type.startswith(_COMPRESSED_MIME_PREFIXES)
+
+
+def worth_keeping(size, stored_size):
+    return stored_size <= size * MAX_COMPRESSED_RATIO
+
+
+def compressor(codec, level):
+    """Return a streaming compressor with compress(data) and flush() methods.
+
+    level uses the zstd scale (1-22); gzip levels are capped at 9.
+    """
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return zlib.compressobj(min(max(level, 1), 9), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def compress_bytes(data, codec, level):
+    c = compressor(codec, level)
+    return c.compress(data) + c.flush()
+
+
+class _DecompressingReader(io.RawIOBase):
+    """Readable stream of decompressed data.
+
+    Deliberately has no fileno(): WSGI servers would otherwise sendfile()
+    the compressed bytes straight from the underlying descriptor.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._stream.readinto(b)
+
+    def close(self):
+        self._stream.close()
+        super().close()
+
+
+def open_decompressed(path, codec):
+    """Open a compressed blob as a readable stream of its original content.
+
+    Data is decompressed as it is read, so nothing is written to disk and
+    memory use doesn't depend on the size of the file.
+    """
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is required to read {path}")
+        return _DecompressingReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+    if codec == GZIP:
+        return _DecompressingReader(gzip.open(path, "rb"))
+    raise ValueError(f"Unknown compression codec: {codec}")
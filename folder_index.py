@@ -0,0 +1,72 @@
+from collections import namedtuple
+from sqlalchemy import and_, func
+from app import db
+from models import File, FileVersion
+
+# Backup state of one source file: its File row (id and size) and latest
+# FileVersion. Version fields are None for a File that has no versions.
+IndexEntry = namedtuple("IndexEntry", [
+    "file_id", "file_size", "version_id", "version_number", "size", "checksum",
+    "source_size", "source_mtime_ns", "source_inode", "source_ctime_ns",
+])
+
+
+def _entry_query(folder_id):
+    """Query (source_path, *IndexEntry) rows for the live files of a folder"""
+    live_files = and_(File.source_folder_id == folder_id, File.is_deleted == False)
+
+    latest = (
+        db.session.query(FileVersion.file_id, func.max(FileVersion.version_number).label("version_number"))
+        .join(File, File.id == FileVersion.file_id)
+        .filter(live_files)
+        .group_by(FileVersion.file_id)
+        .subquery()
+    )
+
+    return (
+        db.session.query(
+            File.source_path, File.id, File.size, FileVersion.id, FileVersion.version_number,
+            FileVersion.size, FileVersion.checksum, FileVersion.source_size,
+            FileVersion.source_mtime_ns, FileVersion.source_inode, FileVersion.source_ctime_ns,
+        )
+        .outerjoin(latest, latest.c.file_id == File.id)
+        .outerjoin(FileVersion, and_(
+            FileVersion.file_id == File.id,
+            FileVersion.version_number == latest.c.version_number
+        ))
+        .filter(live_files)
+    )
+
+
+class FolderIndex:
+    """Backup state of every file in one monitored folder, keyed by source_path.
+
+    Loaded with a single query at the start of a job so scanning and backing
+    up a folder doesn't query the database per file. Entries are immutable,
+    so worker threads can read them while the job thread updates the index.
+    """
+
+    def __init__(self, folder_id, folder_path, entries):
+        self.folder_id = folder_id
+        self.folder_path = folder_path
+        self._entries = entries
+
+    @classmethod
+    def load(cls, folder):
+        entries = {row[0]: IndexEntry(*row[1:]) for row in _entry_query(folder.id)}
+        return cls(folder.id, folder.path, entries)
+
+    @staticmethod
+    def lookup(folder_id, source_path):
+        """Fetch a single entry without loading the whole folder"""
+        row = _entry_query(folder_id).filter(File.source_path == source_path).first()
+        return IndexEntry(*row[1:]) if row else None
+
+    def get(self, source_path):
+        return self._entries.get(source_path)
+
+    def set(self, source_path, entry):
+        self._entries[source_path] = entry
+
+    def __len__(self):
+        return len(self._entries)
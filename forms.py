@@ -73,6 +73,7 @@ class MonitoredFolderForm(FlaskForm):
 class ManualBackupForm(FlaskForm):
     folder_id = SelectField('Select Folder', coerce=int, validators=[DataRequired()])
     name = StringField('Backup Name', validators=[DataRequired(), Length(min=1, max=255)])
+    profile = BooleanField('Profile this job')
     submit = SubmitField('Start Backup')
 
 
@@ -0,0 +1,193 @@
+import os
+import sys
+import time
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from collections import namedtuple
+
+try:
+    import blake3
+except ImportError:  # optional dependency
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:  # optional dependency
+    xxhash = None
+
+logger = logging.getLogger(__name__)
+
+# Checksums recorded before algorithms were tagged are plain MD5 hex digests
+LEGACY_ALGORITHM = "md5"
+DEFAULT_ALGORITHM = "sha256"
+AUTO = "auto"
+
+BENCHMARK_SIZE = 4 * 1024 * 1024
+BENCHMARK_ROUNDS = 3
+
+# strong: collision resistant, so safe to use as a content address.
+# Weak algorithms can still verify integrity but never address blobs.
+HashAlgorithm = namedtuple("HashAlgorithm", ["name", "new", "strong"])
+
+_ALGORITHMS = {}
+
+
+def register_algorithm(name, factory, strong=True):
+    """Make a hash available by name. factory returns an object with update() and hexdigest()."""
+    _ALGORITHMS[name] = HashAlgorithm(name, factory, strong)
+
+
+register_algorithm("md5", hashlib.md5, strong=False)
+register_algorithm("sha256", hashlib.sha256)
+register_algorithm("sha512", hashlib.sha512)
+register_algorithm("blake2b", hashlib.blake2b)
+register_algorithm("blake2s", hashlib.blake2s)
+if blake3 is not None:
+    register_algorithm("blake3", blake3.blake3)
+if xxhash is not None:
+    register_algorithm("xxh3_128", xxhash.xxh3_128, strong=False)
+
+
+def available_algorithms(strong_only=False):
+    return sorted(name for name, alg in _ALGORITHMS.items() if alg.strong or not strong_only)
+
+
+def get_algorithm(name):
+    try:
+        return _ALGORITHMS[name]
+    except KeyError:
+        raise ValueError(f"Unknown hash algorithm: {name}") from None
+
+
+_meters = threading.local()
+
+
+class _TimedHasher:
+    """Hasher wrapper that adds the time spent in update() to a meter"""
+
+    def __init__(self, hasher, meter):
+        self._hasher = hasher
+        self._meter = meter
+
+    def update(self, data):
+        start = time.perf_counter()
+        self._hasher.update(data)
+        self._meter.seconds += time.perf_counter() - start
+
+    def hexdigest(self):
+        return self._hasher.hexdigest()
+
+
+class HashMeter:
+    def __init__(self):
+        self.seconds = 0.0
+
+
+@contextmanager
+def measure_hashing():
+    """Time the hashing done by the current thread inside the block.
+
+    Hashers created with new_hasher() while the block is active report to
+    the yielded meter; outside of it they are returned unwrapped, so there
+    is no cost when nothing is being measured.
+    """
+    meter = HashMeter()
+    previous = getattr(_meters, "meter", None)
+    _meters.meter = meter
+    try:
+        yield meter
+    finally:
+        _meters.meter = previous
+
+
+def new_hasher(name):
+    hasher = get_algorithm(name).new()
+    meter = getattr(_meters, "meter", None)
+    return _TimedHasher(hasher, meter) if meter is not None else hasher
+
+
+def format_checksum(algorithm, hexdigest):
+    """Return a checksum tagged with its algorithm, e.g. "blake2b:<hex>" """
+    return f"{algorithm}:{hexdigest}"
+
+
+def parse_checksum(checksum):
+    """Split a checksum into (algorithm, hexdigest); untagged values are legacy MD5"""
+    if ":" in checksum:
+        algorithm, hexdigest = checksum.split(":", 1)
+        return algorithm, hexdigest
+    return LEGACY_ALGORITHM, checksum
+
+
+def checksum_file(file_path, algorithm=DEFAULT_ALGORITHM, buffer_size=1024 * 1024):
+    """Hash a file on disk and return its tagged checksum"""
+    hasher = new_hasher(algorithm)
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(file_path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return format_checksum(algorithm, hasher.hexdigest())
+
+
+def verify_file(file_path, checksum, buffer_size=1024 * 1024):
+    """Whether a file's content matches a recorded checksum, tagged or legacy MD5"""
+    algorithm, hexdigest = parse_checksum(checksum)
+    return checksum_file(file_path, algorithm, buffer_size) == format_checksum(algorithm, hexdigest)
+
+
+def benchmark(algorithms=None, size=BENCHMARK_SIZE, rounds=BENCHMARK_ROUNDS):
+    """Measure hashing throughput on this host.
+
+    Returns (name, bytes per second) pairs, fastest first. Each algorithm is
+    timed over the same random buffer and the best of rounds is kept, so a
+    stray context switch doesn't decide the result.
+    """
+    data = os.urandom(size)
+    results = []
+    for name in algorithms or available_algorithms():
+        new = get_algorithm(name).new
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            hasher = new()
+            hasher.update(data)
+            hasher.hexdigest()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((name, size / best if best > 0 else float("inf")))
+    results.sort(key=lambda result: result[1], reverse=True)
+    return results
+
+
+def fastest_algorithm(size=BENCHMARK_SIZE, rounds=BENCHMARK_ROUNDS):
+    """Name of the fastest strong hash on this host"""
+    results = benchmark(available_algorithms(strong_only=True), size, rounds)
+    name, speed = results[0]
+    logger.info(f"Fastest strong hash on this host: {name} ({speed / (1024 * 1024):.0f} MiB/s)")
+    return name
+
+
+def resolve_algorithm(name):
+    """Map a configured algorithm to a strong one usable for content addresses"""
+    if not name or name == AUTO:
+        return fastest_algorithm()
+    if not get_algorithm(name).strong:
+        raise ValueError(f"{name} is not collision resistant and can't be used to address content")
+    return name
+
+
+def main():
+    for name, speed in benchmark():
+        strength = "strong" if _ALGORITHMS[name].strong else "weak"
+        print(f"{name:<10} {speed / (1024 * 1024):>8.0f} MiB/s  {strength}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
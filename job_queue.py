@@ -0,0 +1,308 @@
+import os
+import json
+import socket
+import uuid
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, func, or_
+from sqlalchemy.orm import aliased
+from app import db
+from models import BackupJob, BackupLog
+
+logger = logging.getLogger(__name__)
+
+# Queue priorities; lower runs first
+PRIORITY_MANUAL = 0
+PRIORITY_SCHEDULED = 1
+
+# How many pending jobs a worker looks at per claim attempt. Other workers
+# may take some of them first, so more than one is worth trying.
+CLAIM_CANDIDATES = 5
+
+
+class LeaseLostError(Exception):
+    """The worker running a job no longer holds its claim, so another worker may be running it"""
+
+
+def make_worker_id():
+    """Identify this process in BackupJob.claimed_by"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def encode_paths(paths):
+    return json.dumps(sorted(paths)) if paths is not None else None
+
+
+def decode_paths(value):
+    return json.loads(value) if value is not None else None
+
+
+def enqueue_job(user_id, folder_id, name, priority=PRIORITY_SCHEDULED, changed_paths=None, profile=False):
+    """Add a pending job to the shared queue and return the ID of the job that will cover it.
+
+    Like the in-process queue, a request for a folder that already has a
+    pending job is merged into it, and a full-scan request for a folder
+    whose full scan is running returns the running job. The merge only
+    applies while the job is still unclaimed, so no request is lost to a
+    worker picking the job up at the same moment. Nothing is merged into a
+    job that will resume from a checkpoint, since it skips what it did
+    before.
+    """
+    pending = BackupJob.query.filter_by(folder_id=folder_id, status='pending', claimed_by=None,
+                                        checkpoint_folder_id=None) \
+        .order_by(BackupJob.id).first()
+    if pending:
+        paths = decode_paths(pending.changed_paths)
+        if paths is not None:
+            paths = None if changed_paths is None else set(paths) | set(changed_paths)
+        result = db.session.execute(
+            update(BackupJob)
+            .where(BackupJob.id == pending.id, BackupJob.status == 'pending', BackupJob.claimed_by.is_(None))
+            .values(priority=min(pending.priority, priority), changed_paths=encode_paths(paths),
+                    is_manual=pending.is_manual or priority == PRIORITY_MANUAL,
+                    profile=pending.profile or profile)
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return pending.id
+
+    if changed_paths is None:
+        running = BackupJob.query.filter_by(folder_id=folder_id, status='running', changed_paths=None).first()
+        if running:
+            return running.id
+
+    job = BackupJob(
+        name=name,
+        user_id=user_id,
+        status='pending',
+        is_manual=priority == PRIORITY_MANUAL,
+        folder_id=folder_id,
+        priority=priority,
+        changed_paths=encode_paths(changed_paths),
+        profile=profile
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+
+def claim_job(worker_id, lease_seconds):
+    """Atomically take the next runnable pending job, or return None.
+
+    A job is claimed with a compare-and-set UPDATE, so two workers can never
+    both get it, on SQLite or Postgres alike. Jobs for a folder that
+    already has a running job are left for later; the same check is part of
+    the UPDATE, which makes it exact where writes are serialised (SQLite).
+    """
+    running = aliased(BackupJob)
+    # A folder-less job covers every folder of its user, so it conflicts with
+    # any running job of that user, and vice versa
+    conflicting = select(running.id).where(
+        running.status == 'running',
+        running.user_id == BackupJob.user_id,
+        or_(running.folder_id == BackupJob.folder_id, running.folder_id.is_(None), BackupJob.folder_id.is_(None))
+    )
+    candidates = db.session.execute(
+        select(BackupJob.id)
+        .where(
+            BackupJob.status == 'pending',
+            BackupJob.claimed_by.is_(None),
+            ~conflicting.exists()
+        )
+        .order_by(BackupJob.priority, BackupJob.id)
+        .limit(CLAIM_CANDIDATES)
+    ).scalars().all()
+
+    for job_id in candidates:
+        now = datetime.utcnow()
+        result = db.session.execute(
+            update(BackupJob)
+            .where(BackupJob.id == job_id, BackupJob.status == 'pending', BackupJob.claimed_by.is_(None),
+                   ~conflicting.exists())
+            .values(status='running', claimed_by=worker_id, heartbeat_at=now,
+                    lease_expires_at=now + timedelta(seconds=lease_seconds),
+                    attempts=func.coalesce(BackupJob.attempts, 0) + 1)
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return job_id
+    return None
+
+
+def renew_lease(job_id, worker_id, lease_seconds):
+    """Heartbeat for a claimed job. Returns False if the lease was lost to another worker."""
+    now = datetime.utcnow()
+    result = db.session.execute(
+        update(BackupJob)
+        .where(BackupJob.id == job_id, BackupJob.claimed_by == worker_id, BackupJob.status == 'running')
+        .values(heartbeat_at=now, lease_expires_at=now + timedelta(seconds=lease_seconds))
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def confirm_claim(job_id, worker_id):
+    """Make the current transaction conditional on worker_id still holding the job's claim.
+
+    The job's row is written (and so locked) until the transaction ends,
+    so the claim can't be reclaimed before the commit that follows. Raises
+    LeaseLostError, with the transaction rolled back, if the claim is gone.
+    """
+    result = db.session.execute(
+        update(BackupJob)
+        .where(BackupJob.id == job_id, BackupJob.claimed_by == worker_id, BackupJob.status == 'running')
+        .values(claimed_by=worker_id)
+    )
+    if result.rowcount != 1:
+        db.session.rollback()
+        raise LeaseLostError(f"Worker {worker_id} no longer holds the claim on backup job {job_id}")
+
+
+def release_job(job_id, worker_id):
+    """Drop the lease on a job this worker has finished with"""
+    db.session.execute(
+        update(BackupJob)
+        .where(BackupJob.id == job_id, BackupJob.claimed_by == worker_id)
+        .values(lease_expires_at=None)
+    )
+    db.session.commit()
+
+
+def reclaim_expired_jobs(max_attempts):
+    """Return jobs whose worker stopped heartbeating to the queue.
+
+    Jobs that have already been tried max_attempts times are failed instead.
+    Returns the number of jobs reclaimed or failed.
+    """
+    now = datetime.utcnow()
+    expired = db.session.execute(
+        select(BackupJob.id, BackupJob.claimed_by, BackupJob.attempts)
+        .where(BackupJob.status == 'running', BackupJob.lease_expires_at < now)
+    ).all()
+
+    count = 0
+    for job_id, claimed_by, attempts in expired:
+        give_up = (attempts or 0) >= max_attempts
+        result = db.session.execute(
+            update(BackupJob)
+            .where(BackupJob.id == job_id, BackupJob.claimed_by == claimed_by,
+                   BackupJob.status == 'running', BackupJob.lease_expires_at < now)
+            .values(status='failed' if give_up else 'pending', claimed_by=None, lease_expires_at=None)
+        )
+        if result.rowcount != 1:
+            continue
+        if give_up:
+            message = f"Backup failed: worker {claimed_by} stopped responding and the job ran out of attempts"
+        else:
+            message = f"Worker {claimed_by} stopped responding; job returned to the queue"
+        db.session.add(BackupLog(message=message, level='warning', job_id=job_id))
+        db.session.commit()
+        logger.warning(f"Job {job_id}: {message}")
+        count += 1
+    return count
+
+
+def _owner_alive(claimed_by, own_id):
+    """Whether the process named in a claim may still be running the job.
+
+    Returns None when that can't be told from here (another host).
+    """
+    if claimed_by is None:
+        return False
+    try:
+        host, pid, _ = claimed_by.rsplit(":", 2)
+        pid = int(pid)
+    except ValueError:
+        return None
+    if host != socket.gethostname():
+        return None
+    if pid == os.getpid():
+        return claimed_by == own_id
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def recover_orphaned_jobs(max_attempts, orphan_seconds, own_id, claim=False):
+    """Deal with jobs left behind by a process that died, at startup.
+
+    Jobs run by worker.py hold a lease and are handled by
+    reclaim_expired_jobs; this looks at the ones run in-process, which are
+    claimed when queued: 'running' jobs and claimed 'pending' ones. A job is
+    orphaned if the process that claimed it is gone, or, for jobs running
+    on other hosts, if its row hasn't been updated (checkpoints do that) for
+    orphan_seconds. Orphans go back to 'pending' to resume from their
+    checkpoint, claimed by own_id if claim is set so only this process
+    runs them; jobs that were already interrupted max_attempts times are
+    failed instead. Returns the jobs to run.
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=orphan_seconds)
+    candidates = BackupJob.query.filter(
+        BackupJob.lease_expires_at.is_(None),
+        or_(BackupJob.status == 'running', (BackupJob.status == 'pending') & BackupJob.claimed_by.isnot(None))
+    ).order_by(BackupJob.id).all()
+
+    resumed = []
+    for job in candidates:
+        interrupted = job.status == 'running'
+        alive = _owner_alive(job.claimed_by, own_id)
+        if alive is None:
+            alive = not interrupted or (job.updated_at is not None and job.updated_at >= stale_before)
+        if alive:
+            continue
+        owner = job.claimed_by or "an unknown process"
+        attempts = (job.attempts or 0) + 1 if interrupted else job.attempts or 0
+        give_up = interrupted and attempts >= max_attempts
+        if give_up:
+            values = {'status': 'failed', 'finished_at': datetime.utcnow()}
+        else:
+            values = {'status': 'pending', 'claimed_by': own_id if claim else None}
+        # Compare-and-set, in case another process is recovering the same job
+        result = db.session.execute(
+            update(BackupJob)
+            .where(BackupJob.id == job.id, BackupJob.status == job.status, BackupJob.lease_expires_at.is_(None),
+                   BackupJob.claimed_by == job.claimed_by if job.claimed_by else BackupJob.claimed_by.is_(None))
+            .values(attempts=attempts, **values)
+        )
+        if result.rowcount != 1:
+            db.session.rollback()
+            continue
+        if give_up:
+            message = f"Backup failed: interrupted when {owner} stopped, and the job ran out of attempts"
+        elif not interrupted:
+            message = f"Queued by {owner}, which stopped before running it; requeued"
+        elif job.checkpoint_path is not None:
+            message = f"Interrupted when {owner} stopped; resuming after {job.checkpoint_path}"
+        else:
+            message = f"Interrupted when {owner} stopped; restarting"
+        db.session.add(BackupLog(message=message, level='warning', job_id=job.id))
+        db.session.commit()
+        logger.warning(f"Job {job.id}: {message}")
+        if not give_up:
+            db.session.refresh(job)
+            resumed.append(job)
+    return resumed
+
+
+def folder_has_open_job(folder_id):
+    return db.session.query(
+        BackupJob.query.filter(BackupJob.folder_id == folder_id,
+                               BackupJob.status.in_(('pending', 'running'))).exists()
+    ).scalar()
+
+
+def queue_stats():
+    """Depth of the shared queue and number of jobs held by workers"""
+    counts = dict(db.session.execute(
+        select(BackupJob.status, func.count())
+        .where(BackupJob.status.in_(('pending', 'running')))
+        .group_by(BackupJob.status)
+    ).all())
+    workers = db.session.execute(
+        select(func.count(func.distinct(BackupJob.claimed_by))).where(BackupJob.status == 'running')
+    ).scalar()
+    return {'queued': counts.get('pending', 0), 'running': counts.get('running', 0), 'workers': workers}
@@ -0,0 +1,140 @@
+import os
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Per-file timings measured in a worker thread by process_file
+FileTiming = namedtuple("FileTiming", ["scan_seconds", "hash_seconds", "copy_seconds", "bytes_hashed"])
+
+# Check memory every this many files, in addition to every commit
+RSS_SAMPLE_INTERVAL = 100
+
+try:
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+def current_rss_bytes():
+    """Resident set size of this process, or None where it can't be read cheaply"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _max_rss_bytes():
+    """Lifetime peak RSS; only a fallback, since it never goes down in a long-lived process"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return usage if os.uname().sysname == "Darwin" else usage * 1024
+
+
+def stored_bytes(staged):
+    """(bytes written to storage, bytes of content that was already stored) for a staged file"""
+    blobs = [chunk for _, chunk in staged['chunks']] if 'chunks' in staged else [staged['blob']]
+    copied = sum(blob.stored_size for blob in blobs if blob.written)
+    deduplicated = sum(blob.size for blob in blobs if not blob.written)
+    return copied, deduplicated
+
+
+class JobStats:
+    """Counters and phase timings for one backup job, saved on its BackupJob row.
+
+    The scan, hash and copy phases run on the worker threads and are summed
+    over them, so together with db_seconds they can add up to more than
+    wall_seconds. Only the job thread updates this object.
+    """
+
+    def __init__(self):
+        self.files_scanned = 0
+        self.files_changed = 0
+        self.bytes_hashed = 0
+        self.bytes_copied = 0
+        self.bytes_deduplicated = 0
+        self.scan_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.copy_seconds = 0.0
+        self.db_seconds = 0.0
+        self.peak_rss_bytes = None
+        self._start = time.perf_counter()
+        self._earlier_seconds = 0.0  # Wall time of earlier runs of a resumed job
+        self._since_sample = 0
+        self.sample_rss()
+
+    @classmethod
+    def resume(cls, job):
+        """Stats for a job continuing from its checkpoint, starting from the counts saved there"""
+        stats = cls()
+        for name in ("files_scanned", "files_changed", "bytes_hashed", "bytes_copied", "bytes_deduplicated",
+                     "scan_seconds", "hash_seconds", "copy_seconds", "db_seconds"):
+            setattr(stats, name, getattr(job, name) or 0)
+        stats._earlier_seconds = job.wall_seconds or 0.0
+        if job.peak_rss_bytes and job.peak_rss_bytes > (stats.peak_rss_bytes or 0):
+            stats.peak_rss_bytes = job.peak_rss_bytes
+        return stats
+
+    @contextmanager
+    def timed(self, phase):
+        """Add the time spent in the block to <phase>_seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            setattr(self, f"{phase}_seconds", getattr(self, f"{phase}_seconds") + time.perf_counter() - start)
+
+    def add_file(self, timing, staged=None):
+        """Record one processed file; staged is its content if it was backed up"""
+        self.files_scanned += 1
+        if timing is not None:
+            self.scan_seconds += timing.scan_seconds
+            self.hash_seconds += timing.hash_seconds
+            self.copy_seconds += timing.copy_seconds
+            self.bytes_hashed += timing.bytes_hashed
+        if staged is not None:
+            self.files_changed += 1
+            copied, deduplicated = stored_bytes(staged)
+            self.bytes_copied += copied
+            self.bytes_deduplicated += deduplicated
+        self._since_sample += 1
+        if self._since_sample >= RSS_SAMPLE_INTERVAL:
+            self.sample_rss()
+
+    def sample_rss(self):
+        self._since_sample = 0
+        rss = current_rss_bytes()
+        if rss is None:
+            rss = _max_rss_bytes()
+        if rss is not None and (self.peak_rss_bytes is None or rss > self.peak_rss_bytes):
+            self.peak_rss_bytes = rss
+
+    @property
+    def wall_seconds(self):
+        return self._earlier_seconds + time.perf_counter() - self._start
+
+    def save(self, job, unsaved_db_seconds=0.0):
+        """Copy the numbers onto a BackupJob; the caller commits.
+
+        unsaved_db_seconds is database time not added to db_seconds yet,
+        for saving a checkpoint while a BackupWriter is still counting it.
+        """
+        self.sample_rss()
+        job.files_scanned = self.files_scanned
+        job.files_changed = self.files_changed
+        job.bytes_hashed = self.bytes_hashed
+        job.bytes_copied = self.bytes_copied
+        job.bytes_deduplicated = self.bytes_deduplicated
+        job.scan_seconds = self.scan_seconds
+        job.hash_seconds = self.hash_seconds
+        job.copy_seconds = self.copy_seconds
+        job.db_seconds = self.db_seconds + unsaved_db_seconds
+        job.wall_seconds = self.wall_seconds
+        job.peak_rss_bytes = self.peak_rss_bytes
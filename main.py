@@ -7,9 +7,11 @@ logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Initialize and start the backup scheduler
+# Initialize and start the backup scheduler. With BACKUP_EXECUTION=workers,
+# jobs are queued in the database and run by worker.py processes instead, so
+# gunicorn workers don't each run their own scheduler.
 scheduler.init_app(app)
-if app.config.get("MONITOR_ENABLED", True):
+if app.config.get("MONITOR_ENABLED", True) and not scheduler.uses_workers:
     scheduler.start()
     logger.info("Started backup scheduler")
 
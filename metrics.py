@@ -0,0 +1,416 @@
+import os
+import json
+import time
+import socket
+import bisect
+import logging
+import threading
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+JOB_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 21600)
+
+# Snapshots of processes that stopped updating them are retired after this long:
+# their counters and histograms are added to RETIRED_SNAPSHOT, their gauges dropped
+SNAPSHOT_RETENTION = 3600
+RETIRED_SNAPSHOT = "retired.json"
+
+
+class _Metric:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            values = [[list(key), value] for key, value in self._values.items()]
+        return {"type": self.type, "help": self.help, "labelnames": list(self.labelnames), "values": values}
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down.
+
+    Across processes gauges are added up, unless merge is "max": that is for
+    values about shared state (e.g. queue depth, storage use) that several processes may
+    each report.
+    """
+    type = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), merge="sum"):
+        super().__init__(name, help_text, labelnames)
+        self.merge = merge
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot["merge"] = self.merge
+        return snapshot
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=REQUEST_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts = counts[:]
+            counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot["buckets"] = list(self.buckets)
+        return snapshot
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), merge="sum"):
+        return self._add(Gauge(name, help_text, labelnames, merge))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=REQUEST_BUCKETS):
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+
+def merge_snapshots(snapshots):
+    """Add up the snapshots of several processes, label set by label set"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for labels, value in metric["values"]:
+                key = tuple(labels)
+                current = target["values"].get(key)
+                if current is None:
+                    target["values"][key] = value
+                elif metric["type"] == "histogram":
+                    counts = [a + b for a, b in zip(current[0], value[0])]
+                    target["values"][key] = (counts, current[1] + value[1], current[2] + value[2])
+                elif metric.get("merge") == "max":
+                    target["values"][key] = max(current, value)
+                else:
+                    target["values"][key] = current + value
+    return merged
+
+
+def _without_gauges(snapshot):
+    return {name: metric for name, metric in snapshot.items() if metric["type"] != "gauge"}
+
+
+def _as_snapshot(merged):
+    """Turn merge_snapshots() output back into the snapshot format"""
+    return {name: {**metric, "values": [[list(key), value] for key, value in metric["values"].items()]}
+            for name, metric in merged.items()}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(merged):
+    """Format merged metrics in the Prometheus text exposition format"""
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        names = metric["labelnames"]
+        for key in sorted(metric["values"]):
+            value = metric["values"][key]
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_labels(names, key)} {_number(value)}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(list(metric["buckets"]) + [float("inf")], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(names, key, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(names, key)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(names, key)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+class Metrics:
+    """Process-wide metrics, exposed for Prometheus at /metrics.
+
+    Hot paths only update in-memory values. Each process writes a snapshot
+    of its values to METRICS_DIR every METRICS_FLUSH_INTERVAL seconds, and
+    a scrape adds up the snapshots of every process, so gunicorn workers
+    and worker.py processes all show up in one response. Counters and
+    histograms of processes that have exited keep counting (totals must
+    never go down), but their gauges are left out once they go stale. Values
+    that need a database query (queue depth in workers mode, storage use)
+    come from collectors run on the same timer, never from the scrape.
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        self.app = None
+        self._pid = None
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._collectors = []  # [callable, interval, next run]
+        self._collectors_lock = threading.Lock()
+
+        r = self.registry
+        self.jobs = r.counter("backup_jobs_total", "Backup jobs finished, by final status", ["status"])
+        self.job_duration = r.histogram("backup_job_duration_seconds", "Wall time of finished backup jobs",
+                                        buckets=JOB_BUCKETS)
+        self.files_scanned = r.counter("backup_files_scanned_total", "Files looked at by backup jobs")
+        self.files_changed = r.counter("backup_files_changed_total", "Files backed up by backup jobs")
+        self.bytes_hashed = r.counter("backup_bytes_hashed_total", "Bytes hashed by backup jobs")
+        self.bytes_written = r.counter("backup_bytes_written_total", "Bytes written to storage by backup jobs")
+        self.bytes_deduplicated = r.counter("backup_bytes_deduplicated_total",
+                                            "Bytes backed up that were already in storage")
+        self.jobs_queued = r.gauge("backup_jobs_queued", "Backup jobs waiting to run", merge="max")
+        self.jobs_running = r.gauge("backup_jobs_running", "Backup jobs running", merge="max")
+        self.requests = r.counter("http_requests_total", "HTTP requests, by endpoint and status",
+                                  ["method", "endpoint", "status"])
+        self.request_duration = r.histogram("http_request_duration_seconds", "HTTP request latency by endpoint",
+                                            ["endpoint"])
+        self.sql_statements = r.counter("sql_statements_total", "SQL statements sent to the database")
+        self.storage_bytes = r.gauge("storage_stored_bytes", "Bytes on disk used by stored blobs", merge="max")
+        self.storage_blobs = r.gauge("storage_blobs", "Blobs in storage", merge="max")
+
+    def init_app(self, app):
+        self.app = app
+        if not app.config.get("METRICS_ENABLED", True):
+            return
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        event.listen(Engine, "before_cursor_execute", self._on_statement)
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config.get("METRICS_ENABLED", True)
+
+    # Recording
+
+    def _before_request(self):
+        self.ensure_started()
+        g._metrics_start = time.perf_counter()
+
+    def _after_request(self, response):
+        start = g.pop("_metrics_start", None)
+        if start is not None:
+            endpoint = request.endpoint or "unmatched"
+            self.request_duration.observe(time.perf_counter() - start, endpoint=endpoint)
+            self.requests.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+        return response
+
+    def _on_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.sql_statements.inc()
+
+    def record_job(self, status, stats):
+        """Count a finished job; stats is its JobStats"""
+        if not self.enabled:
+            return
+        self.ensure_started()
+        self.jobs.inc(status=status)
+        self.job_duration.observe(stats.wall_seconds)
+        self.files_scanned.inc(stats.files_scanned)
+        self.files_changed.inc(stats.files_changed)
+        self.bytes_hashed.inc(stats.bytes_hashed)
+        self.bytes_written.inc(stats.bytes_copied)
+        self.bytes_deduplicated.inc(stats.bytes_deduplicated)
+
+    def add_collector(self, collector, interval=None):
+        """Call collector() (in an app context) every interval seconds to refresh gauges"""
+        if not self.enabled:
+            return
+        with self._collectors_lock:
+            self._collectors.append([collector, interval, 0])
+        self.ensure_started()
+
+    # Snapshots
+
+    @property
+    def _snapshot_dir(self):
+        return self.app.config.get("METRICS_DIR")
+
+    def _snapshot_name(self):
+        return f"{socket.gethostname()}-{os.getpid()}.json"
+
+    def ensure_started(self):
+        """Start the snapshot thread, once per process (so also after a fork)"""
+        if self._pid == os.getpid() or not self.enabled:
+            return
+        self._pid = os.getpid()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stop_event.set()
+
+    def _run(self):
+        interval = self.app.config.get("METRICS_FLUSH_INTERVAL", 5)
+        while True:
+            self._run_collectors()
+            self._write_snapshot()
+            if self._stop_event.wait(interval):
+                break
+
+    def _run_collectors(self):
+        now = time.monotonic()
+        with self._collectors_lock:
+            due = [c for c in self._collectors if c[2] <= now]
+            for c in due:
+                c[2] = now + (c[1] or 0)
+        for collector, _, _ in due:
+            try:
+                with self.app.app_context():
+                    collector()
+            except Exception as e:
+                logger.error(f"Metrics collector {collector.__name__} failed: {e}")
+
+    def _write_snapshot(self):
+        directory = self._snapshot_dir
+        if not directory:
+            return
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, self._snapshot_name())
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(self.registry.snapshot(), f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.error(f"Cannot write metrics snapshot: {e}")
+
+    def _other_snapshots(self):
+        directory = self._snapshot_dir
+        if not directory or not os.path.isdir(directory):
+            return []
+        own = self._snapshot_name()
+        stale = self.app.config.get("METRICS_STALE_SECONDS", 60)
+        now = time.time()
+        snapshots = []
+        retired = []
+        for name in os.listdir(directory):
+            if name in (own, RETIRED_SNAPSHOT) or not name.endswith(".json"):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                age = now - os.path.getmtime(path)
+                if age > SNAPSHOT_RETENTION:
+                    retired.append(path)
+                    continue
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            snapshots.append(_without_gauges(snapshot) if age > stale else snapshot)
+        if retired:
+            self._retire(directory, retired)
+        try:
+            with open(os.path.join(directory, RETIRED_SNAPSHOT)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return snapshots
+
+    def _retire(self, directory, paths):
+        """Add the counters and histograms of old snapshots to the retired snapshot and delete them"""
+        try:
+            with open(os.path.join(directory, f"{RETIRED_SNAPSHOT}.lock"), "w") as lock:
+                if fcntl is not None:
+                    # Another process retiring the same snapshots would count them twice
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                path = os.path.join(directory, RETIRED_SNAPSHOT)
+                try:
+                    with open(path) as f:
+                        snapshots = [json.load(f)]
+                except FileNotFoundError:
+                    snapshots = []
+                done = []
+                for old in paths:
+                    try:
+                        with open(old) as f:
+                            snapshots.append(_without_gauges(json.load(f)))
+                    except FileNotFoundError:
+                        continue  # Retired by another process meanwhile
+                    except ValueError:
+                        pass  # Unreadable; nothing to keep
+                    done.append(old)
+                temp_path = f"{path}.tmp"
+                with open(temp_path, "w") as f:
+                    json.dump(_as_snapshot(merge_snapshots(snapshots)), f)
+                os.replace(temp_path, path)
+                for old in done:
+                    os.remove(old)
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot retire metrics snapshots: {e}")
+
+    def exposition(self):
+        """All processes' metrics in the Prometheus text format"""
+        self.ensure_started()
+        return render(merge_snapshots([self.registry.snapshot(), *self._other_snapshots()]))
+
+
+# Create global metrics instance
+metrics = Metrics()
@@ -0,0 +1,21 @@
+"""Delete a monitored folder's backup jobs with it
+Revision ID: f6a2c8e4d913
+Revises: a3d7e9b2c584
+Create Date: 2026-10-20 10:12:37.406521
+"""
+from alembic import op
+import sqlalchemy as sa
+# revision identifiers, used by Alembic.
+revision = 'f6a2c8e4d913'
+down_revision = 'a3d7e9b2c584'
+branch_labels = None
+depends_on = None
+def upgrade():
+    # SET NULL turned a deleted folder's jobs into backups of every folder of the user
+    with op.batch_alter_table('backup_job', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_backup_job_folder_id', type_='foreignkey')
+        batch_op.create_foreign_key('fk_backup_job_folder_id', 'monitored_folder', ['folder_id'], ['id'], ondelete='CASCADE')
+def downgrade():
+    with op.batch_alter_table('backup_job', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_backup_job_folder_id', type_='foreignkey')
+        batch_op.create_foreign_key('fk_backup_job_folder_id', 'monitored_folder', ['folder_id'], ['id'], ondelete='SET NULL')
@@ -38,6 +38,7 @@ class MonitoredFolder(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     last_scan_at = db.Column(db.DateTime, nullable=True)
+    last_backup_at = db.Column(db.DateTime, nullable=True)  # When the last completed job covering the folder finished
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     backup_interval = db.Column(db.Integer, default=60)  # Backup interval in minutes
     backup_logs = db.relationship('BackupLog', backref='folder', lazy=True)
@@ -51,9 +52,45 @@ class BackupJob(db.Model):
     name = db.Column(db.String(255), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    status = db.Column(db.String(50), default='pending')  # pending, running, completed, failed
+    status = db.Column(db.String(50), default='pending', index=True)  # pending, running, completed, failed
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     is_manual = db.Column(db.Boolean, default=False)
+    priority = db.Column(db.Integer, default=1, server_default='1', nullable=False)  # Lower runs first
+    changed_paths = db.Column(db.Text, nullable=True)  # JSON list of paths to look at; NULL means a full scan
+    # Claim held by the worker running the job. Workers renew the lease while
+    # they run; a job whose lease has expired is returned to the queue.
+    claimed_by = db.Column(db.String(255), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    attempts = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    # Performance telemetry, recorded when the job finishes. The scan, hash
+    # and copy times are summed over the job's worker threads, so they can
+    # add up to more than wall_seconds.
+    files_scanned = db.Column(db.Integer, nullable=True)
+    files_changed = db.Column(db.Integer, nullable=True)
+    bytes_hashed = db.Column(db.BigInteger, nullable=True)
+    bytes_copied = db.Column(db.BigInteger, nullable=True)  # Written to storage, after compression
+    bytes_deduplicated = db.Column(db.BigInteger, nullable=True)  # Content that was already stored
+    scan_seconds = db.Column(db.Float, nullable=True)
+    hash_seconds = db.Column(db.Float, nullable=True)
+    copy_seconds = db.Column(db.Float, nullable=True)
+    db_seconds = db.Column(db.Float, nullable=True)
+    wall_seconds = db.Column(db.Float, nullable=True)
+    peak_rss_bytes = db.Column(db.BigInteger, nullable=True)  # Of the process running the job
+    profile = db.Column(db.Boolean, default=False, server_default='0', nullable=False)  # Run under the sampling profiler
+    profile_file = db.Column(db.String(255), nullable=True)  # Collapsed stacks, in PROFILE_DIR
+    # Progress saved with every commit of the job: all folders before
+    # checkpoint_folder_id, and that folder's files up to checkpoint_path
+    # (relative, in sorted order), are done. A resumed job continues from here.
+    checkpoint_folder_id = db.Column(db.Integer, nullable=True)
+    checkpoint_path = db.Column(db.String(1024), nullable=True)
+    checkpoint_at = db.Column(db.DateTime, nullable=True)
+    # Folder the job backs up; NULL means every active folder of the user, so
+    # deleting the folder deletes its jobs rather than widening them
+    folder_id = db.Column(db.Integer, db.ForeignKey('monitored_folder.id', ondelete='CASCADE'), nullable=True, index=True)
+    folder = db.relationship('MonitoredFolder', lazy=True)
     logs = db.relationship('BackupLog', backref='job', lazy=True)
     
     def __repr__(self):
@@ -77,7 +114,7 @@ class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
-    size = db.Column(db.Integer, nullable=False)  # Size in bytes
+    size = db.Column(db.BigInteger, nullable=False)  # Size in bytes
     content_type = db.Column(db.String(100), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -112,15 +149,95 @@ class FileVersion(db.Model):
     file_id = db.Column(db.Integer, db.ForeignKey('file.id'), nullable=False)
     version_number = db.Column(db.Integer, nullable=False)
     filename = db.Column(db.String(255), nullable=False)  # The internal filename on disk
-    size = db.Column(db.Integer, nullable=False)  # Size in bytes
+    size = db.Column(db.BigInteger, nullable=False)  # Size in bytes
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_current = db.Column(db.Boolean, default=True)
-    checksum = db.Column(db.String(128), nullable=True)  # For file integrity verification
+    checksum = db.Column(db.String(160), nullable=True)  # "<algorithm>:<hex>", or untagged MD5 on old versions
     change_reason = db.Column(db.String(255), nullable=True)  # Description of what changed
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'), nullable=True)  # Content-addressed storage
+    is_chunked = db.Column(db.Boolean, default=False)  # Stored as an ordered list of chunks
+    # Stat of the source file when this version was taken, used for change detection
+    source_size = db.Column(db.BigInteger, nullable=True)
+    source_mtime_ns = db.Column(db.BigInteger, nullable=True)
+    source_inode = db.Column(db.BigInteger, nullable=True)
+    source_ctime_ns = db.Column(db.BigInteger, nullable=True)
+    stored_size = db.Column(db.BigInteger, nullable=True)  # Bytes on disk after compression
+    chunks = db.relationship('VersionChunk', backref='version', lazy=True,
+                             order_by='VersionChunk.seq', cascade="all, delete-orphan")
     
     def __repr__(self):
         return f'<FileVersion {self.file_id}-{self.version_number}>'
         
     def get_path(self):
+        """Path of the stored content, or None for a chunked version (its content is in its chunks' blobs)"""
+        if self.is_chunked:
+            return None
         from app import app
         return os.path.join(app.config['UPLOAD_FOLDER'], self.filename)
+
+
+class VersionChunk(db.Model):
+    """One chunk of a chunked FileVersion, in file order"""
+    id = db.Column(db.Integer, primary_key=True)
+    version_id = db.Column(db.Integer, db.ForeignKey('file_version.id'), nullable=False, index=True)
+    seq = db.Column(db.Integer, nullable=False)  # Position of the chunk within the version
+    offset = db.Column(db.BigInteger, nullable=False)  # Byte offset within the version
+    size = db.Column(db.Integer, nullable=False)
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'), nullable=False)
+    blob = db.relationship('Blob', lazy='joined')
+    
+    def __repr__(self):
+        return f'<VersionChunk {self.version_id}-{self.seq}>'
+
+
+class Blob(db.Model):
+    """A piece of content stored once in UPLOAD_FOLDER, shared by every version with the same digest"""
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(160), unique=True, nullable=False, index=True)  # e.g. "sha256:<hex>"
+    filename = db.Column(db.String(255), nullable=False)  # Path relative to UPLOAD_FOLDER
+    size = db.Column(db.BigInteger, nullable=False)  # Size in bytes
+    compression = db.Column(db.String(16), nullable=True)  # Codec the file on disk is compressed with, if any
+    stored_size = db.Column(db.BigInteger, nullable=True)  # Size of the file on disk
+    ref_count = db.Column(db.Integer, default=0, nullable=False)  # Number of FileVersions using this blob
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    versions = db.relationship('FileVersion', backref='blob', lazy=True)
+    
+    def __repr__(self):
+        return f'<Blob {self.digest}>'
+    
+    def get_path(self):
+        from app import app
+        return os.path.join(app.config['UPLOAD_FOLDER'], self.filename)
+
+
+class UploadSession(db.Model):
+    """A chunked upload in progress; the bytes received so far are in UPLOAD_FOLDER/uploads/<id>"""
+    id = db.Column(db.String(32), primary_key=True)  # Random, part of the upload's URLs
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(100), nullable=False)
+    size = db.Column(db.BigInteger, nullable=True)  # Total size announced by the client, if it did
+    checksum = db.Column(db.String(160), nullable=True)  # Expected "<algorithm>:<hex>", if given up front
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<UploadSession {self.id}>'
+
+
+class UsageStats(db.Model):
+    """Running totals over a user's live (not deleted) files and their versions.
+    
+    Updated in the same transaction as every change to what they count, so
+    the dashboard reads them instead of aggregating. folder_id 0 holds the
+    user's totals; other rows hold one monitored folder's share of them.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    folder_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    file_count = db.Column(db.BigInteger, default=0, server_default='0', nullable=False)
+    version_count = db.Column(db.BigInteger, default=0, server_default='0', nullable=False)
+    total_size = db.Column(db.BigInteger, default=0, server_default='0', nullable=False)  # Sum of File.size
+    stored_size = db.Column(db.BigInteger, default=0, server_default='0', nullable=False)  # Versions' bytes on disk
+    
+    def __repr__(self):
+        return f'<UsageStats {self.user_id}-{self.folder_id}>'
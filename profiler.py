@@ -0,0 +1,149 @@
+import os
+import re
+import sys
+import random
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.01
+
+# Pool threads are named "<prefix>_<n>"; profiles group them under the prefix
+_THREAD_NUMBER = re.compile(r"_\d+$")
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Statistical profiler for a set of threads.
+
+    A background thread takes the stacks of every thread accepted by
+    thread_filter every interval seconds, so the profiled code runs
+    unmodified and the overhead doesn't depend on how many calls it makes.
+    The result is in collapsed-stack format ("root;caller;callee count"
+    per line), which flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self, thread_filter, interval=DEFAULT_INTERVAL):
+        self.thread_filter = thread_filter
+        self.interval = interval
+        self.samples = 0
+        self._stacks = Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            for thread in threading.enumerate():
+                frame = frames.get(thread.ident)
+                if frame is None or thread.ident == own or not self.thread_filter(thread):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(_THREAD_NUMBER.sub("", thread.name))
+                self._stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(self.collapsed())
+
+
+class Profiler:
+    """Opt-in profiling of backup jobs and a sample of HTTP requests.
+
+    Jobs are profiled when PROFILE_JOBS is set or the job was started with
+    profiling requested; requests with probability PROFILE_REQUEST_RATE.
+    Profiles go to PROFILE_DIR. When profiling is off the only cost is the
+    check of those settings.
+    """
+
+    def __init__(self):
+        self.app = None
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    @property
+    def directory(self):
+        return self.app.config.get("PROFILE_DIR") or os.path.join(os.getcwd(), "profiles")
+
+    @property
+    def interval(self):
+        return self.app.config.get("PROFILE_INTERVAL", DEFAULT_INTERVAL)
+
+    def wants_job(self, job):
+        return bool(job.profile or self.app.config.get("PROFILE_JOBS", False))
+
+    def job_profile_path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    @contextmanager
+    def profile_job(self, job_id):
+        """Profile the calling thread and the job's worker pool; yields the profile's file name"""
+        caller = threading.get_ident()
+        pool_prefix = f"backup-job-{job_id}_"
+        sampler = SamplingProfiler(lambda t: t.ident == caller or t.name.startswith(pool_prefix), self.interval)
+        filename = f"job-{job_id}.folded"
+        sampler.start()
+        try:
+            yield filename
+        finally:
+            sampler.stop()
+            try:
+                sampler.write(self.job_profile_path(filename))
+                logger.info(f"Wrote profile of job {job_id} ({sampler.samples} samples) to {filename}")
+            except OSError as e:
+                logger.error(f"Cannot write profile of job {job_id}: {e}")
+
+    def _before_request(self):
+        rate = self.app.config.get("PROFILE_REQUEST_RATE", 0)
+        if not rate or random.random() >= rate:
+            return
+        caller = threading.get_ident()
+        sampler = SamplingProfiler(lambda t: t.ident == caller, self.interval)
+        sampler.start()
+        g._profiler = sampler
+
+    def _teardown_request(self, exc):
+        sampler = g.pop("_profiler", None)
+        if sampler is None:
+            return
+        sampler.stop()
+        if not sampler.samples:
+            return
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        path = os.path.join(self.directory, "requests", f"{stamp}-{request.endpoint or 'unmatched'}.folded")
+        try:
+            sampler.write(path)
+        except OSError as e:
+            logger.error(f"Cannot write request profile: {e}")
+
+
+# Create global profiler instance
+profiler = Profiler()
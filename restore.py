@@ -0,0 +1,273 @@
+"""Rebuild a monitored folder as it was at a point in time.
+
+The version of every file as of the given time is found with one query;
+the tree is then written to a target directory by a pool of threads.
+Uncompressed blobs are cloned (reflinked) where the filesystem allows,
+otherwise copied in the kernel; compressed and chunked content is
+decoded as it is written. Every file gets the mtime its source had when
+it was backed up.
+
+    python restore.py --folder 3 --at 2026-10-01T12:00 --target /srv/restore/photos
+
+Times are UTC, like everything the database records. Files in the target
+that aren't part of the snapshot are left alone.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import calendar
+import logging
+import argparse
+import threading
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from sqlalchemy import select, func
+from app import app, db
+from models import File, FileVersion, Blob, VersionChunk, MonitoredFolder
+from blob_store import ChunkedReader, clone_file, copy_file, open_blob, READ_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# How a file's content is put in place: "clone" and "link" share the blob's
+# storage, "copy" writes a copy in the kernel, "decode" decompresses or joins chunks
+METHODS = ("clone", "link", "copy", "decode")
+
+RestoreItem = namedtuple("RestoreItem", "rel_path version_id size mtime_ns filename compression is_chunked")
+
+
+class RestoreReport:
+    """What a restore did and how fast"""
+
+    def __init__(self, folder_id, at, target):
+        self.folder_id = folder_id
+        self.at = at
+        self.target = target
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.methods = dict.fromkeys(METHODS, 0)
+        self.query_seconds = 0.0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, method, size):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            self.methods[method] += 1
+
+    def add_error(self):
+        with self._lock:
+            self.errors += 1
+
+    @property
+    def files_per_second(self):
+        return self.files / self.seconds if self.seconds else 0.0
+
+    @property
+    def mb_per_second(self):
+        return self.bytes / 1024 / 1024 / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return {
+            'folder_id': self.folder_id,
+            'at': self.at.isoformat(),
+            'target': self.target,
+            'files': self.files,
+            'bytes': self.bytes,
+            'errors': self.errors,
+            'methods': self.methods,
+            'query_seconds': round(self.query_seconds, 3),
+            'seconds': round(self.seconds, 3),
+            'files_per_second': round(self.files_per_second, 1),
+            'mb_per_second': round(self.mb_per_second, 1),
+        }
+
+
+def versions_at(folder_id, at):
+    """The version of every backed-up file of a folder that was current at time at.
+
+    That is the newest version of each path taken at or before at; paths
+    whose first version is later didn't exist yet and are left out. Files
+    deleted since are included: they were there at the time.
+    """
+    # A path deleted and backed up again has a File row per incarnation; the
+    # newest version across all of them is the one that was there at the time
+    newest = func.row_number().over(
+        partition_by=File.source_path,
+        order_by=(FileVersion.created_at.desc(), FileVersion.id.desc())
+    ).label("newest")
+    candidates = (
+        select(File.source_path, FileVersion.id, FileVersion.size, FileVersion.source_mtime_ns,
+               FileVersion.created_at, FileVersion.filename, Blob.compression, FileVersion.is_chunked, newest)
+        .join(File, File.id == FileVersion.file_id)
+        .outerjoin(Blob, Blob.id == FileVersion.blob_id)
+        .where(File.source_folder_id == folder_id, File.source_path.isnot(None),
+               FileVersion.created_at <= at)
+        .subquery()
+    )
+    rows = db.session.execute(
+        select(candidates).where(candidates.c.newest == 1).order_by(candidates.c.source_path)
+    )
+    items = []
+    for row in rows:
+        mtime_ns = row.source_mtime_ns
+        if mtime_ns is None:
+            mtime_ns = calendar.timegm(row.created_at.utctimetuple()) * 1_000_000_000
+        items.append(RestoreItem(row.source_path, row.id, row.size, mtime_ns, row.filename,
+                                 row.compression, row.is_chunked))
+    return items
+
+
+def _chunk_lists(items):
+    """{version id: [(offset, size, relative path, compression)]} for the chunked items, in one query"""
+    chunked = [item.version_id for item in items if item.is_chunked]
+    chunks = defaultdict(list)
+    if not chunked:
+        return chunks
+    rows = db.session.execute(
+        select(VersionChunk.version_id, VersionChunk.offset, VersionChunk.size, Blob.filename, Blob.compression)
+        .join(Blob, Blob.id == VersionChunk.blob_id)
+        .where(VersionChunk.version_id.in_(chunked))
+        .order_by(VersionChunk.version_id, VersionChunk.seq)
+    )
+    for row in rows:
+        chunks[row.version_id].append((row.offset, row.size, row.filename, row.compression))
+    return chunks
+
+
+class RestoreEngine:
+    """Writes a list of RestoreItems under a target directory.
+
+    With hardlink, uncompressed blobs that can't be cloned are hard-linked
+    instead of copied. That is fastest of all, but the restored files then
+    are the stored blobs: they must be treated as read-only, and files with
+    the same content share one mtime.
+    """
+
+    def __init__(self, storage_root, workers=4, buffer_size=READ_CHUNK_SIZE, kernel_copy=True, hardlink=False):
+        self.storage_root = storage_root
+        self.workers = max(1, workers)
+        self.buffer_size = buffer_size
+        self.kernel_copy = kernel_copy
+        self.hardlink = hardlink
+        self._can_clone = True  # Until the target filesystem says otherwise
+
+    def run(self, items, chunks, target, report):
+        # Create the tree up front, so the workers don't race to make the same directories
+        for directory in sorted({os.path.dirname(item.rel_path) for item in items}):
+            os.makedirs(os.path.join(target, directory), exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="restore") as pool:
+            for item in items:
+                pool.submit(self._restore_item, item, chunks.get(item.version_id), target, report)
+
+    def _restore_item(self, item, chunks, target, report):
+        path = os.path.join(target, item.rel_path)
+        # Written under a temporary name, so an interrupted restore never leaves a partial file in place
+        temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex}.restoring")
+        try:
+            method = self._write(item, chunks, temp_path)
+            os.utime(temp_path, ns=(item.mtime_ns, item.mtime_ns))
+            if method == "link" and os.path.exists(path):
+                # Renaming onto another link to the same blob would do nothing and leave the temporary name
+                os.remove(path)
+            os.replace(temp_path, path)
+            report.add(method, item.size)
+        except Exception as e:
+            logger.error(f"Cannot restore {item.rel_path}: {e}")
+            report.add_error()
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def _write(self, item, chunks, temp_path):
+        if item.is_chunked:
+            source = ChunkedReader(chunks or (), self.storage_root)
+        else:
+            blob_path = os.path.join(self.storage_root, item.filename)
+            if not item.compression:
+                return self._place_blob(blob_path, temp_path)
+            source = open_blob(blob_path, item.compression)
+        with source, open(temp_path, "wb") as dst:
+            shutil.copyfileobj(source, dst, self.buffer_size)
+            written = dst.tell()
+        if written != item.size:
+            raise IOError(f"stored content is {written} bytes, {item.size} were recorded")
+        return "decode"
+
+    def _place_blob(self, blob_path, temp_path):
+        if self._can_clone:
+            if clone_file(blob_path, temp_path):
+                return "clone"
+            self._can_clone = False
+        if self.hardlink:
+            try:
+                os.link(blob_path, temp_path)
+                return "link"
+            except OSError as e:
+                logger.debug(f"Cannot hard-link {blob_path}: {e}")
+        copy_file(blob_path, temp_path, self.buffer_size, self.kernel_copy)
+        return "copy"
+
+
+def restore_folder(folder, at, target, workers=None, hardlink=False):
+    """Rebuild folder as it was at time at (naive UTC) under target; returns a RestoreReport"""
+    config = app.config
+    report = RestoreReport(folder.id, at, target)
+    start = time.perf_counter()
+    items = versions_at(folder.id, at)
+    chunks = _chunk_lists(items)
+    report.query_seconds = time.perf_counter() - start
+    logger.info(f"Restoring {len(items)} files of folder {folder.name} as of {at} to {target}")
+
+    engine = RestoreEngine(config['UPLOAD_FOLDER'], workers or config.get('BACKUP_WORKERS', 4),
+                           config.get('COPY_BUFFER_SIZE', READ_CHUNK_SIZE), config.get('KERNEL_COPY_ENABLED', True),
+                           hardlink)
+    os.makedirs(target, exist_ok=True)
+    engine.run(items, chunks, target, report)
+    report.seconds = time.perf_counter() - start
+    logger.info(f"Restored {report.files} files ({report.bytes} bytes) in {report.seconds:.1f}s: "
+                f"{report.files_per_second:.0f} files/s, {report.mb_per_second:.1f} MB/s, {report.errors} errors")
+    return report
+
+
+def parse_time(value):
+    """An ISO 8601 time as naive UTC; times without an offset are taken to be UTC already"""
+    at = datetime.fromisoformat(value)
+    if at.tzinfo is not None:
+        at = at.astimezone(timezone.utc).replace(tzinfo=None)
+    return at
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild a monitored folder as it was at a point in time")
+    parser.add_argument("--folder", type=int, required=True, help="id of the monitored folder")
+    parser.add_argument("--target", required=True, help="directory to write the tree to")
+    parser.add_argument("--at", type=parse_time, default=None,
+                        help="UTC time to restore to, e.g. 2026-10-01T12:00 (default: now)")
+    parser.add_argument("--workers", type=int, default=None, help="copy threads (default: BACKUP_WORKERS)")
+    parser.add_argument("--hardlink", action="store_true",
+                        help="hard-link uncompressed blobs that can't be cloned; the restored files must not be modified")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    with app.app_context():
+        folder = db.session.get(MonitoredFolder, args.folder)
+        if folder is None:
+            parser.error(f"no monitored folder {args.folder}")
+        report = restore_folder(folder, args.at or datetime.utcnow(), os.path.abspath(args.target),
+                                args.workers, args.hardlink)
+    json.dump(report.as_dict(), sys.stdout, indent=2)
+    print()
+    sys.exit(1 if report.errors else 0)
+
+
+if __name__ == "__main__":
+    main()
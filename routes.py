@@ -1,16 +1,26 @@
 import os
-import uuid
+import hmac
 import shutil
 from datetime import datetime
-from flask import render_template, url_for, flash, redirect, request, jsonify, send_file
+from flask import (render_template, url_for, flash, redirect, request, jsonify, send_file, abort, Response,
+                   stream_with_context)
 from flask_login import login_user, logout_user, current_user, login_required
 from werkzeug.utils import secure_filename
 from app import db
-from models import User, File, FileVersion, MonitoredFolder, BackupJob, BackupLog
+from models import User, File, FileVersion, MonitoredFolder, BackupJob, BackupLog, UploadSession, UsageStats
 from forms import RegistrationForm, LoginForm, UploadFileForm, RenameFileForm, MonitoredFolderForm, ManualBackupForm, BackupSearchForm
 from utils import get_file_extension, allowed_file, create_version_directory, human_readable_size
-from backup_utils import scan_folder, create_backup_job, run_backup_job
+from backup_utils import (scan_folder, create_backup_job, run_backup_job, get_storage_settings, choose_compression,
+                          get_file_mime_type)
+from blob_store import ingest_stream, version_exists, get_version_source
+from archive import MIME_TYPES, archive_name, folder_members, job_members, stream_tar
+from compression import resolve_codec
+from usage import get_usage, set_file_deleted
+from uploads import (UploadError, record_upload, store_stream, create_session, write_chunk, finish_session,
+                     abort_session, received_bytes)
 from scheduler import scheduler
+from metrics import metrics
+from profiler import profiler
 
 
 def register_routes(app):
@@ -68,17 +78,9 @@ def register_routes(app):
     @app.route('/dashboard')
     @login_required
     def dashboard():
-        # Get stats for dashboard
-        total_files = File.query.filter_by(user_id=current_user.id, is_deleted=False).count()
+        # File, version and storage totals are kept up to date as files change
+        usage = get_usage(current_user.id)
         active_folders = MonitoredFolder.query.filter_by(user_id=current_user.id, is_active=True).count()
-        total_versions = FileVersion.query.join(File).filter(File.user_id == current_user.id, File.is_deleted == False).count()
-        
-        # Calculate total storage used
-        storage_query = db.session.query(db.func.sum(File.size)).filter(
-            File.user_id == current_user.id,
-            File.is_deleted == False
-        ).scalar()
-        total_storage = storage_query or 0
         
         # Get recent files
         recent_files = File.query.filter_by(
@@ -101,10 +103,13 @@ def register_routes(app):
             upload_form=upload_form,
             rename_form=rename_form,
             stats={
-                'total_files': total_files,
+                'total_files': usage.file_count,
                 'active_folders': active_folders,
-                'total_versions': total_versions,
-                'total_storage': human_readable_size(total_storage)
+                'total_versions': usage.version_count,
+                'total_storage': human_readable_size(usage.total_size),
+                # Compressed size of all versions, counting content shared between versions
+                # (or with other users) once per version: the logical size, not space on disk
+                'stored_storage': human_readable_size(usage.stored_size)
             }
         )
 
@@ -120,92 +125,22 @@ def register_routes(app):
                 flash('Invalid file type. Allowed types are: txt, pdf, doc, docx, xls, xlsx, jpg, jpeg, png, gif', 'danger')
                 return redirect(url_for('dashboard'))
                 
-            # Secure filename and create unique filename for storage
+            # Secure filename; storage is addressed by content
             original_filename = secure_filename(uploaded_file.filename)
-            file_extension = get_file_extension(original_filename)
-            unique_filename = f"{uuid.uuid4().hex}{file_extension}"
             
-            # Check if this file already exists for the user
-            existing_file = File.query.filter_by(
-                user_id=current_user.id,
-                original_filename=original_filename,
-                is_deleted=False
-            ).first()
+            # Store content, reusing an identical blob if one exists
+            settings = get_storage_settings()
+            blob = ingest_stream(uploaded_file.stream, settings['storage_root'],
+                                 compression=choose_compression(original_filename, settings),
+                                 level=settings['compression_level'], algorithm=settings['hash_algorithm'])
             
-            # If the file already exists, create a new version
-            if existing_file:
-                # Get the latest version number and increment
-                latest_version = FileVersion.query.filter_by(file_id=existing_file.id).order_by(FileVersion.version_number.desc()).first()
-                version_number = latest_version.version_number + 1 if latest_version else 1
-                
-                # Update all previous versions to not be current
-                for version in existing_file.versions:
-                    version.is_current = False
-                
-                # Create new version
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                uploaded_file.save(file_path)
-                
-                # Calculate file hash for integrity verification
-                from backup_utils import calculate_file_hash
-                file_hash = calculate_file_hash(file_path)
-                
-                new_version = FileVersion(
-                    file_id=existing_file.id,
-                    version_number=version_number,
-                    filename=unique_filename,
-                    size=os.path.getsize(file_path),
-                    is_current=True,
-                    checksum=file_hash,
-                    change_reason="Manual upload"
-                )
-                
-                # Update file metadata
-                existing_file.size = os.path.getsize(file_path)
-                existing_file.updated_at = datetime.utcnow()
-                
-                # Add and commit changes
-                db.session.add(new_version)
-                db.session.commit()
-                
-                flash(f'New version of {original_filename} uploaded successfully!', 'success')
+            # A new version if the file already exists, otherwise a new file
+            version = record_upload(current_user.id, original_filename, uploaded_file.content_type, blob)
+            db.session.commit()
             
-            # If the file doesn't exist, create a new file entry
+            if version.version_number > 1:
+                flash(f'New version of {original_filename} uploaded successfully!', 'success')
             else:
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                uploaded_file.save(file_path)
-                
-                # Calculate file hash for integrity verification
-                from backup_utils import calculate_file_hash
-                file_hash = calculate_file_hash(file_path)
-                
-                # Create file record
-                new_file = File(
-                    filename=unique_filename,
-                    original_filename=original_filename,
-                    size=os.path.getsize(file_path),
-                    content_type=uploaded_file.content_type,
-                    user_id=current_user.id,
-                    is_auto_backup=False
-                )
-                
-                db.session.add(new_file)
-                db.session.flush()  # To get the file ID
-                
-                # Create first version
-                new_version = FileVersion(
-                    file_id=new_file.id,
-                    version_number=1,
-                    filename=unique_filename,
-                    size=os.path.getsize(file_path),
-                    is_current=True,
-                    checksum=file_hash,
-                    change_reason="Initial upload"
-                )
-                
-                db.session.add(new_version)
-                db.session.commit()
-                
                 flash(f'File {original_filename} uploaded successfully!', 'success')
                 
             return redirect(url_for('dashboard'))
@@ -214,6 +149,162 @@ def register_routes(app):
         return redirect(url_for('dashboard'))
 
 
+    # Upload API, for clients that send large files. Content is streamed
+    # to storage and hashed on the way; errors are answered with JSON.
+    
+    @app.errorhandler(UploadError)
+    def upload_error(error):
+        return jsonify({'success': False, 'message': str(error)}), error.status
+    
+    def api_upload_filename(filename):
+        original_filename = secure_filename(filename)
+        if not original_filename or not allowed_file(original_filename):
+            raise UploadError('Invalid file type. Allowed types are: txt, pdf, doc, docx, xls, xlsx, jpg, jpeg, png, gif', 415)
+        return original_filename
+    
+    def upload_session_json(session, storage_root):
+        return {
+            'id': session.id,
+            'filename': session.filename,
+            'size': session.size,
+            'offset': received_bytes(storage_root, session),
+            'chunk_size': app.config.get('UPLOAD_CHUNK_SIZE'),
+            'url': url_for('upload_session', session_id=session.id),
+        }
+    
+    def version_json(version):
+        return {
+            'success': True,
+            'file_id': version.file_id,
+            'version_id': version.id,
+            'version_number': version.version_number,
+            'size': version.size,
+            'checksum': version.checksum,
+        }
+
+
+    @app.route('/api/files/<filename>', methods=['PUT'])
+    @login_required
+    def api_put_file(filename):
+        """Upload a whole file as the request body; X-Checksum ("<algorithm>:<hex>") is verified if sent"""
+        original_filename = api_upload_filename(filename)
+        request.max_content_length = app.config.get('UPLOAD_MAX_SIZE')
+        settings = get_storage_settings()
+        version = store_stream(request.stream, current_user.id, original_filename,
+                               get_file_mime_type(original_filename), settings,
+                               compression=choose_compression(original_filename, settings),
+                               checksum=request.headers.get('X-Checksum'))
+        return jsonify(version_json(version)), 201
+
+
+    @app.route('/api/uploads', methods=['POST'])
+    @login_required
+    def api_create_upload():
+        """Start a chunked upload: {"filename": ..., "size": optional, "checksum": optional}"""
+        data = request.get_json()
+        if not isinstance(data, dict) or not data.get('filename'):
+            raise UploadError('filename is required')
+        size = data.get('size')
+        if size is not None and not isinstance(size, int):
+            raise UploadError('size must be an integer')
+        original_filename = api_upload_filename(data['filename'])
+        settings = get_storage_settings()
+        session = create_session(current_user.id, original_filename, get_file_mime_type(original_filename), settings,
+                                 size=size, checksum=data.get('checksum'),
+                                 max_age=app.config.get('UPLOAD_SESSION_MAX_AGE'),
+                                 max_size=app.config.get('UPLOAD_MAX_SIZE'))
+        return jsonify(upload_session_json(session, settings['storage_root'])), 201
+
+
+    @app.route('/api/uploads/<session_id>', methods=['GET'])
+    @login_required
+    def upload_session(session_id):
+        """State of a chunked upload; offset is where to continue"""
+        session = UploadSession.query.filter_by(id=session_id, user_id=current_user.id).first_or_404()
+        return jsonify(upload_session_json(session, app.config['UPLOAD_FOLDER']))
+
+
+    @app.route('/api/uploads/<session_id>', methods=['PUT'])
+    @login_required
+    def api_upload_chunk(session_id):
+        """Write the request body at ?offset=N; answers with the offset to continue from"""
+        session = UploadSession.query.filter_by(id=session_id, user_id=current_user.id).first_or_404()
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            raise UploadError('offset is required')
+        request.max_content_length = app.config.get('UPLOAD_MAX_CHUNK_SIZE')
+        offset = write_chunk(session, offset, request.stream, get_storage_settings(),
+                             max_size=app.config.get('UPLOAD_MAX_SIZE'))
+        return jsonify({'success': True, 'offset': offset})
+
+
+    @app.route('/api/uploads/<session_id>/complete', methods=['POST'])
+    @login_required
+    def api_complete_upload(session_id):
+        """Verify and store a chunked upload: {"checksum": ...} unless given when it was started"""
+        session = UploadSession.query.filter_by(id=session_id, user_id=current_user.id).first_or_404()
+        data = request.get_json(silent=True) or {}
+        settings = get_storage_settings()
+        version = finish_session(session, settings, compression=choose_compression(session.filename, settings),
+                                 checksum=data.get('checksum'))
+        return jsonify(version_json(version)), 201
+
+
+    @app.route('/api/uploads/<session_id>', methods=['DELETE'])
+    @login_required
+    def api_abort_upload(session_id):
+        session = UploadSession.query.filter_by(id=session_id, user_id=current_user.id).first_or_404()
+        abort_session(session, app.config['UPLOAD_FOLDER'])
+        return jsonify({'success': True})
+
+
+    def send_version(version, download_name):
+        """Send a version's content as an attachment.
+        
+        The ETag is the version's checksum, so it is strong and stays valid
+        for as long as the content is the same; conditional requests get a
+        304 and Range requests (resumed downloads) a 206. With DOWNLOAD_OFFLOAD
+        set, uncompressed blobs are handed to the front server, which streams
+        them from UPLOAD_FOLDER itself.
+        """
+        etag = version.checksum or f"version-{version.id}"
+        offload = app.config.get('DOWNLOAD_OFFLOAD')
+        plain = not version.is_chunked and (version.blob is None or not version.blob.compression)
+        
+        if offload and plain:
+            response = Response(mimetype=get_file_mime_type(download_name))
+            response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+            response.set_etag(etag)
+            response.last_modified = version.created_at
+            response.cache_control.no_cache = True
+            # The front server handles Range requests itself
+            response = response.make_conditional(request)
+            if response.status_code != 304:
+                # The body, and its length, come from the front server; Werkzeug
+                # would otherwise set the empty body's length when it sends it
+                del response.headers['Content-Length']
+                response.automatically_set_content_length = False
+                if offload == 'x-accel-redirect':
+                    prefix = app.config.get('DOWNLOAD_ACCEL_PREFIX', '/_blobs/')
+                    response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + version.filename
+                else:
+                    response.headers['X-Sendfile'] = version.get_path()
+            return response
+        
+        response = send_file(
+            get_version_source(version),
+            as_attachment=True,
+            download_name=download_name,
+            etag=etag,
+            last_modified=version.created_at,
+            conditional=False
+        )
+        # Readers for compressed and chunked content don't know their length
+        # up front; the version does, which is what Range handling needs
+        response.content_length = version.size
+        return response.make_conditional(request, accept_ranges=True, complete_length=version.size)
+
+
     @app.route('/download/<int:file_id>')
     @login_required
     def download_file(file_id):
@@ -224,17 +315,11 @@ def register_routes(app):
             flash('Error: File version not found.', 'danger')
             return redirect(url_for('dashboard'))
             
-        file_path = latest_version.get_path()
-        
-        if not os.path.exists(file_path):
+        if not version_exists(latest_version):
             flash('Error: File not found on server.', 'danger')
             return redirect(url_for('dashboard'))
             
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=file.original_filename
-        )
+        return send_version(latest_version, file.original_filename)
 
 
     @app.route('/download-version/<int:version_id>')
@@ -243,17 +328,11 @@ def register_routes(app):
         version = FileVersion.query.filter_by(id=version_id).first_or_404()
         file = File.query.filter_by(id=version.file_id, user_id=current_user.id, is_deleted=False).first_or_404()
         
-        file_path = version.get_path()
-        
-        if not os.path.exists(file_path):
+        if not version_exists(version):
             flash('Error: File version not found on server.', 'danger')
             return redirect(url_for('file_history', file_id=file.id))
             
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=file.original_filename
-        )
+        return send_version(version, file.original_filename)
 
 
     @app.route('/delete/<int:file_id>', methods=['POST'])
@@ -263,13 +342,13 @@ def register_routes(app):
         
         # If it's a regular form submission, handle with redirect
         if not request.is_json:
-            file.is_deleted = True
+            set_file_deleted(file, True)
             db.session.commit()
             flash(f'File {file.original_filename} has been deleted.', 'success')
             return redirect(url_for('dashboard'))
         
         # For AJAX requests, just mark as deleted and return JSON response
-        file.is_deleted = True if not file.is_deleted else False
+        set_file_deleted(file, not file.is_deleted)
         db.session.commit()
         
         status = "deleted" if file.is_deleted else "active"
@@ -288,13 +367,13 @@ def register_routes(app):
         
         # If it's a regular form submission, handle with redirect
         if not request.is_json:
-            file.is_deleted = False
+            set_file_deleted(file, False)
             db.session.commit()
             flash(f'File {file.original_filename} has been restored.', 'success')
             return redirect(url_for('dashboard'))
         
         # For AJAX requests, toggle the restored status and return JSON response
-        file.is_deleted = False
+        set_file_deleted(file, False)
         db.session.commit()
         
         return jsonify({
@@ -367,27 +446,19 @@ def register_routes(app):
         folders = MonitoredFolder.query.filter_by(user_id=current_user.id).order_by(MonitoredFolder.name).all()
         form = MonitoredFolderForm()
         
-        # Get folder stats
-        folder_stats = {}
-        for folder in folders:
-            # Count files from this folder
-            file_count = File.query.filter_by(
-                user_id=current_user.id,
-                source_folder_id=folder.id,
-                is_deleted=False
-            ).count()
-            
-            # Get last backup time
-            last_backup = BackupJob.query.join(BackupLog).filter(
-                BackupJob.user_id == current_user.id,
-                BackupLog.folder_id == folder.id,
-                BackupJob.status == 'completed'
-            ).order_by(BackupJob.created_at.desc()).first()
-            
-            folder_stats[folder.id] = {
-                'file_count': file_count,
-                'last_backup': last_backup.created_at if last_backup else None
+        # File counts come from the usage counters, last backup times from the
+        # folders themselves, so the page takes the same few queries however
+        # many folders and how much backup history there are
+        file_counts = dict(db.session.query(UsageStats.folder_id, UsageStats.file_count).filter(
+            UsageStats.user_id == current_user.id
+        ).all())
+        folder_stats = {
+            folder.id: {
+                'file_count': file_counts.get(folder.id, 0),
+                'last_backup': folder.last_backup_at
             }
+            for folder in folders
+        }
         
         return render_template(
             'monitored_folders.html',
@@ -421,6 +492,7 @@ def register_routes(app):
             
             db.session.add(folder)
             db.session.commit()
+            scheduler.invalidate_folder(folder.id)
             
             flash(f'Folder "{form.name.data}" has been added for monitoring.', 'success')
             
@@ -458,6 +530,7 @@ def register_routes(app):
                 pass
             
             db.session.commit()
+            scheduler.invalidate_folder(folder.id)
             flash(f'Folder "{folder.name}" has been updated.', 'success')
             return redirect(url_for('monitored_folders'))
         
@@ -477,8 +550,16 @@ def register_routes(app):
         if files_count > 0:
             flash(f'Cannot delete folder "{folder.name}" because it has {files_count} files associated with it. Please delete the files first.', 'danger')
         else:
+            UsageStats.query.filter_by(user_id=folder.user_id, folder_id=folder.id).delete()
+            # The folder's jobs go with it (SQLite doesn't enforce the CASCADE). A job that
+            # is running stops at its next commit, as its claim on the row is gone
+            jobs = db.session.query(BackupJob.id).filter_by(folder_id=folder.id).scalar_subquery()
+            BackupLog.query.filter(BackupLog.job_id.in_(jobs)).delete(synchronize_session=False)
+            BackupJob.query.filter_by(folder_id=folder.id).delete(synchronize_session=False)
+            BackupLog.query.filter_by(folder_id=folder.id).update({'folder_id': None}, synchronize_session=False)
             db.session.delete(folder)
             db.session.commit()
+            scheduler.invalidate_folder(folder_id)
             flash(f'Folder "{folder.name}" has been deleted.', 'success')
         
         return redirect(url_for('monitored_folders'))
@@ -498,7 +579,7 @@ def register_routes(app):
             job_name = form.name.data
             
             # Trigger manual backup
-            job_id = scheduler.trigger_manual_backup(folder_id, current_user.id, job_name)
+            job_id = scheduler.trigger_manual_backup(folder_id, current_user.id, job_name, profile=form.profile.data)
             
             if job_id:
                 flash('Manual backup job started. Check the backup jobs page for status.', 'success')
@@ -532,7 +613,7 @@ def register_routes(app):
         # Order by newest first
         jobs = query.order_by(BackupJob.created_at.desc()).all()
         
-        return render_template('backup_jobs.html', jobs=jobs, form=search_form)
+        return render_template('backup_jobs.html', jobs=jobs, form=search_form, queue=scheduler.get_stats())
 
 
     @app.route('/backup-job/<int:job_id>')
@@ -547,7 +628,47 @@ def register_routes(app):
             File.user_id == current_user.id
         ).distinct().all()
         
-        return render_template('backup_job_detail.html', job=job, logs=logs, files=files)
+        return render_template('backup_job_detail.html', job=job, logs=logs, files=files,
+                               format_size=human_readable_size)
+
+
+    def send_archive(members, name):
+        """Stream a tar archive of members; ?compression=gzip or zstd compresses it"""
+        try:
+            codec = resolve_codec(request.args.get('compression'))
+        except ValueError as e:
+            abort(400, description=str(e))
+        settings = get_storage_settings()
+        stream = stream_tar(members, settings['storage_root'], codec, settings['compression_level'],
+                            settings['buffer_size'])
+        response = Response(stream_with_context(stream), mimetype=MIME_TYPES[codec])
+        response.headers.set('Content-Disposition', 'attachment', filename=archive_name(name, codec))
+        return response
+
+
+    @app.route('/export-folder/<int:folder_id>')
+    @login_required
+    def export_folder(folder_id):
+        folder = MonitoredFolder.query.filter_by(id=folder_id, user_id=current_user.id).first_or_404()
+        return send_archive(folder_members(folder), folder.name)
+
+
+    @app.route('/backup-job/<int:job_id>/export')
+    @login_required
+    def export_job(job_id):
+        job = BackupJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+        return send_archive(job_members(job), f"backup-job-{job.id}")
+
+
+    @app.route('/backup-job/<int:job_id>/profile')
+    @login_required
+    def download_job_profile(job_id):
+        job = BackupJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+        path = profiler.job_profile_path(job.profile_file) if job.profile_file else None
+        if not path or not os.path.exists(path):
+            flash('No profile is available for this job.', 'warning')
+            return redirect(url_for('backup_job_detail', job_id=job.id))
+        return send_file(path, mimetype='text/plain', as_attachment=True, download_name=job.profile_file)
 
 
     @app.route('/files')
@@ -596,3 +717,13 @@ def register_routes(app):
             rename_form=RenameFileForm(),
             form=UploadFileForm()
         )
+
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        if not app.config.get('METRICS_ENABLED', True):
+            abort(404)
+        token = app.config.get('METRICS_TOKEN')
+        if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+            abort(401)
+        return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
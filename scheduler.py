@@ -1,20 +1,83 @@
 import threading
 import time
+import heapq
+import queue
+import itertools
 import logging
 import atexit
 from datetime import datetime, timedelta
 from flask import current_app
 from app import db
-from models import MonitoredFolder, BackupJob
+from models import MonitoredFolder, BackupJob, BackupLog
 from backup_utils import create_backup_job, run_backup_job
+from job_queue import (PRIORITY_MANUAL, PRIORITY_SCHEDULED, make_worker_id, enqueue_job,
+                       folder_has_open_job, queue_stats, recover_orphaned_jobs, decode_paths)
+from watcher import watcher
+from blob_store import storage_usage
+from metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+
+class QueuedJob:
+    """A backup job waiting for, or holding, a worker.
+
+    changed_paths is the set of files to look at, or None for a full scan
+    of the folder. resumed is set for a recovered job that will continue
+    from its checkpoint. held counts merged requests whose changes are
+    still being written to the job's row; the job isn't run until they are.
+    """
+
+    def __init__(self, job_id, user_id, folder_id, priority, changed_paths=None, resumed=False):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.folder_id = folder_id
+        self.priority = priority
+        self.changed_paths = changed_paths
+        self.resumed = resumed
+        self.held = 0
+
+    @property
+    def key(self):
+        """(user_id, folder_id): a job without a folder covers all of its user's folders"""
+        return (self.user_id, self.folder_id)
+
+    def merge(self, priority, changed_paths):
+        """Fold another request for the same folder into this job"""
+        self.priority = min(self.priority, priority)
+        if self.changed_paths is not None:
+            if changed_paths is None:
+                self.changed_paths = None
+            else:
+                self.changed_paths.update(changed_paths)
+
+
 class BackupScheduler:
     def __init__(self, app=None):
         self.app = app
         self.stop_event = threading.Event()
         self.scheduler_thread = None
+        self.watcher = watcher
+        # At most one job per folder is queued and one is running. A request
+        # for a folder that already has a queued job is merged into it.
+        self._queue = queue.PriorityQueue()
+        self._queue_lock = threading.Lock()
+        self._sequence = itertools.count()
+        self._queued = {}   # (user_id, folder_id) -> QueuedJob
+        self._running = {}  # (user_id, folder_id) -> QueuedJob
+        self._workers = []
+        self.worker_id = make_worker_id()
+        # Min-heap of (next due time, folder_id) for full scans. _schedule
+        # holds each folder's current entry; anything else in the heap is stale.
+        self._schedule_lock = threading.Lock()
+        self._schedule = {}  # folder_id -> (due, user_id, name, interval)
+        self._due_heap = []
+        self._invalidated = set()
+        self._watch_deadline = None
+        self._next_refresh = 0
+        self._wakeup = threading.Event()
+        self._collecting_metrics = False
+        self.watcher.on_change = self._on_watched_change
         
         if app is not None:
             self.init_app(app)
@@ -30,8 +93,19 @@ class BackupScheduler:
         """Start the backup scheduler thread"""
         if self.scheduler_thread is None or not self.scheduler_thread.is_alive():
             self.stop_event.clear()
+            if not self.uses_workers:
+                self._recover_jobs()
+            if self.app.config.get("FILE_WATCHER_ENABLED", True):
+                self.watcher.start()
             self.scheduler_thread = threading.Thread(target=self._scheduler_run, daemon=True)
             self.scheduler_thread.start()
+            if not self._collecting_metrics:
+                # Queue depth and storage use are reported by the scheduler's
+                # process only, so they aren't counted once per web worker
+                metrics.add_collector(self._collect_queue_metrics)
+                metrics.add_collector(self._collect_storage_metrics,
+                                      self.app.config.get("METRICS_STORAGE_INTERVAL", 300))
+                self._collecting_metrics = True
             logger.info("Backup scheduler started")
     
     def shutdown(self):
@@ -39,11 +113,50 @@ class BackupScheduler:
         if self.scheduler_thread and self.scheduler_thread.is_alive():
             logger.info("Shutting down backup scheduler...")
             self.stop_event.set()
+            self._wakeup.set()
             self.scheduler_thread.join(timeout=5)
+            for worker in self._workers:
+                worker.join(timeout=5)
+            self.watcher.shutdown()
             logger.info("Backup scheduler shutdown complete")
     
+    def _recover_jobs(self):
+        """Resume the jobs an earlier run of the app left unfinished, or fail them.
+        
+        Runs before the scheduler queues anything, so each folder has at
+        most one resumed job; a folder's other leftover jobs are failed, as
+        its next backup covers them.
+        """
+        config = self.app.config
+        with self.app.app_context():
+            try:
+                jobs = recover_orphaned_jobs(config.get("JOB_MAX_ATTEMPTS", 3), config.get("JOB_ORPHAN_SECONDS", 3600),
+                                             self.worker_id, claim=True)
+                with self._queue_lock:
+                    for job in jobs:
+                        if (job.user_id, job.folder_id) in self._queued:
+                            job.status = "failed"
+                            job.finished_at = datetime.utcnow()
+                            db.session.add(BackupLog(message="Backup not run: the folder has an earlier job to resume",
+                                                     level="warning", job_id=job.id))
+                            continue
+                        paths = decode_paths(job.changed_paths)
+                        queued = QueuedJob(job.id, job.user_id, job.folder_id, job.priority,
+                                           set(paths) if paths is not None else None,
+                                           resumed=job.checkpoint_folder_id is not None)
+                        self._queued[queued.key] = queued
+                        self._push(queued)
+                    db.session.commit()
+            except Exception as e:
+                logger.exception(f"Error recovering unfinished backup jobs: {e}")
+                db.session.rollback()
+                return
+        if jobs:
+            self._ensure_workers()
+            logger.info(f"Requeued {len(jobs)} unfinished backup jobs")
+    
     def _scheduler_run(self):
-        """Main scheduler loop that checks for folders needing backups"""
+        """Main scheduler loop: sleeps until the next folder is due or something changes"""
         with self.app.app_context():
             logger.info("Scheduler thread running")
             
@@ -51,59 +164,334 @@ class BackupScheduler:
                 try:
                     # Skip if monitoring is disabled in config
                     if not current_app.config.get("MONITOR_ENABLED", True):
-                        time.sleep(60)  # Check every minute if monitoring is re-enabled
+                        self.stop_event.wait(60)  # Check every minute if monitoring is re-enabled
                         continue
                     
-                    # Get all active folders
-                    folders = MonitoredFolder.query.filter_by(is_active=True).all()
+                    self._wakeup.clear()
+                    if time.monotonic() >= self._next_refresh:
+                        self._reload_all()
+                    self._apply_invalidations()
+                    self._queue_due_folders()
+                    self._queue_watched_changes()
                     
-                    for folder in folders:
-                        # Check if folder needs to be backed up
-                        if self._folder_needs_backup(folder):
-                            logger.info(f"Starting scheduled backup for folder {folder.name} (ID: {folder.id})")
-                            
-                            # Create a new backup job
-                            job_name = f"Scheduled backup of {folder.name} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-                            job = create_backup_job(folder.user_id, name=job_name)
-                            
-                            # Run the backup job in a separate thread to avoid blocking the scheduler
-                            backup_thread = threading.Thread(
-                                target=self._run_backup_job_wrapper,
-                                args=(job.id,),
-                                daemon=True
-                            )
-                            backup_thread.start()
-                    
-                    # Sleep for 1 minute before checking again
-                    time.sleep(60)
+                    # Don't hold a transaction open while sleeping
+                    db.session.rollback()
+                    self._wakeup.wait(self._sleep_time())
                 
                 except Exception as e:
                     logger.exception(f"Error in scheduler loop: {e}")
-                    time.sleep(60)  # Sleep and try again
+                    self.stop_event.wait(60)  # Sleep and try again
     
-    def _folder_needs_backup(self, folder):
-        """Check if a folder needs to be backed up based on its backup interval"""
-        # If folder has never been scanned, it needs a backup
-        if folder.last_scan_at is None:
-            return True
+    def invalidate_folder(self, folder_id):
+        """Re-read a folder's schedule (after it was added, edited or deleted) and wake the scheduler"""
+        with self._schedule_lock:
+            self._invalidated.add(folder_id)
+        self._wakeup.set()
+    
+    def _on_watched_change(self):
+        # Called by the watcher thread; changes are collected for a short
+        # while so that a burst of writes becomes a single job
+        with self._schedule_lock:
+            if self._watch_deadline is None:
+                self._watch_deadline = time.monotonic() + self.app.config.get("FILE_WATCHER_POLL_INTERVAL", 5)
+        self._wakeup.set()
+    
+    def _reload_all(self):
+        """Rebuild the due-time heap from the database.
+        
+        Normally the heap is kept current by invalidate_folder; the periodic
+        reload catches edits made by other processes.
+        """
+        folders = MonitoredFolder.query.filter_by(is_active=True).populate_existing().all()
+        self.watcher.sync(folders)
+        with self._schedule_lock:
+            self._schedule.clear()
+            self._due_heap = []
+            self._invalidated.clear()
+            for folder in folders:
+                self._schedule_folder(folder)
+        self._next_refresh = time.monotonic() + self.app.config.get("SCHEDULER_REFRESH_INTERVAL", 600)
+        if self.watcher.changed_folders():
+            self._on_watched_change()
+    
+    def _apply_invalidations(self):
+        with self._schedule_lock:
+            folder_ids, self._invalidated = self._invalidated, set()
+        for folder_id in folder_ids:
+            folder = db.session.get(MonitoredFolder, folder_id, populate_existing=True)
+            with self._schedule_lock:
+                self._schedule.pop(folder_id, None)
+                if folder is not None and folder.is_active:
+                    self._schedule_folder(folder)
+            if folder is not None and folder.is_active:
+                self.watcher.watch(folder.id, folder.path)
+            else:
+                self.watcher.unwatch(folder_id)
+        if folder_ids and self.watcher.changed_folders():
+            self._on_watched_change()
+    
+    def _schedule_folder(self, folder):
+        """Set a folder's next due time; called with _schedule_lock held"""
+        due = self._next_due(folder)
+        self._schedule[folder.id] = (due, folder.user_id, folder.name, timedelta(minutes=folder.backup_interval))
+        # Superseded heap entries are left in place and skipped when popped
+        heapq.heappush(self._due_heap, (due, folder.id))
+    
+    def _queue_due_folders(self):
+        now = datetime.utcnow()
+        due_folders = []
+        with self._schedule_lock:
+            while self._due_heap and self._due_heap[0][0] <= now:
+                due, folder_id = heapq.heappop(self._due_heap)
+                entry = self._schedule.get(folder_id)
+                if entry is None or entry[0] != due:
+                    continue
+                # Provisional next run; the finished job invalidates the
+                # folder so the real last_scan_at is used
+                _, user_id, name, interval = entry
+                self._schedule[folder_id] = (now + interval, user_id, name, interval)
+                heapq.heappush(self._due_heap, (now + interval, folder_id))
+                due_folders.append((folder_id, user_id, name))
         
-        # Calculate the next backup time based on the interval
-        interval_minutes = folder.backup_interval
-        next_backup_time = folder.last_scan_at + timedelta(minutes=interval_minutes)
+        for folder_id, user_id, name in due_folders:
+            logger.info(f"Queueing scheduled backup for folder {name} (ID: {folder_id})")
+            job_name = f"Scheduled backup of {name} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            job_id = self.enqueue(folder_id, user_id, job_name, PRIORITY_SCHEDULED)
+            # A full scan that hasn't started covers whatever the watcher has queued. One
+            # already running (the request was merged into it) may be past those paths, so
+            # they are left for a follow-up job.
+            if self._job_status(job_id) == 'pending':
+                self.watcher.drain(folder_id)
+    
+    def _queue_watched_changes(self):
+        with self._schedule_lock:
+            if self._watch_deadline is None or time.monotonic() < self._watch_deadline:
+                return
+            self._watch_deadline = None
         
-        # If the next backup time is in the past, the folder needs a backup
-        return datetime.utcnow() >= next_backup_time
+        for folder_id in self.watcher.changed_folders():
+            with self._schedule_lock:
+                entry = self._schedule.get(folder_id)
+            if entry is None:
+                continue
+            _, user_id, name, _ = entry
+            if self.is_queued_or_running(folder_id, user_id):
+                # Picked up once the folder's current job is done
+                self._on_watched_change()
+                continue
+            paths = self.watcher.drain(folder_id)
+            if paths is None:
+                logger.info(f"Queueing full rescan of folder {name} (ID: {folder_id}); watched changes may have been missed")
+                job_name = f"Rescan of {name} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            else:
+                logger.info(f"Queueing backup of {len(paths)} changed paths in folder {name} (ID: {folder_id})")
+                job_name = f"Changes in {name} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            self.enqueue(folder_id, user_id, job_name, PRIORITY_SCHEDULED, paths)
     
-    def _run_backup_job_wrapper(self, job_id):
+    def _job_status(self, job_id):
+        job = db.session.get(BackupJob, job_id, populate_existing=True)
+        return job.status if job is not None else None
+    
+    def _sleep_time(self):
+        """Seconds until the next folder is due or the watcher's changes should be collected"""
+        timeouts = [self.app.config.get("SCHEDULER_REFRESH_INTERVAL", 600)]
+        with self._schedule_lock:
+            if self._due_heap:
+                timeouts.append((self._due_heap[0][0] - datetime.utcnow()).total_seconds())
+            if self._watch_deadline is not None:
+                timeouts.append(self._watch_deadline - time.monotonic())
+        return max(min(timeouts), 0)
+    
+    def enqueue(self, folder_id, user_id, job_name, priority=PRIORITY_SCHEDULED, changed_paths=None, profile=False):
+        """Queue a backup of a folder and return the ID of the job that will cover it.
+        
+        If the folder already has a queued job the request is merged into it
+        (taking the higher priority), and a full-scan request for a folder
+        whose full scan is already running is merged into the running job.
+        profile asks for the job to run under the profiler; it has no effect
+        on a job that is already running. With BACKUP_EXECUTION = "workers" the job goes into the shared
+        database queue for worker.py processes instead. Must be called with
+        an app context.
+        """
+        if self.uses_workers:
+            return enqueue_job(user_id, folder_id, job_name, priority, changed_paths, profile)
+        
+        self._ensure_workers()
+        paths = set(changed_paths) if changed_paths is not None else None
+        
+        key = (user_id, folder_id)
+        job = None
+        while True:
+            with self._queue_lock:
+                merged, changes = self._merge_request(key, priority, paths, profile)
+                if merged is None and job is not None:
+                    queued = QueuedJob(job.id, user_id, folder_id, priority, paths)
+                    self._queued[key] = queued
+                    # A folder's next job only becomes runnable once its current one finishes
+                    if key not in self._running:
+                        self._push(queued)
+                    return job.id
+            if merged is not None:
+                if changes:
+                    self._write_merged(merged, changes)
+                if job is not None:
+                    # Another request for the folder was queued while this job was being created
+                    db.session.delete(job)
+                    db.session.commit()
+                return merged.job_id
+            # Created outside the queue lock, so other enqueues and the workers don't wait
+            # on the commit; claimed by this process up front so worker.py processes leave it alone
+            job = create_backup_job(user_id, name=job_name, is_manual=priority == PRIORITY_MANUAL,
+                                    folder_id=folder_id, claimed_by=self.worker_id, profile=profile)
+    
+    def _merge_request(self, key, priority, paths, profile):
+        """Merge a request into the folder's queued or running job.
+        
+        Returns (that job, changes to write to its row), or (None, None) if
+        the request needs a job of its own. A queued job with changes to
+        write is held until _write_merged has written them. Must be called
+        with the queue lock held.
+        """
+        queued = self._queued.get(key)
+        if queued:
+            old_priority = queued.priority
+            queued.merge(priority, paths)
+            changes = {'profile': True} if profile else {}
+            if priority == PRIORITY_MANUAL:
+                changes['is_manual'] = True
+            if queued.resumed:
+                # The job would skip everything before its checkpoint,
+                # so it starts over to cover this request as well
+                changes.update(checkpoint_folder_id=None, checkpoint_path=None, checkpoint_at=None)
+                queued.resumed = False
+            if changes:
+                queued.held += 1
+            elif queued.priority != old_priority and key not in self._running:
+                self._push(queued)
+            return queued, changes
+        
+        running = self._running.get(key)
+        if running and running.changed_paths is None and paths is None:
+            return running, None
+        return None, None
+    
+    def _write_merged(self, queued, changes):
+        """Write a merged request's changes to a held job's row, then let the job run"""
+        try:
+            BackupJob.query.filter_by(id=queued.job_id).update(changes)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            with self._queue_lock:
+                queued.held -= 1
+                if not queued.held and self._queued.get(queued.key) is queued and queued.key not in self._running:
+                    self._push(queued)
+    
+    @property
+    def uses_workers(self):
+        """Whether jobs are run by separate worker.py processes rather than in this one"""
+        return self.app.config.get("BACKUP_EXECUTION", "local") == "workers"
+    
+    def is_queued_or_running(self, folder_id, user_id):
+        if self.uses_workers:
+            return folder_has_open_job(folder_id)
+        with self._queue_lock:
+            return (user_id, folder_id) in self._queued or (user_id, folder_id) in self._running
+    
+    def get_stats(self):
+        """Queue depth and in-flight job counts"""
+        if self.uses_workers:
+            return queue_stats()
+        with self._queue_lock:
+            return {
+                'queued': len(self._queued),
+                'running': len(self._running),
+                'workers': len(self._workers),
+            }
+    
+    def _collect_queue_metrics(self):
+        stats = self.get_stats()
+        metrics.jobs_queued.set(stats['queued'])
+        metrics.jobs_running.set(stats['running'])
+        db.session.remove()
+    
+    def _collect_storage_metrics(self):
+        count, stored = storage_usage()
+        metrics.storage_blobs.set(count)
+        metrics.storage_bytes.set(stored)
+        db.session.remove()
+    
+    def _push(self, queued):
+        # Entries are never removed from the heap; ones that no longer match
+        # the folder's queued job (merged or re-prioritised) are skipped by _take
+        self._queue.put((queued.priority, next(self._sequence), queued))
+    
+    def _take(self, timeout):
+        """Block until a job is runnable and mark it running"""
+        while True:
+            priority, _, queued = self._queue.get(timeout=timeout)
+            with self._queue_lock:
+                # Held jobs are pushed again once their row has been written
+                if self._queued.get(queued.key) is queued and queued.priority == priority and not queued.held:
+                    del self._queued[queued.key]
+                    self._running[queued.key] = queued
+                    return queued
+    
+    def _finish(self, queued):
+        with self._queue_lock:
+            del self._running[queued.key]
+            follow_up = self._queued.get(queued.key)
+            if follow_up and not follow_up.held:
+                self._push(follow_up)
+        # The job moved the folder's last_scan_at (every folder's, for a job without one)
+        if queued.folder_id is None:
+            self._next_refresh = 0
+            self._wakeup.set()
+        else:
+            self.invalidate_folder(queued.folder_id)
+    
+    def _ensure_workers(self):
+        with self._queue_lock:
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            count = max(1, self.app.config.get("BACKUP_MAX_CONCURRENT_JOBS", 2))
+            while len(self._workers) < count:
+                worker = threading.Thread(target=self._worker_run, name=f"backup-worker-{len(self._workers)}",
+                                          daemon=True)
+                worker.start()
+                self._workers.append(worker)
+    
+    def _worker_run(self):
+        while not self.stop_event.is_set():
+            try:
+                queued = self._take(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                paths = sorted(queued.changed_paths) if queued.changed_paths is not None else None
+                self._run_backup_job_wrapper(queued.job_id, paths)
+            finally:
+                self._finish(queued)
+    
+    def _next_due(self, folder):
+        """When a folder is next due for a full backup, based on its backup interval"""
+        # If folder has never been scanned, it needs a backup now
+        if folder.last_scan_at is None:
+            return datetime.utcnow()
+        return folder.last_scan_at + timedelta(minutes=folder.backup_interval)
+    
+    def _run_backup_job_wrapper(self, job_id, changed_paths=None):
         """Wrapper to run a backup job with app context"""
         with self.app.app_context():
             try:
-                run_backup_job(job_id)
+                # Jobs are claimed by this process, so one deleted or failed meanwhile stops
+                run_backup_job(job_id, changed_paths, self.worker_id)
             except Exception as e:
                 logger.exception(f"Error running backup job {job_id}: {e}")
     
-    def trigger_manual_backup(self, folder_id, user_id, job_name=None):
-        """Trigger a manual backup for a specific folder"""
+    def trigger_manual_backup(self, folder_id, user_id, job_name=None, profile=False):
+        """Trigger a manual backup for a specific folder, optionally under the profiler"""
         with self.app.app_context():
             try:
                 # Create a default job name if none is provided
@@ -111,18 +499,8 @@ class BackupScheduler:
                     folder = MonitoredFolder.query.get(folder_id)
                     job_name = f"Manual backup of {folder.name} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
                 
-                # Create a new backup job
-                job = create_backup_job(user_id, name=job_name, is_manual=True)
-                
-                # Run the backup job in a separate thread
-                backup_thread = threading.Thread(
-                    target=self._run_backup_job_wrapper,
-                    args=(job.id,),
-                    daemon=True
-                )
-                backup_thread.start()
-                
-                return job.id
+                # Manual jobs go ahead of scheduled ones
+                return self.enqueue(folder_id, user_id, job_name, PRIORITY_MANUAL, profile=profile)
             
             except Exception as e:
                 logger.exception(f"Error triggering manual backup for folder {folder_id}: {e}")
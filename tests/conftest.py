@@ -0,0 +1,86 @@
+import os
+import tempfile
+import pytest
+
+# app reads its configuration when it is imported, so the database and
+# metrics settings have to be in place before any test module imports it
+_workdir = tempfile.mkdtemp(prefix="backup-tests-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_workdir, "test.db")
+os.environ["METRICS_ENABLED"] = "false"
+
+from app import app as flask_app, db  # noqa: E402
+from models import User, MonitoredFolder  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    """The app with an empty database and its own storage directory, in an app context"""
+    saved = dict(flask_app.config)
+    storage = tmp_path / "storage"
+    storage.mkdir()
+    flask_app.config.update(
+        TESTING=True,
+        WTF_CSRF_ENABLED=False,
+        UPLOAD_FOLDER=str(storage),
+        BACKUP_WORKERS=2,
+        COMPRESSION="none",
+    )
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+        db.drop_all()
+    flask_app.config.clear()
+    flask_app.config.update(saved)
+
+
+@pytest.fixture
+def user(app):
+    user = User(username="alice", email="alice@example.com")
+    user.set_password("password1")
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def source(tmp_path):
+    """Directory to back up"""
+    path = tmp_path / "source"
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def folder(user, source):
+    folder = MonitoredFolder(name="docs", path=str(source), user_id=user.id, backup_interval=15)
+    db.session.add(folder)
+    db.session.commit()
+    return folder
+
+
+@pytest.fixture
+def client(app, user):
+    """A test client logged in as user"""
+    client = app.test_client()
+    client.post("/login", data={"email": user.email, "password": "password1"})
+    return client
+
+
+def write_file(directory, rel_path, data):
+    path = os.path.join(directory, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def read_version(version):
+    """A version's content, read back from storage the way downloads do"""
+    from blob_store import get_version_source
+    source = get_version_source(version)
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            return f.read()
+    with source:
+        return source.read()
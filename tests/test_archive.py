@@ -0,0 +1,70 @@
+import io
+import os
+import tarfile
+from models import File, FileVersion
+from backup_utils import create_backup_job, run_backup_job
+from conftest import write_file
+
+
+def _backup(user, folder):
+    job = create_backup_job(user.id, folder_id=folder.id)
+    assert run_backup_job(job.id)
+    return job
+
+
+def _read_archive(data, mode="r:"):
+    with tarfile.open(fileobj=io.BytesIO(data), mode=mode) as tar:
+        return {member.name: (tar.extractfile(member).read(), member.mtime) for member in tar.getmembers()}
+
+
+def test_folder_export_holds_the_current_version_of_every_file(app, user, folder, source, client):
+    long_path = "/".join(["directory-with-a-long-name"] * 8) + "/file.txt"
+    a = write_file(source, "a.txt", b"first")
+    write_file(source, long_path, b"deep")  # Too long for a plain ustar header
+    _backup(user, folder)
+    with open(a, "wb") as f:
+        f.write(b"second")
+    os.utime(a, ns=(0, 0))
+    _backup(user, folder)
+
+    for compression, mode in (("", "r:"), ("gzip", "r:gz")):
+        response = client.get(f"/export-folder/{folder.id}?compression={compression}")
+        assert response.status_code == 200
+        suffix = ".gz" if compression else ""
+        assert f"filename=docs.tar{suffix}" in response.headers["Content-Disposition"]
+        members = _read_archive(response.data, mode)
+        assert set(members) == {"docs/a.txt", f"docs/{long_path}"}
+        assert members["docs/a.txt"][0] == b"second"
+        assert members[f"docs/{long_path}"][0] == b"deep"
+        if not compression:
+            assert len(response.data) % tarfile.RECORDSIZE == 0
+
+    assert client.get(f"/export-folder/{folder.id}?compression=rar").status_code == 400
+
+
+def test_job_export_holds_the_versions_the_job_left(app, user, folder, source, client):
+    a = write_file(source, "a.txt", b"first")
+    write_file(source, "b.txt", b"bee")
+    os.utime(a, ns=(1_000_000_000, 1_000_000_000))
+    first = _backup(user, folder)
+    with open(a, "wb") as f:
+        f.write(b"second")
+    os.utime(a, ns=(2_000_000_000, 2_000_000_000))
+    second = _backup(user, folder)
+
+    members = _read_archive(client.get(f"/backup-job/{first.id}/export").data)
+    assert members == {"docs/a.txt": (b"first", 1), "docs/b.txt": (b"bee", members["docs/b.txt"][1])}
+    # b.txt was unchanged, so the second job did not back it up
+    assert _read_archive(client.get(f"/backup-job/{second.id}/export").data) == {"docs/a.txt": (b"second", 2)}
+
+
+def test_files_missing_from_storage_are_left_out(app, user, folder, source, client):
+    write_file(source, "a.txt", b"kept")
+    write_file(source, "b.txt", b"lost")
+    _backup(user, folder)
+    lost = FileVersion.query.join(File).filter(File.source_path == "b.txt").one()
+    os.remove(lost.get_path())
+
+    members = _read_archive(client.get(f"/export-folder/{folder.id}").data)
+    assert list(members) == ["docs/a.txt"]
+    assert members["docs/a.txt"][0] == b"kept"
@@ -0,0 +1,37 @@
+import os
+from collections import Counter
+from sqlalchemy import event
+from app import db
+from models import File, FileVersion
+from backup_utils import create_backup_job, run_backup_job
+from conftest import read_version, write_file
+
+
+def _count_inserts(statements):
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO"):
+            statements[statement.split()[2].strip('"')] += 1
+    return before_cursor_execute
+
+
+def test_a_batch_is_written_with_one_insert_per_table(app, user, folder, source):
+    app.config.update(BACKUP_COMMIT_BATCH_SIZE=500, BACKUP_COMMIT_INTERVAL=3600)
+    contents = {f"f{i:03}.txt": os.urandom(100) for i in range(100)}
+    for rel_path, data in contents.items():
+        write_file(source, rel_path, data)
+    job = create_backup_job(user.id, folder_id=folder.id)
+
+    statements = Counter()
+    listener = _count_inserts(statements)
+    event.listen(db.engine, "before_cursor_execute", listener)
+    try:
+        assert run_backup_job(job.id)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", listener)
+
+    assert statements["file"] == 1
+    assert statements["file_version"] == 1
+    # Each file got its own version, with the right content
+    for file in File.query:
+        version = FileVersion.query.filter_by(file_id=file.id).one()
+        assert read_version(version) == contents[file.source_path]
@@ -0,0 +1,88 @@
+import io
+import os
+from app import db
+from models import Blob, File, FileVersion
+from backup_utils import create_backup_job, run_backup_job
+from blob_store import ingest_stream
+from conftest import read_version, write_file
+
+
+def _blob_files(storage_root):
+    return [name for _, _, names in os.walk(os.path.join(storage_root, "blobs")) for name in names
+            if name != "ALGORITHM"]
+
+
+def test_identical_files_share_one_blob(app, user, folder, source):
+    data = os.urandom(50_000)
+    write_file(source, "a.bin", data)
+    write_file(source, "nested/b.bin", data)
+    job = create_backup_job(user.id, folder_id=folder.id)
+    assert run_backup_job(job.id)
+
+    versions = FileVersion.query.all()
+    assert len(versions) == 2
+    assert len({v.blob_id for v in versions}) == 1
+    blob = db.session.get(Blob, versions[0].blob_id)
+    assert blob.ref_count == 2
+    assert blob.size == len(data)
+    assert len(_blob_files(app.config["UPLOAD_FOLDER"])) == 1
+    assert all(read_version(v) == data for v in versions)
+
+
+def test_new_content_gets_its_own_blob(app, user, folder, source):
+    path = write_file(source, "a.txt", b"first")
+    job = create_backup_job(user.id, folder_id=folder.id)
+    assert run_backup_job(job.id)
+
+    with open(path, "wb") as f:
+        f.write(b"second version")
+    os.utime(path, ns=(0, 0))  # A different mtime, so the change is noticed whatever the clock resolution
+    job = create_backup_job(user.id, folder_id=folder.id)
+    assert run_backup_job(job.id)
+
+    file = File.query.one()
+    versions = FileVersion.query.filter_by(file_id=file.id).order_by(FileVersion.version_number).all()
+    assert [read_version(v) for v in versions] == [b"first", b"second version"]
+    assert Blob.query.count() == 2
+    assert len(_blob_files(app.config["UPLOAD_FOLDER"])) == 2
+
+
+def test_ingesting_stored_content_reuses_the_blob(app):
+    storage_root = app.config["UPLOAD_FOLDER"]
+    first = ingest_stream(io.BytesIO(b"same bytes"), storage_root)
+    db.session.commit()
+    second = ingest_stream(io.BytesIO(b"same bytes"), storage_root)
+    db.session.commit()
+    assert first.id == second.id
+    assert Blob.query.count() == 1
+    assert len(_blob_files(storage_root)) == 1
+
+
+
+def test_chunked_versions_round_trip_and_share_chunks(app, user, folder, source):
+    app.config.update(CHUNKED_STORAGE_ENABLED=True, CHUNKED_STORAGE_MIN_SIZE=100_000, CHUNK_AVG_SIZE=16 * 1024)
+    data = os.urandom(1_000_000)
+    path = write_file(source, "big.bin", data)
+    write_file(source, "small.txt", b"below the chunking threshold")
+    job = create_backup_job(user.id, folder_id=folder.id)
+    assert run_backup_job(job.id)
+
+    first = FileVersion.query.filter_by(is_chunked=True).one()
+    assert first.get_path() is None
+    assert len(first.chunks) > 1
+    assert sum(chunk.size for chunk in first.chunks) == len(data)
+    assert read_version(first) == data
+    blobs = Blob.query.count()
+
+    appended = data + os.urandom(20_000)
+    with open(path, "ab") as f:
+        f.write(appended[len(data):])
+    os.utime(path, ns=(0, 0))
+    job = create_backup_job(user.id, folder_id=folder.id)
+    assert run_backup_job(job.id)
+
+    second = FileVersion.query.filter_by(is_chunked=True, version_number=2).one()
+    assert read_version(second) == appended
+    assert read_version(first) == data
+    # Only the chunks at the end changed
+    assert Blob.query.count() - blobs < len(second.chunks)
@@ -0,0 +1,75 @@
+import os
+from sqlalchemy import update
+from app import db
+from models import FileVersion
+from backup_utils import adopt_source_stat, create_backup_job, run_backup_job, should_backup_file
+from folder_index import FolderIndex
+from conftest import write_file
+
+
+def _backup(user, folder):
+    job = create_backup_job(user.id, folder_id=folder.id)
+    assert run_backup_job(job.id)
+
+
+def _forget_source_stats():
+    """Make every version look like it was taken before stats were recorded"""
+    db.session.execute(update(FileVersion).values(source_size=None, source_mtime_ns=None,
+                                                  source_inode=None, source_ctime_ns=None))
+    db.session.commit()
+
+
+def test_unchanged_files_are_skipped_and_stat_changes_detected(user, folder, source):
+    a = write_file(source, "a.txt", b"same")
+    b = write_file(source, "b.txt", b"size")
+    _backup(user, folder)
+    assert should_backup_file(folder.id, a) == (False, None)
+    assert should_backup_file(folder.id, str(source / "new.txt")) == (False, None)  # Not there
+
+    os.utime(a, ns=(0, 0))
+    with open(b, "ab") as f:
+        f.write(b" grew")
+    index = FolderIndex.load(folder)
+    for path in (a, b):
+        assert should_backup_file(folder.id, path) == (True, None)
+        assert should_backup_file(folder.id, path, index) == (True, None)
+
+    _backup(user, folder)
+    assert FileVersion.query.count() == 4
+    _backup(user, folder)
+    assert FileVersion.query.count() == 4
+
+
+def test_legacy_versions_are_compared_by_content_and_adopted_by_the_caller(user, folder, source):
+    same = write_file(source, "same.txt", b"unchanged")
+    edited = write_file(source, "edited.txt", b"before")
+    _backup(user, folder)
+    _forget_source_stats()
+    with open(edited, "wb") as f:
+        f.write(b"after!")  # Same size, different content
+
+    assert should_backup_file(folder.id, edited) == (True, None)
+    changed, adopt = should_backup_file(folder.id, same)
+    assert not changed
+    entry, st = adopt
+    # Checking persisted nothing
+    db.session.rollback()
+    assert FileVersion.query.filter(FileVersion.source_mtime_ns.isnot(None)).count() == 0
+
+    index = FolderIndex.load(folder)
+    adopt_source_stat(entry, st, index, "same.txt")
+    db.session.commit()
+    assert index.get("same.txt").source_mtime_ns == st.st_mtime_ns
+    assert db.session.get(FileVersion, entry.version_id).source_mtime_ns == st.st_mtime_ns
+    assert should_backup_file(folder.id, same) == (False, None)
+
+
+def test_jobs_adopt_legacy_stats_without_new_versions(user, folder, source):
+    write_file(source, "a.txt", b"content")
+    _backup(user, folder)
+    _forget_source_stats()
+
+    _backup(user, folder)
+    db.session.expire_all()
+    version = FileVersion.query.one()
+    assert version.source_mtime_ns == os.stat(source / "a.txt").st_mtime_ns
@@ -0,0 +1,60 @@
+import pytest
+from models import FileVersion
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def version(client):
+    assert client.put("/api/files/data.pdf", data=DATA).status_code == 201
+    return FileVersion.query.one()
+
+
+def test_conditional_get_answers_304_while_the_content_is_the_same(client, version):
+    response = client.get(f"/download-version/{version.id}")
+    assert response.status_code == 200
+    assert response.data == DATA
+    etag = response.headers["ETag"]
+    assert etag == f'"{version.checksum}"'
+    assert "attachment" in response.headers["Content-Disposition"]
+
+    response = client.get(f"/download-version/{version.id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert client.get(f"/download-version/{version.id}", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_range_requests_resume_downloads(app, client, compression):
+    app.config["COMPRESSION"] = compression
+    assert client.put("/api/files/data.pdf", data=DATA).status_code == 201
+    version = FileVersion.query.one()
+
+    response = client.get(f"/download-version/{version.id}", headers={"Range": "bytes=1000-1999"})
+    assert response.status_code == 206
+    assert response.data == DATA[1000:2000]
+    assert response.headers["Content-Range"] == f"bytes 1000-1999/{len(DATA)}"
+    assert response.headers["Content-Length"] == "1000"
+
+    response = client.get(f"/download-version/{version.id}", headers={"Range": "bytes=-100"})
+    assert response.status_code == 206
+    assert response.data == DATA[-100:]
+
+    response = client.get(f"/download-version/{version.id}", headers={"Range": f"bytes={len(DATA)}-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{len(DATA)}"
+
+
+def test_offloaded_downloads_leave_the_body_to_the_front_server(app, client, version):
+    app.config.update(DOWNLOAD_OFFLOAD="x-accel-redirect", DOWNLOAD_ACCEL_PREFIX="/_blobs/")
+
+    response = client.get(f"/download-version/{version.id}")
+    assert response.status_code == 200
+    assert response.headers["X-Accel-Redirect"] == f"/_blobs/{version.filename}"
+    assert "Content-Length" not in response.headers
+    assert response.data == b""
+    assert response.headers["ETag"] == f'"{version.checksum}"'
+
+    response = client.get(f"/download-version/{version.id}", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert "X-Accel-Redirect" not in response.headers
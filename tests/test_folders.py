@@ -0,0 +1,79 @@
+import pytest
+from flask import template_rendered
+from sqlalchemy import event
+from app import db
+from models import BackupJob, BackupLog, MonitoredFolder
+from backup_utils import create_backup_job, run_backup_job
+from job_queue import LeaseLostError, claim_job, confirm_claim, enqueue_job
+from conftest import write_file
+
+
+def test_deleting_a_folder_deletes_its_jobs(user, folder, client, tmp_path):
+    other = MonitoredFolder(name="photos", path=str(tmp_path), user_id=user.id)
+    db.session.add(other)
+    db.session.commit()
+    running = enqueue_job(user.id, folder.id, "running")
+    assert claim_job("worker-a", 60) == running
+    pending = enqueue_job(user.id, folder.id, "follow-up", changed_paths=["a.txt"])
+    kept = enqueue_job(user.id, other.id, "other folder")
+    user_wide = BackupJob(name="everything", user_id=user.id, status="completed")
+    db.session.add(user_wide)
+    db.session.commit()
+    db.session.add_all([BackupLog(message="ran", job_id=running),
+                        BackupLog(message="scanned", job_id=user_wide.id, folder_id=folder.id)])
+    db.session.commit()
+    folder_id = folder.id
+
+    assert client.post(f"/delete-folder/{folder_id}").status_code == 302
+
+    db.session.expire_all()
+    assert db.session.get(MonitoredFolder, folder_id) is None
+    # Nothing is left to be taken for a backup of every folder
+    assert {job.id for job in BackupJob.query} == {kept, user_wide.id}
+    assert db.session.get(BackupJob, pending) is None
+    assert BackupLog.query.filter_by(job_id=running).count() == 0
+    assert BackupLog.query.filter_by(job_id=user_wide.id).one().folder_id is None
+    # The worker running the folder's job finds its claim gone at its next commit
+    with pytest.raises(LeaseLostError):
+        confirm_claim(running, "worker-a")
+
+
+def _folders_page(app, client):
+    """Render the monitored folders page; returns its folder_stats and the number of statements it ran"""
+    rendered = []
+    statements = []
+
+    def on_render(sender, template, context, **extra):
+        rendered.append(context)
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        with template_rendered.connected_to(on_render, app):
+            assert client.get("/monitored-folders").status_code == 200
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    return rendered[0]["folder_stats"], len(statements)
+
+
+def test_folder_stats_take_the_same_queries_however_many_folders(app, user, folder, source, client, tmp_path):
+    write_file(source, "a.txt", b"a")
+    write_file(source, "sub/b.txt", b"b")
+    job = create_backup_job(user.id, folder_id=folder.id)
+    assert run_backup_job(job.id)
+    db.session.expire_all()
+
+    stats, queries = _folders_page(app, client)
+    assert stats[folder.id]["file_count"] == 2
+    assert folder.last_backup_at is not None
+    assert stats[folder.id]["last_backup"] == folder.last_backup_at
+
+    others = [MonitoredFolder(name=f"other {i}", path=str(tmp_path), user_id=user.id) for i in range(5)]
+    db.session.add_all(others)
+    db.session.commit()
+    stats, more_queries = _folders_page(app, client)
+    assert more_queries == queries
+    assert stats[others[0].id] == {"file_count": 0, "last_backup": None}
+    assert stats[folder.id]["file_count"] == 2
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import update
+from app import db
+from models import BackupJob, BackupLog, FileVersion, MonitoredFolder
+from backup_utils import run_backup_job
+from job_queue import (LeaseLostError, claim_job, confirm_claim, enqueue_job, reclaim_expired_jobs,
+                       renew_lease)
+from conftest import write_file
+
+
+def _job(job_id):
+    db.session.expire_all()
+    return db.session.get(BackupJob, job_id)
+
+
+def _expire_lease(job_id):
+    db.session.execute(update(BackupJob).where(BackupJob.id == job_id)
+                       .values(lease_expires_at=datetime.utcnow() - timedelta(seconds=1)))
+    db.session.commit()
+
+
+@pytest.fixture
+def other_folder(user, tmp_path):
+    folder = MonitoredFolder(name="photos", path=str(tmp_path), user_id=user.id)
+    db.session.add(folder)
+    db.session.commit()
+    return folder
+
+
+def test_each_job_is_claimed_once(user, folder, other_folder):
+    first = enqueue_job(user.id, folder.id, "first")
+    second = enqueue_job(user.id, other_folder.id, "second")
+
+    claimed = {claim_job("worker-a", 60), claim_job("worker-b", 60)}
+    assert claimed == {first, second}
+    assert claim_job("worker-c", 60) is None
+    assert _job(first).status == "running"
+    assert _job(first).attempts == 1
+
+
+def test_folder_with_a_running_job_waits(user, folder):
+    running = enqueue_job(user.id, folder.id, "full scan")
+    assert claim_job("worker-a", 60) == running
+    follow_up = enqueue_job(user.id, folder.id, "changes", changed_paths=["a.txt"])
+    assert follow_up != running
+
+    assert claim_job("worker-b", 60) is None
+    _job(running).status = "completed"
+    db.session.commit()
+    assert claim_job("worker-b", 60) == follow_up
+
+
+def test_expired_lease_is_reclaimed(user, folder):
+    job_id = enqueue_job(user.id, folder.id, "job")
+    assert claim_job("worker-a", 60) == job_id
+    assert renew_lease(job_id, "worker-a", 60)
+
+    _expire_lease(job_id)
+    assert reclaim_expired_jobs(max_attempts=3) == 1
+    job = _job(job_id)
+    assert (job.status, job.claimed_by) == ("pending", None)
+    assert BackupLog.query.filter_by(job_id=job_id, level="warning").count() == 1
+
+    # The old worker finds out at its next heartbeat or commit
+    assert claim_job("worker-b", 60) == job_id
+    assert not renew_lease(job_id, "worker-a", 60)
+    with pytest.raises(LeaseLostError):
+        confirm_claim(job_id, "worker-a")
+    assert _job(job_id).claimed_by == "worker-b"
+
+
+def test_job_fails_once_out_of_attempts(user, folder):
+    job_id = enqueue_job(user.id, folder.id, "job")
+    for _ in range(2):
+        assert claim_job("worker-a", 60) == job_id
+        _expire_lease(job_id)
+        reclaim_expired_jobs(max_attempts=2)
+    job = _job(job_id)
+    assert (job.status, job.attempts) == ("failed", 2)
+    assert claim_job("worker-a", 60) is None
+
+
+def test_job_stops_after_losing_its_claim(user, folder, source):
+    write_file(source, "a.txt", b"content")
+    job_id = enqueue_job(user.id, folder.id, "job")
+    assert claim_job("worker-a", 60) == job_id
+    _job(job_id).claimed_by = "worker-b"
+    db.session.commit()
+
+    assert not run_backup_job(job_id, worker_id="worker-a")
+    job = _job(job_id)
+    assert (job.status, job.claimed_by) == ("running", "worker-b")
+    assert FileVersion.query.count() == 0
@@ -0,0 +1,88 @@
+import os
+import time
+import pytest
+from flask import Flask
+from metrics import Metrics, RETIRED_SNAPSHOT, SNAPSHOT_RETENTION, merge_snapshots
+
+
+@pytest.fixture
+def metrics_app(tmp_path):
+    app = Flask("metrics-test")
+    app.config.update(METRICS_ENABLED=True, METRICS_DIR=str(tmp_path), METRICS_STALE_SECONDS=60)
+    return app
+
+
+def _process(app, name):
+    """A Metrics instance standing in for one process, without its snapshot thread"""
+    process = Metrics()
+    process.app = app
+    process._pid = os.getpid()
+    process._snapshot_name = lambda: f"{name}.json"
+    return process
+
+
+def _age(app, process, seconds):
+    path = os.path.join(app.config["METRICS_DIR"], process._snapshot_name())
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def _scrape(process):
+    return merge_snapshots([process.registry.snapshot(), *process._other_snapshots()])
+
+
+def _record(process, files, queued, duration):
+    process.files_scanned.inc(files)
+    process.jobs.inc(status="completed")
+    process.jobs_queued.set(queued)
+    process.job_duration.observe(duration)
+
+
+def test_a_scrape_adds_up_every_process(metrics_app):
+    web, worker, scraper = (_process(metrics_app, name) for name in ("web", "worker", "scraper"))
+    _record(web, 10, 3, 2)
+    _record(worker, 5, 4, 100)
+    web._write_snapshot()
+    worker._write_snapshot()
+
+    merged = _scrape(scraper)
+    assert merged["backup_files_scanned_total"]["values"][()] == 15
+    assert merged["backup_jobs_total"]["values"][("completed",)] == 2
+    # Queue depth is shared state every process reports: the largest wins
+    assert merged["backup_jobs_queued"]["values"][()] == 4
+    counts, total, count = merged["backup_job_duration_seconds"]["values"][()]
+    assert (sum(counts), total, count) == (2, 102, 2)
+    assert 'backup_jobs_total{status="completed"} 2' in scraper.exposition()
+
+
+def test_stale_processes_keep_their_counters_but_not_their_gauges(metrics_app):
+    gone, scraper = _process(metrics_app, "gone"), _process(metrics_app, "scraper")
+    _record(gone, 7, 9, 1)
+    gone._write_snapshot()
+    _age(metrics_app, gone, 120)
+
+    merged = _scrape(scraper)
+    assert merged["backup_files_scanned_total"]["values"][()] == 7
+    assert merged["backup_jobs_queued"]["values"] == {}
+
+
+def test_old_snapshots_are_retired_into_one_that_keeps_counting(metrics_app, tmp_path):
+    scraper = _process(metrics_app, "scraper")
+    for name, files, total in (("first", 3, 3), ("second", 4, 7)):
+        old = _process(metrics_app, name)
+        _record(old, files, 5, 1)
+        old._write_snapshot()
+        _age(metrics_app, old, SNAPSHOT_RETENTION + 60)
+        assert _scrape(scraper)["backup_files_scanned_total"]["values"][()] == total
+
+    assert sorted(os.listdir(tmp_path)) == sorted([RETIRED_SNAPSHOT, f"{RETIRED_SNAPSHOT}.lock"])
+    # Scraping again reads the retired totals once, without adding them up again
+    merged = _scrape(scraper)
+    assert merged["backup_files_scanned_total"]["values"][()] == 7
+    assert merged["backup_jobs_total"]["values"][("completed",)] == 2
+    assert merged["backup_jobs_queued"]["values"] == {}
+
+    live = _process(metrics_app, "live")
+    _record(live, 1, 2, 1)
+    live._write_snapshot()
+    assert _scrape(scraper)["backup_files_scanned_total"]["values"][()] == 8
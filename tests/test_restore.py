@@ -0,0 +1,67 @@
+import os
+from datetime import datetime
+from app import db
+from models import File
+from backup_utils import create_backup_job, run_backup_job
+from restore import restore_folder, versions_at
+from usage import set_file_deleted
+from conftest import write_file
+
+
+def _backup(user, folder):
+    job = create_backup_job(user.id, folder_id=folder.id)
+    assert run_backup_job(job.id)
+    return datetime.utcnow()
+
+
+def _change(path, data, mtime):
+    with open(path, "wb") as f:
+        f.write(data)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def _read_tree(root):
+    tree = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            with open(path, "rb") as f:
+                tree[os.path.relpath(path, root)] = f.read()
+    return tree
+
+
+def test_restore_rebuilds_the_folder_as_it_was(app, user, folder, source, tmp_path):
+    a = write_file(source, "a.txt", b"one")
+    write_file(source, "sub/b.txt", b"bee")
+    os.utime(a, ns=(1_000_000_000, 1_000_000_000))
+    first = _backup(user, folder)
+    _change(a, b"two", 2_000_000_000)
+    write_file(source, "c.txt", b"added later")
+    _backup(user, folder)
+
+    target = tmp_path / "restored"
+    report = restore_folder(folder, first, str(target))
+    assert (report.files, report.errors) == (2, 0)
+    assert _read_tree(target) == {"a.txt": b"one", os.path.join("sub", "b.txt"): b"bee"}
+    assert os.stat(target / "a.txt").st_mtime_ns == 1_000_000_000
+
+    report = restore_folder(folder, datetime.utcnow(), str(target))
+    assert report.files == 3
+    assert _read_tree(target)["a.txt"] == b"two"
+
+
+def test_path_deleted_and_backed_up_again_restores_once(app, user, folder, source):
+    a = write_file(source, "a.txt", b"old")
+    before_delete = _backup(user, folder)
+    set_file_deleted(File.query.one(), True)
+    db.session.commit()
+    _change(a, b"new", 5_000_000_000)
+    _backup(user, folder)
+    assert File.query.filter_by(source_path="a.txt").count() == 2
+
+    items = versions_at(folder.id, datetime.utcnow())
+    assert [item.rel_path for item in items] == ["a.txt"]
+    assert items[0].size == 3 and items[0].mtime_ns == 5_000_000_000
+    # Before the deletion the first incarnation is what was there
+    old = versions_at(folder.id, before_delete)
+    assert len(old) == 1 and old[0].version_id != items[0].version_id
@@ -0,0 +1,73 @@
+import os
+import threading
+import pytest
+from app import db
+from models import BackupJob, BackupLog, File, FileVersion
+import backup_utils
+from backup_utils import BackupWriter, create_backup_job, run_backup_job
+from conftest import write_file
+
+
+class Crash(BaseException):
+    """Stands in for the process dying: not caught by the job's error handling"""
+
+
+def _crash_after(monkeypatch, files):
+    flush = BackupWriter.maybe_flush
+    seen = [0]
+
+    def maybe_flush(self):
+        seen[0] += 1
+        if seen[0] > files:
+            raise Crash()
+        flush(self)
+
+    monkeypatch.setattr(BackupWriter, "maybe_flush", maybe_flush)
+
+
+def _count_processed(monkeypatch):
+    processed = []
+    lock = threading.Lock()
+    process_file = backup_utils.process_file
+
+    def counting(file_path, entry, settings):
+        with lock:
+            processed.append(file_path)
+        return process_file(file_path, entry, settings)
+
+    monkeypatch.setattr(backup_utils, "process_file", counting)
+    return processed
+
+
+def test_interrupted_job_resumes_after_its_checkpoint(app, user, folder, source, monkeypatch):
+    app.config.update(BACKUP_COMMIT_BATCH_SIZE=10, BACKUP_COMMIT_INTERVAL=3600)
+    for i in range(40):
+        write_file(source, f"d{i % 3}/f{i:02}.txt", os.urandom(500))
+    job = create_backup_job(user.id, folder_id=folder.id)
+    job_id = job.id
+
+    with monkeypatch.context() as m:
+        _crash_after(m, 25)
+        with pytest.raises(Crash):
+            run_backup_job(job_id)
+    db.session.rollback()
+
+    job = db.session.get(BackupJob, job_id)
+    assert job.status == "running"
+    assert job.checkpoint_folder_id == folder.id
+    committed = FileVersion.query.count()
+    assert committed == 20  # The last batch before the crash
+    assert job.files_changed == committed
+
+    processed = _count_processed(monkeypatch)
+    assert run_backup_job(job_id)
+
+    db.session.expire_all()
+    job = db.session.get(BackupJob, job_id)
+    assert job.status == "completed"
+    assert job.checkpoint_folder_id is None and job.checkpoint_path is None
+    assert len(processed) == 40 - committed
+    assert File.query.count() == 40
+    assert FileVersion.query.count() == 40
+    assert job.files_changed == 40
+    assert BackupLog.query.filter(BackupLog.job_id == job_id, BackupLog.message.like("Resuming after%")).count() == 1
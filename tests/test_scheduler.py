@@ -0,0 +1,144 @@
+import socket
+import threading
+import time
+import pytest
+from app import db
+from models import BackupJob, MonitoredFolder, User
+import scheduler as scheduler_module
+from scheduler import BackupScheduler, PRIORITY_MANUAL, PRIORITY_SCHEDULED
+
+
+class FakeRuns:
+    """Stands in for run_backup_job: records the jobs in the order they run, and blocks until released"""
+
+    def __init__(self):
+        self.order = []
+        self.release = threading.Event()
+
+    def __call__(self, job_id, changed_paths=None, worker_id=None):
+        self.order.append((job_id, changed_paths))
+        self.release.wait(5)
+        return True
+
+    def wait_for(self, count):
+        deadline = time.monotonic() + 5
+        while len(self.order) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(self.order) >= count
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    runs = FakeRuns()
+    monkeypatch.setattr(scheduler_module, "run_backup_job", runs)
+    return runs
+
+
+@pytest.fixture
+def backups(app, runs):
+    """A scheduler with a single worker thread"""
+    app.config["BACKUP_MAX_CONCURRENT_JOBS"] = 1
+    backups = BackupScheduler()
+    backups.app = app
+    yield backups
+    runs.release.set()
+    backups.stop_event.set()
+    for worker in backups._workers:
+        worker.join(5)
+
+
+@pytest.fixture
+def folders(user, tmp_path):
+    folders = [MonitoredFolder(name=f"f{i}", path=str(tmp_path), user_id=user.id) for i in range(4)]
+    db.session.add_all(folders)
+    db.session.commit()
+    return folders
+
+
+def _name(job_id):
+    return db.session.get(BackupJob, job_id).name
+
+
+def test_requests_for_a_folder_coalesce_and_manual_ones_go_first(user, folders, backups, runs):
+    first = backups.enqueue(folders[0].id, user.id, "s0")
+    runs.wait_for(1)  # The only worker is busy with it from now on
+
+    paths = backups.enqueue(folders[1].id, user.id, "s1", changed_paths=["/x"])
+    assert backups.enqueue(folders[1].id, user.id, "s1b", changed_paths=["/y"]) == paths
+    scheduled = backups.enqueue(folders[2].id, user.id, "s2")
+    manual = backups.enqueue(folders[3].id, user.id, "m3", PRIORITY_MANUAL)
+    # A full scan of a folder whose full scan is running is covered by the running one
+    assert backups.enqueue(folders[0].id, user.id, "m0", PRIORITY_MANUAL) == first
+    # A manual request for a folder with a queued scheduled job upgrades it
+    assert backups.enqueue(folders[2].id, user.id, "m2", PRIORITY_MANUAL) == scheduled
+    follow_up = backups.enqueue(folders[0].id, user.id, "p0", changed_paths=["/z"])
+    assert backups.get_stats()["queued"] == 4
+
+    runs.release.set()
+    runs.wait_for(5)
+    assert [_name(job_id) for job_id, _ in runs.order] == ["s0", "m3", "s2", "s1", "p0"]
+    assert dict(runs.order)[paths] == ["/x", "/y"]
+    assert dict(runs.order)[follow_up] == ["/z"]
+    db.session.expire_all()
+    assert db.session.get(BackupJob, scheduled).is_manual
+    assert not db.session.get(BackupJob, paths).is_manual
+    assert BackupJob.query.count() == 5
+    assert manual != scheduled
+
+
+def test_merged_request_is_written_before_the_job_runs(user, folders, backups, runs):
+    backups.enqueue(folders[0].id, user.id, "busy")
+    runs.wait_for(1)
+    queued = backups.enqueue(folders[1].id, user.id, "queued")
+    assert backups.enqueue(folders[1].id, user.id, "profiled", PRIORITY_SCHEDULED, profile=True) == queued
+    db.session.expire_all()
+    assert db.session.get(BackupJob, queued).profile
+
+    runs.release.set()
+    runs.wait_for(2)
+    assert runs.order[1][0] == queued
+
+
+def test_jobs_without_a_folder_are_kept_apart_per_user(app, user, backups, runs):
+    other = User(username="bob", email="bob@example.com")
+    other.set_password("password1")
+    db.session.add(other)
+    db.session.commit()
+    dead_process = f"{socket.gethostname()}:999999:gone"
+    jobs = [BackupJob(name=f"legacy {owner.username}", user_id=owner.id, status="running", claimed_by=dead_process)
+            for owner in (user, other)]
+    db.session.add_all(jobs)
+    db.session.commit()
+
+    backups._recover_jobs()
+    runs.release.set()
+    runs.wait_for(2)
+    assert sorted(job_id for job_id, _ in runs.order) == sorted(job.id for job in jobs)
+    db.session.expire_all()
+    assert all(db.session.get(BackupJob, job.id).status != "failed" for job in jobs)
+
+
+class FakeWatcher:
+    def __init__(self):
+        self.drained = []
+
+    def drain(self, folder_id):
+        self.drained.append(folder_id)
+        return []
+
+
+def test_due_full_scan_only_takes_watched_changes_it_will_cover(user, folders, backups, runs):
+    backups.watcher = FakeWatcher()
+    running = backups.enqueue(folders[0].id, user.id, "running full scan")
+    runs.wait_for(1)
+    db.session.get(BackupJob, running).status = "running"
+    db.session.commit()
+
+    with backups._schedule_lock:
+        for folder in folders[:2]:
+            backups._schedule_folder(folder)  # Never scanned, so due now
+    backups._queue_due_folders()
+
+    # Folder 0's request went to the running scan, which may be past the changed paths
+    assert backups.watcher.drained == [folders[1].id]
+    assert backups.get_stats()["queued"] == 1
@@ -0,0 +1,78 @@
+import os
+import hashlib
+import pytest
+from app import db
+from models import File, FileVersion, UploadSession
+import uploads
+from conftest import read_version
+
+WRONG_CHECKSUM = "sha256:" + "0" * 64
+
+
+def _stored_files(storage_root):
+    """Every file under the storage root apart from the store's ALGORITHM marker"""
+    return sorted(os.path.relpath(os.path.join(directory, name), storage_root)
+                  for directory, _, names in os.walk(storage_root) for name in names if name != "ALGORITHM")
+
+
+def _start(client, **fields):
+    response = client.post("/api/uploads", json={"filename": "report.txt", **fields})
+    assert response.status_code == 201
+    return response.json["id"]
+
+
+def test_chunked_upload_round_trip(app, client):
+    data = os.urandom(300_000)
+    session_id = _start(client, size=len(data), checksum="md5:" + hashlib.md5(data).hexdigest())
+
+    assert client.put(f"/api/uploads/{session_id}?offset=0", data=data[:100_000]).json["offset"] == 100_000
+    # A retried chunk may overlap what was already received
+    assert client.put(f"/api/uploads/{session_id}?offset=50000", data=data[50_000:]).json["offset"] == len(data)
+    response = client.post(f"/api/uploads/{session_id}/complete")
+    assert response.status_code == 201
+
+    version = db.session.get(FileVersion, response.json["version_id"])
+    assert read_version(version) == data
+    assert UploadSession.query.count() == 0
+    assert not os.listdir(os.path.join(app.config["UPLOAD_FOLDER"], uploads.UPLOAD_DIR))
+
+
+def test_chunk_after_a_gap_is_refused(client):
+    session_id = _start(client)
+    client.put(f"/api/uploads/{session_id}?offset=0", data=b"a" * 1000)
+
+    response = client.put(f"/api/uploads/{session_id}?offset=2000", data=b"b" * 1000)
+    assert response.status_code == 409
+    assert client.get(f"/api/uploads/{session_id}").json["offset"] == 1000
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+@pytest.mark.parametrize("restarted", [False, True], ids=["same-process", "restarted"])
+def test_checksum_mismatch_leaves_nothing_behind(app, client, compression, restarted):
+    app.config["COMPRESSION"] = compression
+    session_id = _start(client)
+    client.put(f"/api/uploads/{session_id}?offset=0", data=b"compressible " * 20_000)
+    if restarted:
+        # The running hash is lost, so the received data is hashed again on completion
+        uploads._running_hashes.clear()
+
+    response = client.post(f"/api/uploads/{session_id}/complete", json={"checksum": WRONG_CHECKSUM})
+    assert response.status_code == 422
+    assert _stored_files(app.config["UPLOAD_FOLDER"]) == []
+    assert UploadSession.query.count() == 0
+    assert File.query.count() == 0
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_whole_file_checksum_mismatch_leaves_nothing_behind(app, client, compression):
+    app.config["COMPRESSION"] = compression
+    data = b"compressible " * 20_000
+    response = client.put("/api/files/report.txt", data=data, headers={"X-Checksum": WRONG_CHECKSUM})
+    assert response.status_code == 422
+    assert _stored_files(app.config["UPLOAD_FOLDER"]) == []
+    assert File.query.count() == 0
+
+    checksum = "sha256:" + hashlib.sha256(data).hexdigest()
+    response = client.put("/api/files/report.txt", data=data, headers={"X-Checksum": checksum})
+    assert response.status_code == 201
+    assert read_version(db.session.get(FileVersion, response.json["version_id"])) == data
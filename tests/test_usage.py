@@ -0,0 +1,108 @@
+import os
+from sqlalchemy import update
+from app import db
+from models import File, FileVersion, UsageStats
+from backup_utils import create_backup_job, run_backup_job
+from usage import USER_TOTAL, UsageChanges, get_usage, reconcile_usage
+from conftest import write_file
+
+
+def _backup(user, folder):
+    job = create_backup_job(user.id, folder_id=folder.id)
+    assert run_backup_job(job.id)
+
+
+def _assert_exact():
+    assert reconcile_usage(dry_run=True) == {}
+
+
+def test_counters_follow_backups_uploads_and_deletes(user, folder, source, client):
+    write_file(source, "a.txt", b"a" * 1000)
+    path = write_file(source, "sub/b.bin", os.urandom(5000))
+    _backup(user, folder)
+    usage = get_usage(user.id)
+    assert (usage.file_count, usage.version_count, usage.total_size) == (2, 2, 6000)
+    _assert_exact()
+
+    with open(path, "wb") as f:
+        f.write(os.urandom(2000))
+    os.utime(path, ns=(0, 0))
+    _backup(user, folder)
+    usage = get_usage(user.id)
+    assert (usage.file_count, usage.version_count, usage.total_size) == (2, 3, 3000)
+    assert get_usage(user.id, folder.id).version_count == 3
+    _assert_exact()
+
+    client.put("/api/files/upload.txt", data=b"x" * 100)
+    client.put("/api/files/upload.txt", data=b"y" * 50)
+    usage = get_usage(user.id)
+    assert (usage.file_count, usage.version_count, usage.total_size) == (3, 5, 3050)
+    assert get_usage(user.id, folder.id).file_count == 2
+    _assert_exact()
+
+    file_id = File.query.filter_by(original_filename="a.txt").one().id
+    client.post(f"/delete/{file_id}")
+    client.post(f"/delete/{file_id}")  # Deleting twice counts once
+    assert get_usage(user.id).file_count == 2
+    _assert_exact()
+
+    client.post(f"/restore/{file_id}")
+    assert get_usage(user.id).file_count == 3
+    _assert_exact()
+
+
+def test_changes_add_up_from_the_first_one(user):
+    for _ in range(2):
+        changes = UsageChanges()
+        changes.add(user.id, files=1, versions=2, size=10, stored=5)
+        changes.apply()
+        db.session.commit()
+    usage = get_usage(user.id)
+    assert (usage.file_count, usage.version_count, usage.total_size, usage.stored_size) == (2, 4, 20, 10)
+    assert UsageStats.query.count() == 1
+
+
+def test_reconcile_fixes_drift(user, folder, source):
+    write_file(source, "a.txt", b"content")
+    _backup(user, folder)
+    db.session.execute(update(UsageStats).values(file_count=99))
+    db.session.commit()
+
+    drift = reconcile_usage()
+    assert drift == {(user.id, USER_TOTAL): {"file_count": (99, 1)}, (user.id, folder.id): {"file_count": (99, 1)}}
+    assert get_usage(user.id).file_count == 1
+    _assert_exact()
+
+
+def test_upload_to_a_backed_up_file_counts_in_its_folder(user, folder, source, client):
+    path = write_file(source, "a.txt", b"a" * 1000)
+    _backup(user, folder)
+
+    assert client.put("/api/files/a.txt", data=b"uploaded").status_code == 201
+    file = File.query.one()
+    assert file.source_folder_id == folder.id and len(file.versions) == 2
+    assert get_usage(user.id, folder.id).version_count == 2
+    assert get_usage(user.id, folder.id).total_size == 8
+    _assert_exact()
+
+    with open(path, "wb") as f:
+        f.write(b"b" * 300)
+    os.utime(path, ns=(0, 0))
+    _backup(user, folder)
+    assert get_usage(user.id, folder.id).total_size == 300
+    _assert_exact()
+
+
+def test_size_change_is_taken_from_the_file(user, folder, source):
+    path = write_file(source, "a.txt", b"a" * 1000)
+    _backup(user, folder)
+    # The latest version's size need not be the file's (e.g. rows from before sizes were kept in step)
+    db.session.execute(update(FileVersion).values(size=1))
+    db.session.commit()
+
+    with open(path, "wb") as f:
+        f.write(b"b" * 300)
+    os.utime(path, ns=(0, 0))
+    _backup(user, folder)
+    assert get_usage(user.id).total_size == 300
+    _assert_exact()
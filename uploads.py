@@ -0,0 +1,334 @@
+"""Uploads that don't go through the web form.
+
+Content is hashed while it is written to storage, so an upload is read
+from the network once and never buffered in full by anything else.
+Large uploads can be sent in pieces: a session is created, chunks are
+written at their byte offset (a failed chunk is simply sent again, from
+the offset the server reports), and finishing the session checks the
+whole content against the checksum the client gives before any version
+is recorded.
+"""
+import os
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta
+from app import db
+from models import File, FileVersion, UploadSession
+from blob_store import commit_blob, stage_received, stage_stream
+from hashing import format_checksum, get_algorithm, new_hasher, parse_checksum
+from usage import UsageChanges
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Chunks being received live under UPLOAD_FOLDER/uploads/<session id>; on
+# the same filesystem as the blobs, so a finished upload is moved, not copied
+UPLOAD_DIR = "uploads"
+
+# Hashers of sessions whose chunks arrived in order at this process:
+# session id -> (bytes hashed, {algorithm: hasher}). Finishing such a session
+# needs no extra pass over the data; other processes, or chunks sent out of
+# order, fall back to hashing the assembled file once.
+MAX_RUNNING_HASHES = 256
+_running_hashes = {}
+_running_hashes_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """A request against an upload that can't be honoured; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def upload_path(storage_root, session_id):
+    return os.path.join(storage_root, UPLOAD_DIR, session_id)
+
+
+def received_bytes(storage_root, session):
+    """How much of an upload has been received, i.e. the offset to continue from"""
+    try:
+        return os.path.getsize(upload_path(storage_root, session.id))
+    except FileNotFoundError:
+        return 0
+
+
+def _check_checksum(checksum):
+    """Validate a client-supplied checksum and return (algorithm, tagged checksum)"""
+    algorithm, hexdigest = parse_checksum(checksum)
+    try:
+        get_algorithm(algorithm)
+    except ValueError as e:
+        raise UploadError(str(e)) from None
+    return algorithm, format_checksum(algorithm, hexdigest.lower())
+
+
+def record_upload(user_id, filename, content_type, blob, change_reason=None):
+    """Add a blob as the new current version of a user's uploaded file, creating the file if needed.
+
+    Returns the FileVersion; the caller commits.
+    """
+    existing_file = File.query.filter_by(
+        user_id=user_id,
+        original_filename=filename,
+        is_deleted=False
+    ).first()
+
+    changes = UsageChanges()
+    # An upload can add a version to a file backed up from a monitored folder
+    folder_id = existing_file.source_folder_id if existing_file else None
+    if existing_file:
+        changes.add(user_id, folder_id, size=blob.size - existing_file.size)
+        latest_version = FileVersion.query.filter_by(file_id=existing_file.id).order_by(FileVersion.version_number.desc()).first()
+        version_number = latest_version.version_number + 1 if latest_version else 1
+        for version in existing_file.versions:
+            version.is_current = False
+        existing_file.size = blob.size
+        existing_file.updated_at = datetime.utcnow()
+        file = existing_file
+    else:
+        file = File(
+            filename=blob.filename,
+            original_filename=filename,
+            size=blob.size,
+            content_type=content_type,
+            user_id=user_id,
+            is_auto_backup=False
+        )
+        db.session.add(file)
+        db.session.flush()  # To get the file ID
+        version_number = 1
+        changes.add(user_id, files=1, size=blob.size)
+
+    # The content digest doubles as the version's checksum
+    version = FileVersion(
+        file_id=file.id,
+        version_number=version_number,
+        filename=blob.filename,
+        blob=blob,
+        size=blob.size,
+        stored_size=blob.stored_size,
+        is_current=True,
+        checksum=blob.digest,
+        change_reason=change_reason or ("Manual upload" if existing_file else "Initial upload")
+    )
+    db.session.add(version)
+    changes.add(user_id, folder_id, versions=1, stored=blob.stored_size if blob.stored_size is not None else blob.size)
+    changes.apply()
+    return version
+
+
+def store_stream(stream, user_id, filename, content_type, settings, compression=None, checksum=None):
+    """Store a whole upload read from stream and record it as a new version.
+
+    The content is hashed as it is written to storage. If checksum is
+    given, it must match what was received or nothing is recorded.
+    """
+    algorithm = settings['hash_algorithm']
+    verify = None
+    if checksum:
+        verify_algorithm, checksum = _check_checksum(checksum)
+        if verify_algorithm != algorithm:
+            verify = new_hasher(verify_algorithm)
+    def check(digest):
+        # Runs before the content is stored, so a mismatch leaves nothing behind
+        if checksum:
+            actual = format_checksum(verify_algorithm, verify.hexdigest()) if verify else digest
+            if actual != checksum:
+                raise UploadError(f"Checksum mismatch: received content is {actual}", 422)
+
+    staged = stage_stream(stream, settings['storage_root'], [verify] if verify else (),
+                          buffer_size=settings['buffer_size'], durable=settings['durable'],
+                          compression=compression, level=settings['compression_level'], algorithm=algorithm,
+                          verify=check)
+    version = record_upload(user_id, filename, content_type, commit_blob(staged))
+    db.session.commit()
+    return version
+
+
+def expire_sessions(storage_root, max_age):
+    """Drop upload sessions that haven't received anything for max_age seconds"""
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+    expired = UploadSession.query.filter(UploadSession.updated_at < cutoff).all()
+    for session in expired:
+        _discard(storage_root, session)
+    if expired:
+        db.session.commit()
+        logger.info(f"Expired {len(expired)} abandoned upload sessions")
+    return len(expired)
+
+
+def create_session(user_id, filename, content_type, settings, size=None, checksum=None, max_age=None,
+                   max_size=None):
+    """Start a chunked upload and return its UploadSession.
+
+    Sessions idle for max_age seconds are dropped first; max_size caps the
+    size of an upload.
+    """
+    if max_age:
+        expire_sessions(settings['storage_root'], max_age)
+    if size is not None and size < 0:
+        raise UploadError("size must not be negative")
+    if size is not None and max_size is not None and size > max_size:
+        raise UploadError(f"Uploads are limited to {max_size} bytes", 413)
+    if checksum:
+        _, checksum = _check_checksum(checksum)
+    session = UploadSession(id=uuid.uuid4().hex, user_id=user_id, filename=filename, content_type=content_type,
+                            size=size, checksum=checksum)
+    path = upload_path(settings['storage_root'], session.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+    db.session.add(session)
+    db.session.commit()
+    return session
+
+
+def write_chunk(session, offset, stream, settings, max_size=None):
+    """Write a chunk read from stream at offset and return the new received size.
+
+    offset may be at most the received size: a chunk starting earlier
+    replaces whatever was received from there on (a retry of a chunk that
+    only partly arrived), one starting later would leave a gap and is
+    refused with the offset to continue from.
+    """
+    storage_root = settings['storage_root']
+    path = upload_path(storage_root, session.id)
+    if not os.path.exists(path):
+        raise UploadError("Upload data is missing; start a new upload", 410)
+
+    with open(path, "r+b") as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadError("Another chunk of this upload is being written", 409) from None
+        received = os.fstat(f.fileno()).st_size
+        if offset < 0 or offset > received:
+            raise UploadError(f"Chunk at {offset} doesn't continue the upload; continue from {received}", 409)
+
+        hashers = _take_running_hashes(session, offset, settings['hash_algorithm'])
+        f.truncate(offset)
+        f.seek(offset)
+        end = offset
+        limit = session.size if session.size is not None else max_size
+        buffer_size = settings['buffer_size']
+        for chunk in iter(lambda: stream.read(buffer_size), b""):
+            end += len(chunk)
+            if limit is not None and end > limit:
+                # Keep what was valid; the client can retry with the right data
+                f.truncate(offset)
+                raise UploadError(f"Chunk goes past the upload's size limit of {limit} bytes", 413)
+            if hashers is not None:
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+            f.write(chunk)
+        f.flush()
+        if settings['durable']:
+            os.fsync(f.fileno())
+
+    if hashers is not None:
+        _put_running_hashes(session.id, end, hashers)
+    session.updated_at = datetime.utcnow()
+    db.session.commit()
+    return end
+
+
+def finish_session(session, settings, compression=None, checksum=None):
+    """Verify a complete upload against its checksum, store it and record it as a new version.
+
+    checksum may be given here or when the session was created. On a
+    mismatch the received data is discarded and nothing is recorded.
+    Returns the FileVersion.
+    """
+    storage_root = settings['storage_root']
+    algorithm = settings['hash_algorithm']
+    checksum = checksum or session.checksum
+    if not checksum:
+        raise UploadError("A checksum is needed to finish an upload")
+    verify_algorithm, checksum = _check_checksum(checksum)
+    if session.checksum and checksum != session.checksum:
+        raise UploadError("Checksum differs from the one the upload was started with")
+
+    path = upload_path(storage_root, session.id)
+    if not os.path.exists(path):
+        raise UploadError("Upload data is missing; start a new upload", 410)
+    received = os.path.getsize(path)
+    if session.size is not None and received != session.size:
+        raise UploadError(f"Upload is incomplete: {received} of {session.size} bytes received; "
+                          f"continue from {received}", 409)
+
+    hashers = _pop_running_hashes(session.id, received)
+    if hashers is not None and algorithm in hashers and verify_algorithm in hashers:
+        hasher, verify = hashers[algorithm], hashers[verify_algorithm]
+        extra = ()
+    else:
+        hasher = None
+        verify = new_hasher(verify_algorithm) if verify_algorithm != algorithm else None
+        extra = [verify] if verify else ()
+
+    def check(digest):
+        # Runs before the content is stored, so a mismatch leaves nothing behind but the upload itself
+        actual = format_checksum(verify_algorithm, verify.hexdigest()) if verify else digest
+        if actual != checksum:
+            _discard(storage_root, session)
+            db.session.commit()
+            raise UploadError(f"Checksum mismatch: received content is {actual}; the upload was discarded", 422)
+
+    staged = stage_received(path, storage_root, hasher, extra,
+                            buffer_size=settings['buffer_size'], durable=settings['durable'],
+                            compression=compression, level=settings['compression_level'], algorithm=algorithm,
+                            verify=check)
+
+    version = record_upload(session.user_id, session.filename, session.content_type, commit_blob(staged))
+    db.session.delete(session)
+    db.session.commit()
+    logger.info(f"Finished upload {session.id} of {session.filename} ({staged.size} bytes)")
+    return version
+
+
+def abort_session(session, storage_root):
+    _discard(storage_root, session)
+    db.session.commit()
+
+
+def _discard(storage_root, session):
+    _pop_running_hashes(session.id, None)
+    try:
+        os.remove(upload_path(storage_root, session.id))
+    except FileNotFoundError:
+        pass
+    db.session.delete(session)
+
+
+def _take_running_hashes(session, offset, algorithm):
+    """Hashers to feed a chunk written at offset, or None if the content can't be hashed as it arrives"""
+    with _running_hashes_lock:
+        hashed, hashers = _running_hashes.pop(session.id, (0, None))
+    if offset == 0:
+        algorithms = {algorithm}
+        if session.checksum:
+            algorithms.add(parse_checksum(session.checksum)[0])
+        return {name: new_hasher(name) for name in algorithms}
+    return hashers if hashers is not None and hashed == offset else None
+
+
+def _put_running_hashes(session_id, hashed, hashers):
+    with _running_hashes_lock:
+        _running_hashes[session_id] = (hashed, hashers)
+        while len(_running_hashes) > MAX_RUNNING_HASHES:
+            del _running_hashes[next(iter(_running_hashes))]
+
+
+def _pop_running_hashes(session_id, hashed):
+    """Remove a session's hashers; return them if they cover exactly hashed bytes"""
+    with _running_hashes_lock:
+        entry = _running_hashes.pop(session_id, None)
+    if entry is None or entry[0] != hashed:
+        return None
+    return entry[1]
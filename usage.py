@@ -0,0 +1,189 @@
+"""Per-user and per-folder usage counters.
+
+Every path that adds, deletes or restores files records its changes to
+the counters in UsageStats within its own transaction, so they stay
+exact without the dashboard aggregating over File and FileVersion.
+reconcile_usage() rebuilds them from scratch, to catch any drift:
+
+    python usage.py              # check and fix every user's counters
+    python usage.py --dry-run    # only report drift
+"""
+import sys
+import logging
+import argparse
+from collections import defaultdict
+from sqlalchemy import delete, func, insert, select, update
+from app import app, db
+from models import File, FileVersion, UsageStats
+
+logger = logging.getLogger(__name__)
+
+# folder_id of the row holding a user's totals
+USER_TOTAL = 0
+
+COUNTERS = ("file_count", "version_count", "total_size", "stored_size")
+
+
+class UsageChanges:
+    """Counter changes collected while making a change, written with apply()"""
+
+    def __init__(self):
+        self._deltas = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+
+    def add(self, user_id, folder_id=None, files=0, versions=0, size=0, stored=0):
+        """Count a change to the files of user_id, in folder_id if they belong to a monitored folder"""
+        scopes = [USER_TOTAL] if folder_id is None else [USER_TOTAL, folder_id]
+        for scope in scopes:
+            delta = self._deltas[(user_id, scope)]
+            delta["file_count"] += files
+            delta["version_count"] += versions
+            delta["total_size"] += size or 0
+            delta["stored_size"] += stored or 0
+
+    def apply(self):
+        """Add the changes to the counters in the current session; the caller commits"""
+        for (user_id, folder_id), delta in self._deltas.items():
+            if any(delta.values()):
+                _increment(user_id, folder_id, delta)
+        self._deltas.clear()
+
+
+def _increment(user_id, folder_id, delta):
+    """Add delta to a scope's counters, creating its row on the first change"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        # A single statement, so concurrent first changes to a scope can't both insert it
+        stmt = dialect_insert(UsageStats).values(user_id=user_id, folder_id=folder_id, **delta)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[UsageStats.user_id, UsageStats.folder_id],
+            set_={name: getattr(UsageStats, name) + getattr(stmt.excluded, name) for name in delta}
+        ))
+        return
+    result = db.session.execute(
+        update(UsageStats)
+        .where(UsageStats.user_id == user_id, UsageStats.folder_id == folder_id)
+        .values({name: getattr(UsageStats, name) + value for name, value in delta.items()})
+    )
+    if not result.rowcount:
+        db.session.execute(insert(UsageStats).values(user_id=user_id, folder_id=folder_id, **delta))
+
+
+def file_usage(file):
+    """(versions, stored bytes) of a file, for counting it in or out when it is deleted or restored"""
+    return db.session.execute(
+        select(func.count(FileVersion.id), func.coalesce(func.sum(func.coalesce(FileVersion.stored_size, FileVersion.size)), 0))
+        .where(FileVersion.file_id == file.id)
+    ).one()
+
+
+def set_file_deleted(file, deleted):
+    """Mark a file deleted or not and update the counters to match; the caller commits"""
+    if bool(file.is_deleted) == deleted:
+        return
+    versions, stored = file_usage(file)
+    sign = -1 if deleted else 1
+    changes = UsageChanges()
+    changes.add(file.user_id, file.source_folder_id, files=sign, versions=sign * versions,
+                size=sign * file.size, stored=sign * stored)
+    file.is_deleted = deleted
+    changes.apply()
+
+
+def get_usage(user_id, folder_id=USER_TOTAL):
+    """A user's (or one of their folders') counters, all zero if nothing has been counted yet"""
+    stats = db.session.get(UsageStats, (user_id, folder_id))
+    if stats is None:
+        stats = UsageStats(user_id=user_id, folder_id=folder_id, **dict.fromkeys(COUNTERS, 0))
+    return stats
+
+
+def _actual_usage(user_id=None):
+    """{(user_id, folder_id): {counter: value}} computed from the files themselves"""
+    versions = (
+        select(FileVersion.file_id, func.count(FileVersion.id).label("versions"),
+               func.sum(func.coalesce(FileVersion.stored_size, FileVersion.size)).label("stored"))
+        .group_by(FileVersion.file_id)
+        .subquery()
+    )
+    query = (
+        select(File.user_id, File.source_folder_id, func.count(File.id), func.coalesce(func.sum(versions.c.versions), 0),
+               func.coalesce(func.sum(File.size), 0), func.coalesce(func.sum(versions.c.stored), 0))
+        .outerjoin(versions, versions.c.file_id == File.id)
+        .where(File.is_deleted == False)
+        .group_by(File.user_id, File.source_folder_id)
+    )
+    if user_id is not None:
+        query = query.where(File.user_id == user_id)
+    actual = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+    for user, folder_id, *values in db.session.execute(query):
+        scopes = [USER_TOTAL] if folder_id is None else [USER_TOTAL, folder_id]
+        for scope in scopes:
+            counters = actual[(user, scope)]
+            for name, value in zip(COUNTERS, values):
+                counters[name] += value
+    return actual
+
+
+def reconcile_usage(user_id=None, dry_run=False):
+    """Rebuild the counters (of one user, or everyone) from the files themselves.
+
+    Returns the scopes that had drifted as {(user_id, folder_id): {counter: (recorded, actual)}}.
+    Commits unless dry_run.
+    """
+    actual = _actual_usage(user_id)
+    query = select(UsageStats)
+    if user_id is not None:
+        query = query.where(UsageStats.user_id == user_id)
+    recorded = {(s.user_id, s.folder_id): {name: getattr(s, name) for name in COUNTERS}
+                for s in db.session.scalars(query)}
+
+    zero = dict.fromkeys(COUNTERS, 0)
+    drift = {}
+    for key in set(actual) | set(recorded):
+        was, now = recorded.get(key, zero), actual.get(key, zero)
+        changed = {name: (was[name], now[name]) for name in COUNTERS if was[name] != now[name]}
+        if changed:
+            drift[key] = changed
+
+    if not dry_run:
+        stale = [key for key in recorded if key not in actual]
+        for scope_user, folder_id in stale:
+            db.session.execute(delete(UsageStats).where(UsageStats.user_id == scope_user,
+                                                        UsageStats.folder_id == folder_id))
+        for key, counters in actual.items():
+            if key not in recorded:
+                db.session.execute(insert(UsageStats).values(user_id=key[0], folder_id=key[1], **counters))
+            elif key in drift:
+                db.session.execute(update(UsageStats)
+                                   .where(UsageStats.user_id == key[0], UsageStats.folder_id == key[1])
+                                   .values(**counters))
+        db.session.commit()
+
+    for (scope_user, folder_id), changed in sorted(drift.items()):
+        details = ", ".join(f"{name} {was} -> {now}" for name, (was, now) in changed.items())
+        logger.warning(f"Usage of user {scope_user} folder {folder_id} had drifted: {details}")
+    return drift
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the usage counters from the files themselves")
+    parser.add_argument("--user", type=int, default=None, help="only this user's counters")
+    parser.add_argument("--dry-run", action="store_true", help="report drift without fixing it")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    with app.app_context():
+        drift = reconcile_usage(args.user, args.dry_run)
+    action = "found" if args.dry_run else "fixed"
+    print(f"{len(drift)} drifted counter rows {action}")
+    sys.exit(1 if drift and args.dry_run else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import os
+import sys
+import errno
+import select
+import struct
+import logging
+import threading
+import ctypes
+import ctypes.util
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) constants
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# A file is only worth backing up once it has been written and closed,
+# renamed into place, or had its mtime changed
+FILE_CHANGE_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT_HEADER = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+
+
+def _load_inotify():
+    """Return libc if it has the inotify calls, otherwise None"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FolderWatcher:
+    """Collects changed paths for monitored folders using Linux inotify.
+
+    Each folder gets a set of dirty paths that the scheduler drains into an
+    incremental backup job. When changes may have been missed (the event
+    queue overflowed, a directory couldn't be watched, the folder root was
+    moved) the folder is flagged for a full rescan instead. Periodic full
+    scans still run on each folder's backup_interval as a safety net.
+    """
+
+    def __init__(self):
+        self._libc = _load_inotify()
+        self._fd = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._roots = {}          # folder_id -> root path
+        self._watches = {}        # wd -> (folder_id, directory path)
+        self._folder_watches = {} # folder_id -> set of wds
+        self._dirty = {}          # folder_id -> set of changed file paths
+        self._rescan = set()      # folder_ids whose changes may have been missed
+        self.on_change = None     # called (from the watcher thread) when changes are recorded
+
+    @property
+    def available(self):
+        return self._libc is not None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the watcher thread. Returns False if inotify isn't available."""
+        if self.running:
+            return True
+        if not self.available:
+            logger.info("inotify is not available; folders will only be rescanned on their interval")
+            return False
+
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            logger.warning(f"inotify_init1 failed: {os.strerror(err)}")
+            return False
+
+        self._fd = fd
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="folder-watcher", daemon=True)
+        self._thread.start()
+        logger.info("Folder watcher started")
+        return True
+
+    def shutdown(self):
+        if not self.running:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout=5)
+        with self._lock:
+            os.close(self._fd)
+            self._fd = None
+            self._roots.clear()
+            self._watches.clear()
+            self._folder_watches.clear()
+        logger.info("Folder watcher stopped")
+
+    def sync(self, folders):
+        """Watch exactly the given MonitoredFolders, adding and dropping watches as needed"""
+        if not self.running:
+            return
+        wanted = {folder.id: folder.path for folder in folders}
+        with self._lock:
+            for folder_id in list(self._roots):
+                if folder_id not in wanted:
+                    self._forget_folder(folder_id)
+        for folder_id, path in wanted.items():
+            self.watch(folder_id, path)
+
+    def watch(self, folder_id, path):
+        """Start watching a folder, or re-watch it if its path changed"""
+        if not self.running:
+            return
+        path = os.path.abspath(path)
+        with self._lock:
+            if self._roots.get(folder_id) == path:
+                return
+            self._forget_folder(folder_id)
+            self._roots[folder_id] = path
+            self._folder_watches[folder_id] = set()
+            self._watch_tree(folder_id, path)
+
+    def unwatch(self, folder_id):
+        if not self.running:
+            return
+        with self._lock:
+            self._forget_folder(folder_id)
+
+    def changed_folders(self):
+        """IDs of folders with pending changes or needing a rescan"""
+        with self._lock:
+            return [folder_id for folder_id, paths in self._dirty.items() if paths] + \
+                [folder_id for folder_id in self._rescan if not self._dirty.get(folder_id)]
+
+    def has_changes(self, folder_id):
+        with self._lock:
+            return bool(self._dirty.get(folder_id)) or folder_id in self._rescan
+
+    def needs_rescan(self, folder_id):
+        with self._lock:
+            return folder_id in self._rescan
+
+    def drain(self, folder_id):
+        """Take the pending changes for a folder.
+
+        Returns a sorted list of changed file paths, or None if the folder
+        needs a full rescan. Either way the folder's pending state is cleared.
+        """
+        with self._lock:
+            paths = self._dirty.pop(folder_id, set())
+            if folder_id in self._rescan:
+                self._rescan.discard(folder_id)
+                if folder_id in self._roots and not self._folder_watches.get(folder_id):
+                    # The root watch was lost (e.g. the folder was moved or
+                    # recreated); try again so future changes are seen
+                    self._watch_tree(folder_id, self._roots[folder_id])
+                return None
+            return sorted(paths)
+
+    # Everything below is called with self._lock held
+
+    def _watch_tree(self, folder_id, path, mark_files=False):
+        """Add watches for a directory and all its subdirectories.
+
+        With mark_files, every file found is marked dirty: it is used for
+        directories created or moved into a watched tree, whose contents
+        never produced events of their own.
+        """
+        for root, dirs, files in os.walk(path):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    logger.warning(f"inotify watch limit reached at {root}; "
+                                   f"raise fs.inotify.max_user_watches to watch the whole folder")
+                elif err not in (errno.ENOENT, errno.ENOTDIR):
+                    logger.warning(f"Cannot watch {root}: {os.strerror(err)}")
+                # Changes below this directory would go unnoticed
+                self._rescan.add(folder_id)
+                continue
+            self._watches[wd] = (folder_id, root)
+            self._folder_watches[folder_id].add(wd)
+            if mark_files:
+                dirty = self._dirty.setdefault(folder_id, set())
+                dirty.update(os.path.join(root, name) for name in files)
+
+    def _forget_folder(self, folder_id):
+        for wd in self._folder_watches.pop(folder_id, ()):
+            self._watches.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+        self._roots.pop(folder_id, None)
+        self._dirty.pop(folder_id, None)
+        self._rescan.discard(folder_id)
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN)
+        while not self._stop_event.is_set():
+            if not poller.poll(500):
+                continue
+            try:
+                data = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                logger.error(f"Error reading inotify events: {e}")
+                break
+            with self._lock:
+                self._handle_events(data)
+                changed = bool(self._rescan) or any(self._dirty.values())
+            if changed and self.on_change:
+                self.on_change()
+
+    def _handle_events(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+            offset += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify event queue overflowed; rescanning all watched folders")
+                self._rescan.update(self._roots)
+                continue
+
+            watch = self._watches.get(wd)
+            if watch is None:
+                continue
+            folder_id, directory = watch
+
+            if mask & IN_IGNORED:
+                # The directory is gone or was unmounted; the kernel already
+                # dropped the watch
+                del self._watches[wd]
+                self._folder_watches[folder_id].discard(wd)
+                if directory == self._roots.get(folder_id):
+                    self._rescan.add(folder_id)
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if directory == self._roots.get(folder_id):
+                    self._rescan.add(folder_id)
+                continue
+
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(folder_id, path, mark_files=True)
+                elif mask & IN_MOVED_FROM:
+                    self._drop_subtree(folder_id, path)
+            elif mask & FILE_CHANGE_MASK:
+                self._dirty.setdefault(folder_id, set()).add(path)
+
+    def _drop_subtree(self, folder_id, path):
+        """Stop watching a directory that was moved out of (or within) a watched tree"""
+        prefix = path + os.sep
+        for wd in [wd for wd, (fid, d) in self._watches.items()
+                   if fid == folder_id and (d == path or d.startswith(prefix))]:
+            del self._watches[wd]
+            self._folder_watches[folder_id].discard(wd)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+
+# Create global watcher instance
+watcher = FolderWatcher()
@@ -0,0 +1,152 @@
+"""Standalone backup worker.
+
+Claims pending jobs from the database and runs them, so backups can be
+spread over several processes or machines while the web processes only
+serve HTTP. Start the web app with BACKUP_EXECUTION=workers and run:
+
+    python worker.py               # run queued jobs
+    python worker.py --scheduler   # also queue scheduled and watched backups
+
+Run exactly one process with --scheduler; it needs the monitored folders
+mounted locally for the file watcher.
+"""
+import argparse
+import logging
+import signal
+import threading
+from app import app, db
+from models import BackupJob
+from backup_utils import run_backup_job
+from job_queue import (make_worker_id, claim_job, renew_lease, release_job, reclaim_expired_jobs,
+                       recover_orphaned_jobs, decode_paths)
+from scheduler import scheduler
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BackupWorker:
+    def __init__(self, app, concurrency=None, worker_id=None):
+        self.app = app
+        self.worker_id = worker_id or make_worker_id()
+        self.concurrency = concurrency or app.config.get("BACKUP_MAX_CONCURRENT_JOBS", 2)
+        self.stop_event = threading.Event()
+        self._runners_done = threading.Event()
+        self._held = {}  # job id -> Event set when the job's claim is lost
+        self._held_lock = threading.Lock()
+    
+    def run(self):
+        """Run jobs until stop() is called; jobs in progress are finished first"""
+        logger.info(f"Backup worker {self.worker_id} started with {self.concurrency} job slots")
+        self._recover_jobs()
+        heartbeat = threading.Thread(target=self._heartbeat_run, name="job-heartbeat", daemon=True)
+        heartbeat.start()
+        runners = [
+            threading.Thread(target=self._runner_run, name=f"job-runner-{i}", daemon=True)
+            for i in range(self.concurrency)
+        ]
+        for runner in runners:
+            runner.start()
+        for runner in runners:
+            runner.join()
+        self._runners_done.set()
+        heartbeat.join()
+        logger.info(f"Backup worker {self.worker_id} stopped")
+    
+    def stop(self):
+        self.stop_event.set()
+    
+    def _recover_jobs(self):
+        """Requeue jobs that an in-process scheduler left unfinished, so they resume here"""
+        config = self.app.config
+        with self.app.app_context():
+            try:
+                recover_orphaned_jobs(config.get("JOB_MAX_ATTEMPTS", 3), config.get("JOB_ORPHAN_SECONDS", 3600),
+                                      self.worker_id)
+            except Exception as e:
+                logger.exception(f"Error recovering unfinished backup jobs: {e}")
+                db.session.rollback()
+    
+    def _runner_run(self):
+        config = self.app.config
+        with self.app.app_context():
+            while not self.stop_event.is_set():
+                try:
+                    reclaim_expired_jobs(config.get("JOB_MAX_ATTEMPTS", 3))
+                    job_id = claim_job(self.worker_id, config.get("JOB_LEASE_SECONDS", 60))
+                except Exception as e:
+                    logger.exception(f"Error claiming a backup job: {e}")
+                    db.session.rollback()
+                    job_id = None
+                
+                if job_id is None:
+                    self.stop_event.wait(config.get("JOB_CLAIM_INTERVAL", 2))
+                    continue
+                self._run_job(job_id)
+    
+    def _run_job(self, job_id):
+        lost = threading.Event()
+        with self._held_lock:
+            self._held[job_id] = lost
+        try:
+            job = db.session.get(BackupJob, job_id)
+            logger.info(f"Worker {self.worker_id} running backup job {job_id} ({job.name})")
+            run_backup_job(job_id, decode_paths(job.changed_paths), self.worker_id, lost)
+        except Exception as e:
+            logger.exception(f"Error running backup job {job_id}: {e}")
+            db.session.rollback()
+        finally:
+            with self._held_lock:
+                self._held.pop(job_id, None)
+            release_job(job_id, self.worker_id)
+    
+    def _heartbeat_run(self):
+        lease_seconds = self.app.config.get("JOB_LEASE_SECONDS", 60)
+        with self.app.app_context():
+            while not self._runners_done.wait(lease_seconds / 3):
+                with self._held_lock:
+                    held = list(self._held.items())
+                for job_id, lost in held:
+                    try:
+                        if not renew_lease(job_id, self.worker_id, lease_seconds):
+                            logger.warning(f"Lost the lease on backup job {job_id}; stopping it, another worker may run it again")
+                            lost.set()
+                    except Exception as e:
+                        logger.exception(f"Error renewing lease on backup job {job_id}: {e}")
+                        db.session.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run backup jobs from the shared job queue")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="jobs to run at once (default: BACKUP_MAX_CONCURRENT_JOBS)")
+    parser.add_argument("--scheduler", action="store_true",
+                        help="also run the scheduler and file watcher that queue jobs")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    
+    # Anything this process queues is for the shared queue, whatever the web tier uses
+    app.config["BACKUP_EXECUTION"] = "workers"
+    worker = BackupWorker(app, args.concurrency)
+    metrics.ensure_started()
+    
+    if args.scheduler:
+        scheduler.init_app(app)
+        scheduler.start()
+    
+    def handle_signal(signum, frame):
+        logger.info("Stopping after the jobs in progress finish...")
+        worker.stop()
+    
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    worker.run()
+    
+    if args.scheduler:
+        scheduler.shutdown()
+
+
+if __name__ == "__main__":
+    main()